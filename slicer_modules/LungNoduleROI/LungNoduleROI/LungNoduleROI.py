@@ -1,6 +1,10 @@
+import concurrent.futures
 import logging
 import os
+import shutil
+import subprocess
 
+import qt
 import vtk
 
 import slicer
@@ -14,6 +18,9 @@ import sitkUtils
 import glob
 import csv
 
+from LungNoduleROILib.roi import ImageROI
+from LungNoduleROILib import batch, instrument, resample, transforms
+
 
 
 class LungNoduleROI(ScriptedLoadableModule):
@@ -42,6 +49,15 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.nodeList = []
         self.currentVolume = None
         self.inSlices = False
+        self.imageROI = ImageROI()
+        # volume node ID -> numpy view of its voxels, dropped when its image data is modified
+        self.volumeArrays = {}
+        # roi name -> output node that is updated in place instead of adding a new volume per change
+        self.roiNodes = {}
+        # volume and centroids of the last apply, the sliders re-cut these rois live
+        self.previewVolume = None
+        self.previewCentroids = []
+        self.roiVolumes = []
 
     def setup(self):
         """
@@ -75,6 +91,16 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.noduleCentroidButton.connect('clicked(bool)', self.onNoduleCentroidButton)
         self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
         self.ui.batchCaseApplyButton.connect('clicked(bool)', self.onBatchCaseApplyButton)
+        self.ui.batchDryRunButton.connect('clicked(bool)', self.onBatchDryRunButton)
+        self.ui.segmentButton.connect('clicked(bool)', self.onSegmentButton)
+
+        # segmentation settings are kept in the parameter node
+        self.ui.modelPathLineEdit.connect('textChanged(QString)', self.updateParameterNodeFromGUI)
+        self.ui.segmentThresholdSpinBox.connect('valueChanged(double)', self.updateParameterNodeFromGUI)
+        self.ui.traceCheckBox.connect('toggled(bool)', self.updateParameterNodeFromGUI)
+        # so is the resampling of batch exports
+        self.ui.batchSpacingLineEdit.connect('textChanged(QString)', self.updateParameterNodeFromGUI)
+        self.ui.batchResampleLineEdit.connect('textChanged(QString)', self.updateParameterNodeFromGUI)
 
         # Sliders
         self.ui.roiSizeSlider.minimum = 4
@@ -159,6 +185,14 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
 
+        # cached arrays and output nodes belong to the closing scene
+        for volumeID in list(self.volumeArrays):
+            self.releaseVolumeArray(slicer.mrmlScene.GetNodeByID(volumeID), volumeID)
+        self.roiNodes = {}
+        self.previewVolume = None
+        self.previewCentroids = []
+        self.roiVolumes = []
+
     def onSceneEndClose(self, caller, event):
         """
         Called just after the scene is closed.
@@ -192,12 +226,15 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def aSliderNonIsoChanged(self):
         self.ui.aLineEditNonIso.text = self.ui.aSliderNonIso.value * 2
+        self.updatePreview()
 
     def cSliderNonIsoChanged(self):
         self.ui.cLineEditNonIso.text = self.ui.cSliderNonIso.value * 2
+        self.updatePreview()
 
     def sSliderNonIsoChanged(self):
         self.ui.sLineEditNonIso.text = self.ui.sSliderNonIso.value * 2
+        self.updatePreview()
 
     def aLineEditNonIsoChanged(self):
         self.ui.aSliderNonIso.value = (int(self.ui.aLineEditNonIso.text)) / 2
@@ -230,10 +267,15 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.clearNoduleCentroids()
 
     def onNoduleCentroidButton(self):
-        fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-        fiducialNode.SetName('nodule_centroid')
-
-        slicer.modules.markups.logic().StartPlaceMode(0)        
+        # every nodule of the scan is placed in the same node, one point each
+        fiducialNode = slicer.mrmlScene.GetFirstNodeByName('nodule_centroid')
+        if fiducialNode is None:
+            fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+            fiducialNode.SetName('nodule_centroid')
+        slicer.modules.markups.logic().SetActiveListID(fiducialNode)
+
+        # persistent place mode, keep placing points until the user stops
+        slicer.modules.markups.logic().StartPlaceMode(1)
         self.inSlices = False
 
     def onCentroidManualButton(self):
@@ -243,7 +285,7 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         fiducialNode.SetName('nodule_centroid')
         img = self.ui.volumeComboBox.currentNode()
         slices = [int(self.ui.sLineEdit.text), int(self.ui.cLineEdit.text), int(self.ui.aLineEdit.text)]
-        print(f'slices: {slices}')
+        logging.debug(f'slices: {slices}')
 
         self.inSlices = True
 
@@ -257,6 +299,7 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onRoiSliderValueChanged(self):
         self.ui.roiSizeLabel.setText(f'{self.ui.roiSizeSlider.value * 2}')
+        self.updatePreview()
 
 
     def onApplyButton(self):
@@ -273,166 +316,210 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             return
     
         if not self.inSlices:
-            # Get the centroid of the nodule
-            centroid = [0, 0, 0]
-            node.GetNthFiducialPosition(0, centroid)
-            print(f'centroid: {centroid}')
-
-            # Get the origin and spacing of the volume
-            origin = volume.GetOrigin()
-            print(f'origin: {origin}')
-            spacing = volume.GetSpacing()
-            print(f'spacing: {spacing}')
-
-            difference_vector = np.subtract(centroid, origin)
-            print(f'difference xyz: {difference_vector}')
-
-            difference_slices = np.divide(difference_vector, spacing)
-            difference_slices_int = []
-
-            # convert to int and take absolute value
-            for i in range(3):
-                slice = int(difference_slices[i])
-                if slice < 0:
-                    slice = -1 * slice
-                difference_slices_int.append(slice)
-
-            print(f'difference in slices: {difference_slices_int}')
-
-            self.ui.sLineEdit.text = str(difference_slices_int[0])
-            self.ui.cLineEdit.text = str(difference_slices_int[1])
-            self.ui.aLineEdit.text = str(difference_slices_int[2])
+            # Get the centroid of every placed nodule
+            centroids = []
+            for i in range(node.GetNumberOfFiducials()):
+                centroid = [0, 0, 0]
+                node.GetNthFiducialPosition(i, centroid)
+                centroids.append(centroid)
+            logging.debug(f'centroids: {centroids}')
+
+            if not centroids:
+                logging.error('No centroid selected')
+                return
+
+            # convert RAS to voxel indices with the full IJK to RAS matrix (origin, spacing and direction)
+            centroids_slices = self.centroidsToSlices(volume, centroids).tolist()
+            logging.debug(f'centroids in slices: {centroids_slices}')
+
+            self.ui.sLineEdit.text = str(centroids_slices[0][0])
+            self.ui.cLineEdit.text = str(centroids_slices[0][1])
+            self.ui.aLineEdit.text = str(centroids_slices[0][2])
 
         else:
-            difference_slices_int = [int(self.ui.sLineEdit.text), int(self.ui.cLineEdit.text), int(self.ui.aLineEdit.text)]
-            return
+            centroids_slices = [[int(self.ui.sLineEdit.text), int(self.ui.cLineEdit.text), int(self.ui.aLineEdit.text)]]
 
-        # Get the centroid of the nodule
-        if node is None:
-            logging.error('No centroid selected')
-            return
-        
-        # Get the centroid of the nodule
-        centroid = [0, 0, 0]
-        node.GetNthFiducialPosition(0, centroid)
-        print(f'centroid: {centroid}')
+        size = self.roiSize()
+        logging.debug(f'ROI size: {size}')
 
-        # Get the origin and spacing of the volume
-        origin = volume.GetOrigin()
-        print(f'origin: {origin}')
-        spacing = volume.GetSpacing()
-        print(f'spacing: {spacing}')
+        # create one roi per nodule, timing each step when Record Stage Timings is checked, the live preview runs untimed
+        tracer = instrument.Tracer(enabled=self.ui.traceCheckBox.isChecked())
+        self.create_rois(volume, centroids_slices, size, tracer)
+        tracer.report()
 
-        difference_vector = np.subtract(centroid, origin)
-        print(f'difference xyz: {difference_vector}')
-
-        difference_slices = np.divide(difference_vector, spacing)
-        difference_slices_int = []
-
-        # convert to int and take absolute value
-        for i in range(3):
-            slice = int(difference_slices[i])
-            if slice < 0:
-                slice = -1 * slice
-            difference_slices_int.append(slice)
-
-        print(f'difference in slices: {difference_slices_int}')
-
-        size = [0,0,0]
+        if self.ui.segmentRoiCheckBox.isChecked():
+            self.onSegmentButton()
 
+    def roiSize(self):
         if self.ui.roiCheckBox.isChecked():
-            size[0] = int(self.ui.sLineEditNonIso.text)
-            size[1] = int(self.ui.cLineEditNonIso.text)
-            size[2] = int(self.ui.aLineEditNonIso.text)
-            print(f'Non-isotropic size: {size}')
-        else:
-            size = [self.ui.roiSizeSlider.value * 2, self.ui.roiSizeSlider.value * 2, self.ui.roiSizeSlider.value * 2 ]
-            print(f'Isotropic size: {size}')
-
-        # create roi
-        self.create_roi(volume, difference_slices_int, size)
+            return [int(self.ui.sLineEditNonIso.text), int(self.ui.cLineEditNonIso.text), int(self.ui.aLineEditNonIso.text)]
 
-    def create_roi(self, volume, centroid, size):
+        return [self.ui.roiSizeSlider.value * 2, self.ui.roiSizeSlider.value * 2, self.ui.roiSizeSlider.value * 2]
 
-        sitk_img = sitkUtils.PullVolumeFromSlicer(volume.GetID())
-        imageROI = ImageROI()
-
-        print(f'Creating ROI with size {size} and centroid {centroid}')
+    # re-cut the rois of the last apply with the current slider sizes, reusing their output nodes
+    def updatePreview(self):
+        if self.previewVolume is None or not self.previewCentroids:
+            return
+        if not slicer.mrmlScene.IsNodePresent(self.previewVolume):
+            self.previewVolume = None
+            return
 
+        self.create_rois(self.previewVolume, self.previewCentroids, self.roiSize())
+
+    # voxel indices of RAS points in a volume node
+    def centroidsToSlices(self, volume, centroids):
+        rasToIjk = vtk.vtkMatrix4x4()
+        volume.GetRASToIJKMatrix(rasToIjk)
+        return transforms.ras_to_index(centroids, slicer.util.arrayFromVTKMatrix(rasToIjk))
+
+    # numpy view of the voxels of a volume node, no copy of the volume is made
+    # the view is cached until the voxels of the node change or its image data is replaced,
+    # other modifications of the node (name, display, selection) keep it
+    def volumeArray(self, volume):
+        volumeID = volume.GetID()
+        if volumeID not in self.volumeArrays:
+            self.volumeArrays[volumeID] = slicer.util.arrayFromVolume(volume)
+            self.addObserver(volume, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onCachedVolumeModified)
+
+        return self.volumeArrays[volumeID]
+
+    def releaseVolumeArray(self, volume, volumeID):
+        self.volumeArrays.pop(volumeID, None)
+        if volume is not None:
+            self.removeObserver(volume, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onCachedVolumeModified)
+
+    def onCachedVolumeModified(self, caller, event):
+        self.releaseVolumeArray(caller, caller.GetID())
+
+    # cut an roi around each centroid from the cached array of the volume
+    # rois are named <fileName>_<i> when there is more than one nodule
+    # tracer -> optional instrument.Tracer timing the array access, cut and node update
+    def create_rois(self, volume, centroids, size, tracer=instrument.DISABLED):
+        with tracer.stage('volume_array'):
+            volume_array = self.volumeArray(volume)
+        self.previewVolume = volume
+        self.previewCentroids = centroids
+
+        roi_volumes = []
+        for i, centroid in enumerate(centroids):
+            name = self.ui.fileName.text if len(centroids) == 1 else f'{self.ui.fileName.text}_{i}'
+            roi_volumes.append(self.create_roi(volume_array, centroid, size, name, tracer))
+
+        self.roiVolumes = roi_volumes
+        with tracer.stage('display'):
+            slicer.util.setSliceViewerLayers(background=roi_volumes[0], fit=True)
+
+        return roi_volumes
+
+    # cut one roi and write it to the output node of that name, the node is only created the first time
+    def create_roi(self, volume_array, centroid, size, name, tracer=instrument.DISABLED):
+        # the live preview re-cuts on every slider step, keep the console quiet
+        logging.debug(f'Creating ROI {name} with size {size} and centroid {centroid}')
+
+        with tracer.stage('cut', roi=name):
+            roi_img_np = self.imageROI.create_roi_image_from_array(volume_array, size, centroid)
+
+        with tracer.stage('update_node', roi=name):
+            roi_img_volume = self.roiNodes.get(name)
+            if roi_img_volume is None or not slicer.mrmlScene.IsNodePresent(roi_img_volume):
+                roi_img_volume = slicer.util.addVolumeFromArray(roi_img_np)
+                roi_img_volume.SetName(name)
+                self.roiNodes[name] = roi_img_volume
+            else:
+                slicer.util.updateVolumeFromArray(roi_img_volume, roi_img_np)
 
-        roi_img_np = imageROI.create_roi_image(sitk_img, size, centroid)
+        roi_img_display_node = roi_img_volume.GetDisplayNode()
+        roi_img_display_node.SetInterpolate(1 if self.ui.interpolationCheckBox.isChecked() else 0)
 
-        roi_img_volume = slicer.util.addVolumeFromArray(roi_img_np)
-        roi_img_volume.SetName(self.ui.fileName.text)
+        return roi_img_volume
 
-        if not self.ui.interpolationCheckBox.isChecked():
-            roi_img_display_node = roi_img_volume.GetDisplayNode()
-            roi_img_display_node.SetInterpolate(0)
+    # segment the rois of the last apply in the background, the labelmaps are added when the network is done
+    def onSegmentButton(self):
+        modelPath = self.ui.modelPathLineEdit.text
+        if not modelPath or not os.path.exists(modelPath):
+            logging.error('No model weights selected')
+            return
 
-        slicer.util.setSliceViewerLayers(background=roi_img_volume, fit=True)
-        print('ROI created')
+        roiVolumes = [volume for volume in self.roiVolumes if slicer.mrmlScene.IsNodePresent(volume)]
+        if not roiVolumes:
+            logging.error('No ROI created yet')
+            return
 
-        return roi_img_volume
+        for roiVolume in roiVolumes:
+            print(f'Segmenting {roiVolume.GetName()}')
+            self.logic.process(roiVolume, modelPath, self.ui.segmentThresholdSpinBox.value,
+                               callback=lambda labelmap: print(f'{labelmap.GetName()} created'))
 
     def onVolumeSelected(self):
         self.currentVolume = self.ui.volumeComboBox.currentNode()
 
     # BATCH CASES
 
+    # target spacing of the batch export from the spacing field, None keeps the native spacing
+    def batchSpacing(self):
+        text = self.ui.batchSpacingLineEdit.text.strip()
+        return resample.parse_spacing(text) if text else None
+
     def onBatchCaseApplyButton(self):
-        volumeListPath = self.ui.batchVolumeLineEdit.text
-        centroidListPath = self.ui.batchCentroidLineEdit.text
         outputDir = self.ui.batchOutputLineEdit.text
+        workers = self.ui.batchWorkersSpinBox.value
+        try:
+            spacing = self.batchSpacing()
+        except ValueError as e:
+            logging.error(str(e))
+            return
 
+        # the model is loaded once and every exported roi is segmented in the same pass
+        segment = None
+        if self.ui.batchSegmentCheckBox.isChecked() and self.ui.batchStoreCheckBox.isChecked():
+            logging.error('Segmenting reads the exported nrrd files, uncheck Write One HDF5 File to segment')
+        elif self.ui.batchSegmentCheckBox.isChecked():
+            segment = self.ui.modelPathLineEdit.text
+
+        # one chunked file instead of thousands of small ones, needs h5py in slicer's python
+        store = os.path.join(outputDir, 'rois.h5') if self.ui.batchStoreCheckBox.isChecked() else None
+        # load / cut / save times of every case and the peak memory of the workers, written next to the rois
+        # when Record Stage Timings is checked
+        trace = os.path.join(outputDir, 'batch_trace.json') if self.ui.traceCheckBox.isChecked() else None
+        # cases unchanged since the last export are skipped, an interrupted export picks up where it stopped
+        arguments = batch.batch_arguments(self.ui.batchVolumeLineEdit.text, self.ui.batchCentroidLineEdit.text,
+                                          outputDir, self.ui.batchCentroidSpaceComboBox.currentText, workers,
+                                          spacing=spacing, resampleDir=self.ui.batchResampleLineEdit.text or None,
+                                          store=store, incremental=self.ui.batchIncrementalCheckBox.isChecked(),
+                                          segment=segment, threshold=self.ui.segmentThresholdSpinBox.value,
+                                          trace=trace)
+
+        # the headless exporter runs in a process of its own with its own worker pool, slicer only streams its output
+        # to the python console and keeps the GUI alive in between
+        print(f'Exporting with {workers} workers')
+        python = shutil.which('PythonSlicer') or 'PythonSlicer'
+        proc = slicer.util.launchConsoleProcess([python, '-m', 'LungNoduleROILib.batch'] + arguments,
+                                                useStartupEnvironment=False,
+                                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            slicer.util.logProcessOutput(proc)
+        except subprocess.CalledProcessError as e:
+            logging.error(f'Batch export finished with exit code {e.returncode}, see the report above')
+
+    # print the cases the next incremental export would process and why, nothing is written
+    def onBatchDryRunButton(self):
+        outputDir = self.ui.batchOutputLineEdit.text
+        try:
+            spacing = self.batchSpacing()
+        except ValueError as e:
+            logging.error(str(e))
+            return
+        cases, unmatched = batch.collect_cases(self.ui.batchVolumeLineEdit.text, self.ui.batchCentroidLineEdit.text,
+                                               self.ui.batchCentroidSpaceComboBox.currentText)
 
-        volumePaths = os.listdir(volumeListPath)
-
-        cases = []
-
-        with open(centroidListPath) as file_obj: 
-            reader_obj = csv.reader(file_obj)
-            rows = []
-            for row in reader_obj:
-                print(row)
-                rows.append(row)
-
-        # create pairs of volumes and centroids for each case
-        for volumePath in volumePaths:
-            print('-----------------' + volumePath)
-            pid = volumePath.split('/')[-1].split('_')[0]
-
-            for row in rows:
-                if pid == row[0]:
-                    print('match')
-                    cases.append(self.case(volumeListPath + volumePath, row[0], row[1], row[2], row[3], row[4]))
-
-
-
-        for case in cases:
-            volume = slicer.util.loadVolume(case.volumePath)
-            centroid = [int(case.centroidS), int(case.centroidC), int(case.centroidA)]
-            size = [int(case.size), int(case.size), int(case.size)]
-
-            roi = self.create_roi(volume, centroid, size)
-
-            success = slicer.util.saveNode(roi, outputDir + '/' + case.PID + '_roi.nrrd')
-            if success:
-                print(f'Volume {case.PID} saved to {outputDir}')
-            else:
-                print(f'Failed to save volume {case.PID} to {outputDir}')
-               
-    
-
-    # class to store case information in batch processing
-    class case:
-        def __init__(self,volumePath, PID, centroidS, centroidC, centroidA, size):
-            self.volumePath = volumePath
-            self.PID = PID
-            self.centroidS = centroidS
-            self.centroidC = centroidC
-            self.centroidA = centroidA
-            self.size = size
+        storePath = os.path.join(outputDir, 'rois.h5')
+        if self.ui.batchStoreCheckBox.isChecked() and os.path.exists(storePath):
+            from LungNoduleROILib.roistore import ROIStore
 
+            with ROIStore(storePath, 'r') as store:
+                batch.print_plan(batch.plan_batch(cases, outputDir, spacing, store=store), unmatched)
+        else:
+            batch.print_plan(batch.plan_batch(cases, outputDir, spacing), unmatched)
 
     def setParameterNode(self, inputParameterNode):
         """
@@ -470,6 +557,12 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
         self._updatingGUIFromParameterNode = True
 
+        self.ui.modelPathLineEdit.text = self._parameterNode.GetParameter("ModelPath")
+        self.ui.segmentThresholdSpinBox.value = float(self._parameterNode.GetParameter("Threshold"))
+        self.ui.traceCheckBox.checked = self._parameterNode.GetParameter("Trace") == "true"
+        self.ui.batchSpacingLineEdit.text = self._parameterNode.GetParameter("BatchSpacing")
+        self.ui.batchResampleLineEdit.text = self._parameterNode.GetParameter("BatchResampleDir")
+
         # All the GUI updates are done
         self._updatingGUIFromParameterNode = False
 
@@ -488,6 +581,11 @@ class LungNoduleROIWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         nodes = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
         
         self._parameterNode.SetNodeReferenceID("InputVolume", self.ui.volumeComboBox.currentNodeID)
+        self._parameterNode.SetParameter("ModelPath", self.ui.modelPathLineEdit.text)
+        self._parameterNode.SetParameter("Threshold", str(self.ui.segmentThresholdSpinBox.value))
+        self._parameterNode.SetParameter("Trace", "true" if self.ui.traceCheckBox.checked else "false")
+        self._parameterNode.SetParameter("BatchSpacing", self.ui.batchSpacingLineEdit.text)
+        self._parameterNode.SetParameter("BatchResampleDir", self.ui.batchResampleLineEdit.text)
 
 
  
@@ -500,21 +598,96 @@ class LungNoduleROILogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        # a single background thread, segmentations run one after another on the cached model
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = []
 
     def setDefaultParameters(self, parameterNode):
         """
         Initialize parameter node with default settings.
         """
+        if not parameterNode.GetParameter("ModelPath"):
+            parameterNode.SetParameter("ModelPath", "")
         if not parameterNode.GetParameter("Threshold"):
-            parameterNode.SetParameter("Threshold", "100.0")
-        if not parameterNode.GetParameter("Invert"):
-            parameterNode.SetParameter("Invert", "false")
+            parameterNode.SetParameter("Threshold", "0.5")
+        if not parameterNode.GetParameter("Trace"):
+            parameterNode.SetParameter("Trace", "false")
+        # empty spacing keeps the native spacing, an empty cache resamples into <output>/resampled
+        if not parameterNode.GetParameter("BatchSpacing"):
+            parameterNode.SetParameter("BatchSpacing", "")
+        if not parameterNode.GetParameter("BatchResampleDir"):
+            parameterNode.SetParameter("BatchResampleDir", "")
+
+    def process(self, roiVolume, modelPath, threshold=0.5, showResult=True, callback=None):
+        """
+        Segment an ROI volume with the trained UNet without blocking the GUI.
+        The network runs in a background thread, the labelmap node <ROI name>_segmentation is created or
+        updated on the main thread once it is done and handed to callback.
+        """
+        # copy, the roi node may be updated in place by the live preview while the network runs
+        roi = np.array(slicer.util.arrayFromVolume(roiVolume))
+        future = self.executor.submit(self.calculate_nodule_ROI, roi, modelPath, threshold)
+
+        self.pending.append((future, roiVolume, showResult, callback))
+        if len(self.pending) == 1:
+            qt.QTimer.singleShot(50, self.collectSegmentations)
+
+        return future
+
+    def calculate_nodule_ROI(self, roi, modelPath, threshold=0.5):
+        """
+        Binary nodule mask of a (D, H, W) ROI array, runs in the background thread.
+        The model is loaded on first use and cached until the weights file changes.
+        """
+        # torch is only needed for segmentation, cutting rois works without it
+        from LungNoduleROILib import segmentation
+
+        session = segmentation.load_session(modelPath)
+        return segmentation.segment_roi(session, roi, threshold)
+
+    def collectSegmentations(self):
+        """
+        Turn finished segmentations into labelmap nodes, polled from the main thread while any are running.
+        """
+        running = []
+        for future, roiVolume, showResult, callback in self.pending:
+            if not future.done():
+                running.append((future, roiVolume, showResult, callback))
+                continue
+
+            try:
+                mask = future.result()
+            except Exception as e:
+                logging.error(f'Segmentation of {roiVolume.GetName()} failed: {e}')
+                continue
+            if not slicer.mrmlScene.IsNodePresent(roiVolume):
+                continue
+
+            labelmap = self.segmentationNode(roiVolume, mask)
+            if showResult:
+                slicer.util.setSliceViewerLayers(background=roiVolume, label=labelmap)
+            if callback:
+                callback(labelmap)
+
+        self.pending = running
+        if self.pending:
+            qt.QTimer.singleShot(50, self.collectSegmentations)
+
+    def segmentationNode(self, roiVolume, mask):
+        """
+        Labelmap node with the geometry of the ROI volume, reused when the ROI is segmented again.
+        """
+        name = f'{roiVolume.GetName()}_segmentation'
+        labelmap = slicer.mrmlScene.GetFirstNodeByName(name)
+        if labelmap is None or not labelmap.IsA('vtkMRMLLabelMapVolumeNode'):
+            labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', name)
 
-    def process(self, inputVolume, outputVolume, imageThreshold, invert=False, showResult=True):
-        pass
+        slicer.util.updateVolumeFromArray(labelmap, mask)
+        ijkToRas = vtk.vtkMatrix4x4()
+        roiVolume.GetIJKToRASMatrix(ijkToRas)
+        labelmap.SetIJKToRASMatrix(ijkToRas)
 
-    def calculate_nodule_ROI(self):
-        pass
+        return labelmap
 
 class LungNoduleROITest(ScriptedLoadableModuleTest):
 
@@ -530,30 +703,41 @@ class LungNoduleROITest(ScriptedLoadableModuleTest):
         self.test_t_ApplyThreshold1()
 
     def test_t_ApplyThreshold1(self):
-
-        pass
-
-class ImageROI:
-    def __init__(self):
-        print("ImageROI object created")
-    # create roi image from sitk image
-    # inputs:
-    # img -> SimpleITK image
-    # centroid -> centroid of lung nodule in coordinates using [1,1,1] spacing NOT SLICER
-    # expansion -> amount to expand ROI from centroid in +/- for each direction
-    def create_roi_image(self, img, expansion, centroid):
-        # expand roi from centroid
-        roi = {
-            'coronal' : [centroid[1]-int((expansion[1]) / 2), centroid[1]+int((expansion[1]) / 2)],
-            'sagittal' : [centroid[0]-int((expansion[0]) / 2), centroid[0]+int((expansion[0]) / 2)],
-            'axial' : [centroid[2]-int((expansion[2])/ 2), centroid[2]+int((expansion[2]) / 2)]
-
-        }
-
-        # convert to numpy array and cut down to roi around nodule centroid
-        np_img = sitk.GetArrayFromImage(img)
-        np_roi = np_img[roi['axial'][0]:roi['axial'][1],
-                        roi['coronal'][0]:roi['coronal'][1],
-                        roi['sagittal'][0]:roi['sagittal'][1]]
-
-        return np_roi
\ No newline at end of file
+        """ Cut an ROI at the border of a volume node from a markup in RAS and label it with the ROI geometry.
+        The library itself is covered by the pytest suite in Testing/Python.
+        """
+        self.delayDisplay("Starting the test")
+
+        # voxels hold their own flat index, (z, y, x) like slicer.util.arrayFromVolume
+        volumeArray = np.arange(10 * 12 * 14, dtype=np.int16).reshape(10, 12, 14)
+        volume = slicer.util.addVolumeFromArray(volumeArray, ijkToRAS=[[-0.7, 0, 0, 10], [0, -0.8, 0, -20],
+                                                                      [0, 0, 2.5, 30], [0, 0, 0, 1]])
+
+        # markup on voxel (x, y, z) = (13, 1, 5), close to the first and last columns
+        ijkToRas = vtk.vtkMatrix4x4()
+        volume.GetIJKToRASMatrix(ijkToRas)
+        centroid = np.array(ijkToRas.MultiplyPoint([13, 1, 5, 1])[:3])
+        rasToIjk = vtk.vtkMatrix4x4()
+        volume.GetRASToIJKMatrix(rasToIjk)
+        index = transforms.ras_to_index([centroid], slicer.util.arrayFromVTKMatrix(rasToIjk))[0]
+        self.assertEqual(list(index), [13, 1, 5])
+
+        # x window [9, 17) and y window [-2, 4) run over the volume and are padded with air
+        roi = ImageROI().create_roi_image_from_array(slicer.util.arrayFromVolume(volume), [8, 6, 4], index)
+        self.assertEqual(roi.shape, (4, 6, 8))
+        np.testing.assert_array_equal(roi[:, 2:, :5], volumeArray[3:7, 0:4, 9:14])
+        self.assertTrue((roi[:, :2, :] == -1000).all())
+        self.assertTrue((roi[:, :, 5:] == -1000).all())
+
+        # the labelmap of a segmented roi is created once, reused and keeps the geometry of the roi
+        roiVolume = slicer.util.addVolumeFromArray(roi)
+        roiVolume.SetName('roi')
+        roiVolume.SetSpacing(0.7, 0.8, 2.5)
+        logic = LungNoduleROILogic()
+        labelmap = logic.segmentationNode(roiVolume, (roi > 1000).astype(np.uint8))
+        self.assertEqual(labelmap.GetName(), 'roi_segmentation')
+        self.assertEqual(labelmap.GetSpacing(), roiVolume.GetSpacing())
+        np.testing.assert_array_equal(slicer.util.arrayFromVolume(labelmap), roi > 1000)
+        self.assertIs(logic.segmentationNode(roiVolume, np.zeros_like(roi, dtype=np.uint8)), labelmap)
+
+        self.delayDisplay("Test passed")
@@ -0,0 +1 @@
+from .roi import ImageROI
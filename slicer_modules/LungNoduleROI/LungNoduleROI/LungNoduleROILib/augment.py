@@ -0,0 +1,221 @@
+import math
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import default_collate, get_worker_info
+
+
+# (before, after) padding and crop start of every spatial axis that turns shape into size
+# offsets -> optional crop / pad position per axis in [0, 1], 0.5 keeps the roi centered
+def fit_window(shape, size, offsets=(0.5, 0.5, 0.5)):
+    padding = []
+    starts = []
+    for axis in range(3):
+        extra = size[axis] - shape[axis]
+        if extra >= 0:
+            before = int(round(extra * offsets[axis]))
+            padding.append((before, extra - before))
+            starts.append(0)
+        else:
+            padding.append((0, 0))
+            starts.append(int(round(-extra * offsets[axis])))
+    return padding, starts
+
+
+# crop and / or pad a (C, D, H, W) tensor to (C, *size)
+# pad_value -> value of the padded voxels, e.g. -1000 for scans in HU, 0 for labels and normalized scans
+def crop_or_pad(tensor, size, offsets=(0.5, 0.5, 0.5), pad_value=0.0):
+    padding, starts = fit_window(tensor.shape[-3:], size, offsets)
+    if any(before or after for before, after in padding):
+        # F.pad takes the last axis first
+        flat = [value for before_after in padding[::-1] for value in before_after]
+        tensor = F.pad(tensor, flat, value=pad_value)
+
+    return tensor[..., starts[0]:starts[0] + size[0], starts[1]:starts[1] + size[1], starts[2]:starts[2] + size[2]]
+
+
+# dataset transform bringing every (scan, label) pair to one size, so rois of any size can be batched
+# rois larger than size are cropped, smaller ones padded, the scan with its own minimum (air), the label with 0
+# inputs:
+# size -> (D, H, W) of the output
+# random -> random crop / pad position instead of the center, drawn from numpy (seeded per worker by data.worker_init)
+class FitToSize:
+    def __init__(self, size, random=False):
+        self.size = tuple(size)
+        self.random = random
+
+    def __call__(self, scan, label):
+        offsets = np.random.random(3) if self.random else (0.5, 0.5, 0.5)
+        pad_value = float(scan.min()) if scan.numel() else 0.0
+        return crop_or_pad(scan, self.size, offsets, pad_value), crop_or_pad(label, self.size, offsets, 0.0)
+
+
+# random augmentation of a whole (N, C, D, H, W) batch at once, on whatever device the batch lives on
+# every random parameter is drawn from one seeded CPU generator, so a run is reproducible on the cpu and the gpu
+# inside DataLoader workers every worker seeds its generator with seed + worker id
+# inputs:
+# crop_size -> optional (D, H, W), every sample gets its own random crop, padded first when the batch is smaller
+# flip -> probability of mirroring each spatial axis
+# rot90 -> probability of a random 90, 180 or 270 degree rotation in the axial (H, W) plane
+# affine -> probability of a small random affine transform
+# max_angle -> largest rotation around each axis in degrees
+# max_scale -> largest relative zoom, 0.1 zooms between 0.9 and 1.1
+# max_shift -> largest translation as a fraction of the roi size
+# intensity_shift / intensity_scale -> largest additive / relative intensity jitter, in the units of the scans
+#                                      (e.g. 50 for +-50 HU, 0.05 for normalized scans)
+# noise -> standard deviation of added gaussian noise
+# label_threshold -> labels are interpolated like the scans and binarized again at this value
+class BatchAugment:
+    def __init__(self, crop_size=None, flip=0.5, rot90=0.5, affine=0.3, max_angle=10.0, max_scale=0.1,
+                 max_shift=0.05, intensity_shift=0.0, intensity_scale=0.0, noise=0.0, label_threshold=0.5, seed=0):
+        self.crop_size = tuple(crop_size) if crop_size is not None else None
+        self.flip = flip
+        self.rot90 = rot90
+        self.affine = affine
+        self.max_angle = max_angle
+        self.max_scale = max_scale
+        self.max_shift = max_shift
+        self.intensity_shift = intensity_shift
+        self.intensity_scale = intensity_scale
+        self.noise = noise
+        self.label_threshold = label_threshold
+        self.seed = seed
+        self.generator = None
+        self.generatorPid = None
+
+    # the generator is created in the process that augments, a worker never continues the parent's sequence
+    def rng(self):
+        if self.generator is None or self.generatorPid != os.getpid():
+            info = get_worker_info()
+            self.generator = torch.Generator().manual_seed(self.seed + (info.id if info is not None else 0))
+            self.generatorPid = os.getpid()
+        return self.generator
+
+    def uniform(self, shape, low, high):
+        return torch.rand(shape, generator=self.rng()) * (high - low) + low
+
+    def chance(self, n, probability):
+        return torch.rand(n, generator=self.rng()) < probability
+
+    # per sample random crop, padded with the batch minimum when the crop is larger than the batch
+    def crop(self, scans, labels):
+        size = self.crop_size
+        padding, _ = fit_window(scans.shape[-3:], [max(size[i], scans.shape[2 + i]) for i in range(3)])
+        if any(before or after for before, after in padding):
+            flat = [value for before_after in padding[::-1] for value in before_after]
+            scans = F.pad(scans, flat, value=float(scans.min()))
+            labels = F.pad(labels, flat, value=0.0)
+
+        # every crop window is a view of the unfolded batch, one gather copies just the picked windows
+        n = scans.shape[0]
+        starts = []
+        for axis in range(3):
+            room = scans.shape[2 + axis] - size[axis]
+            starts.append((torch.rand(n, generator=self.rng()) * (room + 1)).long().clamp(max=room).to(scans.device))
+        batch = torch.arange(n, device=scans.device)
+
+        def windows(tensor):
+            tensor = tensor.unfold(2, size[0], 1).unfold(3, size[1], 1).unfold(4, size[2], 1)
+            return tensor[batch, :, starts[0], starts[1], starts[2]]
+
+        return windows(scans), windows(labels)
+
+    # flips and axial rotations are exact, samples sharing a flip / rotation pattern are transformed together
+    def flips_and_rotations(self, scans, labels):
+        n = scans.shape[0]
+        flips = torch.stack([self.chance(n, self.flip) for _ in range(3)], 1)
+        turns = torch.zeros(n, dtype=torch.long)
+        if self.rot90 > 0 and scans.shape[3] == scans.shape[4]:
+            turns = torch.randint(1, 4, (n,), generator=self.rng()) * self.chance(n, self.rot90)
+
+        patterns = flips[:, 0] * 1 + flips[:, 1] * 2 + flips[:, 2] * 4 + turns * 8
+        if not patterns.any():
+            return scans, labels
+
+        scans = scans.clone()
+        labels = labels.clone()
+        for pattern in patterns.unique().tolist():
+            if pattern == 0:
+                continue
+            picked = (patterns == pattern).nonzero().flatten().to(scans.device)
+            dims = [2 + axis for axis in range(3) if pattern >> axis & 1]
+            for tensor in (scans, labels):
+                group = tensor[picked]
+                if dims:
+                    group = group.flip(dims)
+                if pattern >> 3:
+                    group = torch.rot90(group, pattern >> 3, (3, 4))
+                tensor[picked] = group
+
+        return scans, labels
+
+    # (N, 3, 4) affine matrices in the normalized coordinates of F.affine_grid, identity for unpicked samples
+    def affine_matrices(self, n):
+        angles = self.uniform((n, 3), -1.0, 1.0) * math.radians(self.max_angle)
+        scales = 1.0 + self.uniform((n, 1), -self.max_scale, self.max_scale)
+        shifts = self.uniform((n, 3), -2 * self.max_shift, 2 * self.max_shift)
+
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        zeros, ones = torch.zeros(n), torch.ones(n)
+        rx = torch.stack([ones, zeros, zeros, zeros, cos[:, 0], -sin[:, 0], zeros, sin[:, 0], cos[:, 0]], 1)
+        ry = torch.stack([cos[:, 1], zeros, sin[:, 1], zeros, ones, zeros, -sin[:, 1], zeros, cos[:, 1]], 1)
+        rz = torch.stack([cos[:, 2], -sin[:, 2], zeros, sin[:, 2], cos[:, 2], zeros, zeros, zeros, ones], 1)
+        rotation = rx.view(n, 3, 3) @ ry.view(n, 3, 3) @ rz.view(n, 3, 3)
+
+        theta = torch.cat([rotation / scales[:, :, None], shifts[:, :, None]], 2)
+        identity = torch.eye(3, 4).expand(n, 3, 4)
+        picked = self.chance(n, self.affine).view(n, 1, 1)
+
+        return torch.where(picked, theta, identity), picked.view(n)
+
+    def affine_transform(self, scans, labels):
+        theta, picked = self.affine_matrices(scans.shape[0])
+        if not picked.any():
+            return scans, labels
+
+        # only the picked samples are resampled, the others stay bit exact
+        theta = theta[picked].to(scans.device, scans.dtype)
+        picked = picked.to(scans.device)
+        grid = F.affine_grid(theta, list(scans[picked].shape), align_corners=False)
+        scans = scans.clone()
+        labels = labels.clone()
+        scans[picked] = F.grid_sample(scans[picked], grid, mode='bilinear', padding_mode='border',
+                                      align_corners=False)
+        warped = F.grid_sample(labels[picked].to(grid.dtype), grid, mode='bilinear', padding_mode='zeros',
+                               align_corners=False)
+        labels[picked] = (warped >= self.label_threshold).to(labels.dtype)
+
+        return scans, labels
+
+    def intensity(self, scans):
+        n = scans.shape[0]
+        view = (n,) + (1,) * (scans.dim() - 1)
+        if self.intensity_scale:
+            scans = scans * (1.0 + self.uniform(n, -self.intensity_scale, self.intensity_scale)).to(scans).view(view)
+        if self.intensity_shift:
+            scans = scans + self.uniform(n, -self.intensity_shift, self.intensity_shift).to(scans).view(view)
+        if self.noise:
+            scans = scans + torch.randn(scans.shape, generator=self.rng()).to(scans) * self.noise
+        return scans
+
+    def __call__(self, scans, labels):
+        if self.crop_size is not None:
+            scans, labels = self.crop(scans, labels)
+        scans, labels = self.flips_and_rotations(scans, labels)
+        if self.affine > 0:
+            scans, labels = self.affine_transform(scans, labels)
+
+        return self.intensity(scans), labels
+
+
+# DataLoader collate_fn that stacks the samples and augments the batch inside the worker
+# samples must share one shape, see FitToSize for datasets with rois of several sizes
+class AugmentCollate:
+    def __init__(self, augment):
+        self.augment = augment
+
+    def __call__(self, samples):
+        scans, labels = default_collate(samples)
+        return self.augment(scans, labels)
@@ -0,0 +1,557 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+
+from LungNoduleROILib import instrument, manifest, resample, transforms
+from LungNoduleROILib.roi import ImageROI
+
+
+# spaces the centroid columns of the csv can be given in
+CENTROID_SPACES = ('index', 'ras', 'lps')
+
+# bump when the roi export itself changes so every case is exported again
+EXPORT_VERSION = 1
+# journal of exported cases in the output directory, one json line per finished case, the last line of a case wins
+EXPORT_MANIFEST = 'export_manifest.jsonl'
+
+
+# class to store case information in batch processing, one case per nodule
+# noduleIdx -> position of the nodule among the csv rows of its volume
+# centroidSpace -> 'index' for voxel indices, 'ras' (slicer) or 'lps' (itk) for physical coordinates in mm
+class Case:
+    def __init__(self, volumePath, PID, centroidS, centroidC, centroidA, size, centroidSpace='index', noduleIdx=0):
+        self.volumePath = volumePath
+        self.PID = PID
+        self.centroidS = centroidS
+        self.centroidC = centroidC
+        self.centroidA = centroidA
+        self.size = size
+        self.centroidSpace = centroidSpace
+        self.noduleIdx = noduleIdx
+
+    @property
+    def name(self):
+        return f'{self.PID}_{self.noduleIdx}'
+
+    # centroid as voxel indices, physical centroids are mapped with the volume's geometry
+    # geometry -> (origin, spacing, direction) of the volume the roi is cut from, read from its header when not given
+    # sourceGeometry -> geometry of the original volume when the roi is cut from a resampled copy,
+    #                   index centroids are mapped through physical space onto the resampled grid
+    def centroid(self, geometry=None, sourceGeometry=None):
+        if self.centroidSpace == 'index':
+            index = [int(self.centroidS), int(self.centroidC), int(self.centroidA)]
+            if sourceGeometry is None:
+                return index
+            return resample.map_indices(index, sourceGeometry, geometry).tolist()
+
+        point = [float(self.centroidS), float(self.centroidC), float(self.centroidA)]
+        if self.centroidSpace == 'ras':
+            point = transforms.ras_to_lps(point)
+        if geometry is None:
+            geometry = transforms.geometry_from_file(self.volumePath)
+
+        return transforms.physical_to_index(point, geometry).tolist()
+
+    def roi_size(self):
+        return [int(self.size), int(self.size), int(self.size)]
+
+
+# outcome of a single exported case
+class CaseResult:
+    def __init__(self, PID, volumePath, outputPath, success, seconds, error=None):
+        # <PID>_<noduleIdx>
+        self.PID = PID
+        self.volumePath = volumePath
+        self.outputPath = outputPath
+        self.success = success
+        self.seconds = seconds
+        self.error = error
+        # set by segment_results
+        self.segmentationPath = None
+        # instrument records and memory snapshots of this case, filled when the batch is traced
+        self.trace = []
+        self.memory = []
+        # roi and metadata handed back to the parent process when exporting into a roistore.ROIStore
+        self.sample = None
+        # up to date in the export manifest, not exported again
+        self.skipped = False
+
+
+# pair every volume in a directory with its row in the centroid csv
+# inputs:
+# volumeDir -> directory of volumes named <PID>_*.nrrd / .nii.gz
+# centroidCsv -> csv with rows PID, centroidS, centroidC, centroidA, size
+# centroidSpace -> space of the centroid columns, see Case
+# returns the cases and the csv rows that could not be paired as (<PID>_<noduleIdx>, reason),
+# hand them to report / print_plan so they show up next to the exported cases
+def collect_cases(volumeDir, centroidCsv, centroidSpace='index'):
+    caseManifest = manifest.build_case_manifest(volumeDir, centroidCsv)
+    print(f'Case manifest: {caseManifest.summary()}')
+
+    unmatched = []
+    for pid, (volumePaths, rows) in caseManifest.duplicates.items():
+        print(f'Skipping {pid}: {len(volumePaths)} volumes')
+        unmatched += [(f'{pid}_{noduleIdx}', f'{len(volumePaths)} volumes') for noduleIdx in range(len(rows))]
+    for pid in caseManifest.unmatchedLeft:
+        print(f'Skipping {pid}: no csv row')
+    for pid, rows in caseManifest.unmatchedRight.items():
+        print(f'Skipping {pid}: no volume for {len(rows)} csv rows')
+        unmatched += [(f'{pid}_{noduleIdx}', 'no volume') for noduleIdx in range(len(rows))]
+
+    cases = []
+    for pid, (volumePath, rows) in caseManifest.matched.items():
+        for noduleIdx, row in enumerate(rows):
+            # rows cut short or with empty columns are reported instead of failing the whole collection
+            if len(row) < 5 or not all(value.strip() for value in row[:5]):
+                print(f'Skipping {pid}_{noduleIdx}: incomplete csv row {row}')
+                unmatched.append((f'{pid}_{noduleIdx}', 'incomplete csv row'))
+                continue
+            cases.append(Case(volumePath, row[0], row[1], row[2], row[3], row[4], centroidSpace, noduleIdx))
+
+    return cases, unmatched
+
+
+# cases sharing a volume, in order
+def group_by_volume(cases):
+    groups = {}
+    for case in cases:
+        groups.setdefault(case.volumePath, []).append(case)
+    return list(groups.values())
+
+
+# everything an exported roi depends on, the case is exported again when any of it changes
+# volumeFingerprint -> manifest.fingerprint of the volume, size and mtime or also a content hash
+def case_inputs(case, volumeFingerprint, spacing=None):
+    return {
+        'version': EXPORT_VERSION,
+        'volume': os.path.abspath(case.volumePath),
+        'fingerprint': volumeFingerprint,
+        'centroid': [str(case.centroidS).strip(), str(case.centroidC).strip(), str(case.centroidA).strip()],
+        'centroidSpace': case.centroidSpace,
+        'size': str(case.size).strip(),
+        'spacing': [float(s) for s in spacing] if spacing is not None else None,
+    }
+
+
+def export_manifest_path(outputDir):
+    return os.path.join(outputDir, EXPORT_MANIFEST)
+
+
+# {case name: entry} of the last export of every case, a line cut short by a crash is ignored
+def load_export_manifest(outputDir):
+    entries = {}
+    path = export_manifest_path(outputDir)
+    if not os.path.exists(path):
+        return entries
+
+    with open(path) as file_obj:
+        for line in file_obj:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['name']] = entry
+
+    return entries
+
+
+# rewrite the journal with one line per case, written next to it and swapped in once complete
+def compact_export_manifest(outputDir):
+    entries = load_export_manifest(outputDir)
+    path = export_manifest_path(outputDir)
+    with open(path + '.tmp', 'w') as file_obj:
+        for name in sorted(entries):
+            file_obj.write(json.dumps(entries[name], sort_keys=True) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+# why a case has to be exported, None when its output is up to date
+def export_reason(entry, inputs, outputExists):
+    if entry is None:
+        return 'new'
+    if not entry['success']:
+        return 'failed before'
+    if any(entry.get(key) != value for key, value in inputs.items() if key != 'fingerprint'):
+        return 'centroid, size or spacing changed'
+    if entry.get('fingerprint') != inputs['fingerprint']:
+        return 'volume changed'
+    if not outputExists:
+        return 'output missing'
+    return None
+
+
+# compare cases with the export manifest of the output directory
+# inputs:
+# cases -> list of Case
+# outputDir -> directory holding the rois and the export manifest
+# spacing -> target spacing of the run, see run_batch
+# useHash -> also compare content hashes of the volumes, slower but robust to copies that reset mtimes
+# store -> open roistore.ROIStore when exporting into one file, outputs are looked up in it
+# returns a list of (case, inputs, reason), reason is None for cases that are up to date
+def plan_batch(cases, outputDir, spacing=None, useHash=False, store=None):
+    entries = load_export_manifest(outputDir)
+    fingerprints = {}
+    plan = []
+
+    for case in cases:
+        if case.volumePath not in fingerprints:
+            try:
+                fingerprints[case.volumePath] = manifest.fingerprint(case.volumePath, useHash)
+            except OSError:
+                fingerprints[case.volumePath] = None
+
+        inputs = case_inputs(case, fingerprints[case.volumePath], spacing)
+        if inputs['fingerprint'] is None:
+            plan.append((case, inputs, 'volume unreadable'))
+            continue
+
+        if store is not None:
+            outputExists = case.name in store
+        else:
+            outputExists = os.path.exists(os.path.join(outputDir, case.name + '_roi.nrrd'))
+        plan.append((case, inputs, export_reason(entries.get(case.name), inputs, outputExists)))
+
+    return plan
+
+
+# cut and save the rois of every nodule of one volume, runs inside a worker process
+# a single nodule is read straight from the file window, several nodules share one decode of the volume
+# inputs:
+# cases -> cases of a single volume
+# outputDir -> directory the rois are written to
+# spacing -> optional target spacing in mm, rois are then cut from a resampled copy of the volume
+# resampleDir -> directory resampled volumes are cached in, see resample.cached_resample
+# resampleThreads -> threads used to resample the volume
+# trace -> record resample / load / cut / save times and the worker's peak memory on the results
+# store -> keep the rois on the results instead of writing nrrd files, the parent appends them to one store file
+def export_volume(cases, outputDir, spacing=None, resampleDir=None, resampleThreads=1, trace=False, store=False):
+    imageROI = ImageROI()
+    tracer = instrument.Tracer(enabled=trace)
+    results = []
+
+    start = time.perf_counter()
+    volumePath = cases[0].volumePath
+    geometry = sourceGeometry = img = error = None
+    try:
+        if spacing is not None:
+            with tracer.stage('resample', case=cases[0].PID):
+                sourceGeometry = transforms.geometry_from_file(volumePath)
+                volumePath = resample.cached_resample(volumePath, spacing, resampleDir, threads=resampleThreads)
+                geometry = transforms.geometry_from_file(volumePath)
+        if len(cases) > 1:
+            with tracer.stage('load', case=cases[0].PID):
+                img = sitk.ReadImage(volumePath)
+                geometry = transforms.geometry_from_image(img)
+        # the store keeps the geometry the centroids refer to
+        if store and geometry is None:
+            geometry = transforms.geometry_from_file(volumePath)
+    except Exception as e:
+        error = str(e)
+    loadSeconds = (time.perf_counter() - start) / len(cases)
+    volumeRecords = tracer.records
+    tracer.records = []
+
+    for case in cases:
+        start = time.perf_counter()
+        outputPath = os.path.join(outputDir, case.name + '_roi.nrrd')
+
+        try:
+            if error is not None:
+                raise RuntimeError(error)
+
+            centroid = case.centroid(geometry, sourceGeometry)
+            # a single nodule is streamed from the file, reading and cutting are one step
+            with tracer.stage('cut' if img is not None else 'load_cut', case=case.name):
+                if img is None:
+                    roi = imageROI.create_roi_image_from_file(volumePath, case.roi_size(), centroid)
+                else:
+                    roi = imageROI.create_roi_image(img, case.roi_size(), centroid)
+            if not store:
+                with tracer.stage('save', case=case.name):
+                    sitk.WriteImage(sitk.GetImageFromArray(roi), outputPath, useCompression=True)
+        except Exception as e:
+            seconds = loadSeconds + time.perf_counter() - start
+            results.append(CaseResult(case.name, case.volumePath, outputPath, False, seconds, str(e)))
+        else:
+            seconds = loadSeconds + time.perf_counter() - start
+            results.append(CaseResult(case.name, case.volumePath, outputPath, True, seconds))
+            if store:
+                results[-1].sample = {'roi': roi, 'geometry': geometry, 'centroid': centroid, 'pid': case.PID,
+                                      'source': case.volumePath,
+                                      'fingerprint': manifest.fingerprint(case.volumePath)}
+
+        results[-1].trace = tracer.records
+        tracer.records = []
+
+    # the shared volume load is kept on the first case, the worker's memory on the last
+    results[0].trace = volumeRecords + results[0].trace
+    if trace:
+        results[-1].memory = [tracer.snapshot(volume=cases[0].PID, pid=os.getpid())]
+
+    return results
+
+
+# pool initializer, workers already run in parallel, keep each one from spawning a thread per core
+# only set in the workers, an in-process export must not cap the threads of the caller (e.g. slicer) for good
+def init_worker():
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+
+# export every case across a pool of worker processes, one task per volume
+# inputs:
+# cases -> list of Case
+# outputDir -> directory the <PID>_<noduleIdx>_roi.nrrd files are written to
+# workers -> number of worker processes, defaulted to one per core
+# progress -> optional callable(result, done, total) called as each case finishes
+# spacing -> optional target spacing in mm, volumes are resampled before the rois are cut
+# resampleDir -> cache of resampled volumes, defaulted to <outputDir>/resampled, share it between runs
+# tracer -> optional instrument.Tracer collecting the stage times of every case
+# store -> optional open roistore.ROIStore, rois are appended to it as the workers finish instead of written as nrrd
+# incremental -> skip cases that are up to date in the export manifest, new, changed and failed cases are exported
+# useHash -> see plan_batch
+# every finished case is appended to the export manifest right away, an interrupted run resumes where it stopped
+def run_batch(cases, outputDir, workers=None, progress=None, spacing=None, resampleDir=None,
+              tracer=instrument.DISABLED, store=None, incremental=False, useHash=False):
+    os.makedirs(outputDir, exist_ok=True)
+    results = []
+
+    plan = plan_batch(cases, outputDir, spacing, useHash, store)
+    inputs = {case.name: caseInputs for case, caseInputs, reason in plan}
+    if incremental:
+        for case, caseInputs, reason in plan:
+            if reason is None:
+                outputPath = store.path if store is not None else os.path.join(outputDir, case.name + '_roi.nrrd')
+                result = CaseResult(case.name, case.volumePath, outputPath, True, 0.0)
+                result.skipped = True
+                results.append(result)
+        cases = [case for case, caseInputs, reason in plan if reason is not None]
+        print(f'{len(results)} cases up to date, exporting {len(cases)}')
+    groups = group_by_volume(cases)
+    total = len(results) + len(cases)
+
+    if resampleDir is None:
+        resampleDir = os.path.join(outputDir, 'resampled')
+    # each worker resamples with its share of the cores
+    resampleThreads = max(1, (os.cpu_count() or 1) // (workers or os.cpu_count() or 1))
+    options = {'spacing': spacing, 'resampleDir': resampleDir, 'resampleThreads': resampleThreads,
+               'trace': tracer.enabled, 'store': store is not None}
+
+    journal = open(export_manifest_path(outputDir), 'a')
+
+    def collect(groupResults):
+        for result in groupResults:
+            tracer.extend(result.trace, result.memory)
+            if result.sample is not None:
+                try:
+                    with tracer.stage('append', case=result.PID):
+                        store.append(result.PID, **result.sample)
+                except Exception as e:
+                    result.success = False
+                    result.error = str(e)
+                result.sample = None
+                result.outputPath = store.path
+
+            entry = dict(inputs[result.PID], name=result.PID, output=result.outputPath, success=result.success,
+                         error=result.error, seconds=round(result.seconds, 4), exported=time.time())
+            journal.write(json.dumps(entry, sort_keys=True) + '\n')
+            journal.flush()
+
+            results.append(result)
+            if progress:
+                progress(result, len(results), total)
+
+    try:
+        if workers == 1:
+            for group in groups:
+                collect(export_volume(group, outputDir, **options))
+        elif groups:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                futures = {executor.submit(export_volume, group, outputDir, **options): group for group in groups}
+                for future in as_completed(futures):
+                    try:
+                        groupResults = future.result()
+                    except Exception as e:
+                        # a worker that died (e.g. killed when out of memory) breaks the pool, the cases of every
+                        # unfinished volume are recorded as failed and exported again by the next incremental run
+                        groupResults = [CaseResult(case.name, case.volumePath,
+                                                   os.path.join(outputDir, case.name + '_roi.nrrd'), False, 0.0,
+                                                   f'{type(e).__name__}: {e}') for case in futures[future]]
+                    collect(groupResults)
+    finally:
+        journal.close()
+        compact_export_manifest(outputDir)
+
+    return results
+
+
+# command line of main for an export, run as `python -m LungNoduleROILib.batch <arguments>` from the module
+# directory so the worker pool lives in a process of its own and not inside slicer
+# inputs are those of main, spacing a list of mm and store the path of the HDF5 file
+def batch_arguments(volumeDir, centroidCsv, outputDir, centroidSpace='index', workers=None, spacing=None,
+                    resampleDir=None, store=None, incremental=True, segment=None, threshold=0.5, reportPath=None,
+                    trace=None):
+    arguments = [volumeDir, centroidCsv, outputDir, '--centroid-space', centroidSpace]
+    if workers is not None:
+        arguments += ['--workers', str(workers)]
+    if spacing is not None:
+        arguments += ['--spacing', ','.join(str(float(s)) for s in spacing)]
+    if resampleDir is not None:
+        arguments += ['--resample-cache', resampleDir]
+    if store is not None:
+        arguments += ['--store', store]
+    if not incremental:
+        arguments += ['--force']
+    if segment is not None:
+        arguments += ['--segment', segment, '--threshold', str(threshold)]
+    if reportPath is not None:
+        arguments += ['--report', reportPath]
+    if trace is not None:
+        arguments += ['--trace', trace]
+
+    return arguments
+
+
+# segment every exported roi with a trained UNet in this process, the model is loaded once for the whole batch
+# torch is only imported when segmenting, exporting rois does not need it
+# inputs:
+# results -> CaseResults of run_batch, segmentationPath is set on the ones that were segmented
+# weightsPath -> UNet state dict
+# threshold -> probability threshold of the masks
+# progress -> optional callable(roiPath, segmentationPath, done, total)
+def segment_results(results, weightsPath, threshold=0.5, progress=None, **options):
+    from LungNoduleROILib import segmentation
+
+    # rois skipped as up to date are only segmented when their segmentation is missing
+    exported = [result for result in results if result.success and
+                not (result.skipped and os.path.exists(segmentation.segmentation_path(result.outputPath)))]
+    segmented = {}
+    if exported:
+        segmented = segmentation.segment_files([result.outputPath for result in exported], weightsPath, threshold,
+                                               progress=progress, **options)
+    for result in results:
+        if result in exported:
+            result.segmentationPath = segmented.get(result.outputPath)
+        elif result.success:
+            result.segmentationPath = segmentation.segmentation_path(result.outputPath)
+
+    return results
+
+
+# print what an incremental run would export and why, see plan_batch
+# unmatched -> csv rows collect_cases could not pair with a volume, they are never exported
+def print_plan(plan, unmatched=()):
+    pending = [(case, reason) for case, inputs, reason in plan if reason is not None]
+    for case, reason in pending:
+        print(f'{case.name}: {reason}')
+    for name, reason in unmatched:
+        print(f'{name}: skipped, {reason}')
+    print(f'{len(pending)} cases to export, {len(plan) - len(pending)} up to date, {len(unmatched)} csv rows skipped')
+
+    return pending
+
+
+# print a per-case report and totals, optionally write it to a csv
+# unmatched -> csv rows collect_cases could not pair with a volume, listed and written with success False and the reason
+def report(results, wallSeconds, reportPath=None, unmatched=()):
+    for result in sorted(results, key=lambda r: r.PID):
+        if result.skipped:
+            status = 'up to date'
+        else:
+            status = 'ok' if result.success else f'FAILED ({result.error})'
+        print(f'{result.PID}: {status} {result.seconds:.2f}s')
+    for name, reason in unmatched:
+        print(f'{name}: SKIPPED ({reason})')
+
+    succeeded = sum(result.success for result in results)
+    skipped = sum(result.skipped for result in results)
+    print(f'{succeeded}/{len(results)} cases exported in {wallSeconds:.1f}s ({skipped} up to date, '
+          f'{len(unmatched)} csv rows skipped)')
+
+    if reportPath:
+        with open(reportPath, 'w', newline='') as file_obj:
+            writer = csv.writer(file_obj)
+            writer.writerow(['PID', 'volume', 'output', 'success', 'seconds', 'error', 'segmentation', 'up_to_date'])
+            for result in results:
+                writer.writerow([result.PID, result.volumePath, result.outputPath, result.success,
+                                 f'{result.seconds:.4f}', result.error or '', result.segmentationPath or '',
+                                 result.skipped])
+            for name, reason in unmatched:
+                writer.writerow([name, '', '', False, '', reason, '', False])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export lung nodule ROIs for a directory of CT volumes.')
+    parser.add_argument('volumes', help='directory of volumes named <PID>_*')
+    parser.add_argument('centroids', help='csv with rows PID, centroidS, centroidC, centroidA, size, one per nodule')
+    parser.add_argument('output', help='directory the <PID>_<noduleIdx>_roi.nrrd files are written to')
+    parser.add_argument('--centroid-space', choices=CENTROID_SPACES, default='index',
+                        help='centroid columns are voxel indices (default) or RAS / LPS coordinates in mm')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--report', default=None, help='optional csv path for the per-case report')
+    parser.add_argument('--spacing', default=None,
+                        help='resample volumes to this spacing in mm before cutting, one value or "x,y,z"')
+    parser.add_argument('--resample-cache', default=None,
+                        help='directory resampled volumes are cached in (default: <output>/resampled)')
+    parser.add_argument('--segment', default=None, metavar='WEIGHTS',
+                        help='segment every exported roi with these UNet weights, written as <PID>_<noduleIdx>_seg.nrrd')
+    parser.add_argument('--threshold', type=float, default=0.5, help='probability threshold of the segmentations')
+    parser.add_argument('--store', default=None, metavar='H5',
+                        help='append every roi to this chunked HDF5 file instead of writing one nrrd per case')
+    parser.add_argument('--codec', default='gzip', help='compression of the --store samples: gzip, lzf or none')
+    parser.add_argument('--level', type=int, default=4, help='gzip level 0-9 of the --store samples (default: 4)')
+    parser.add_argument('--force', action='store_true',
+                        help='export every case again, by default only new, changed and failed cases are exported')
+    parser.add_argument('--hash', action='store_true',
+                        help='detect changed volumes by content hash instead of size and modification time')
+    parser.add_argument('--dry-run', action='store_true', help='list the cases that would be exported and exit')
+    parser.add_argument('--trace', default=None,
+                        help='write per-stage times and peak memory to this .json or .csv file and print a summary')
+    args = parser.parse_args(argv)
+    if args.store and args.segment:
+        parser.error('--segment reads the exported nrrd files and cannot be combined with --store')
+
+    spacing = resample.parse_spacing(args.spacing) if args.spacing else None
+    cases, unmatched = collect_cases(args.volumes, args.centroids, args.centroid_space)
+    tracer = instrument.Tracer(enabled=args.trace is not None)
+    options = {'spacing': spacing, 'resampleDir': args.resample_cache, 'tracer': tracer,
+               'incremental': not args.force, 'useHash': args.hash}
+
+    if args.dry_run:
+        store = None
+        if args.store and os.path.exists(args.store):
+            from LungNoduleROILib.roistore import ROIStore
+
+            store = ROIStore(args.store, 'r')
+        print_plan(plan_batch(cases, args.output, spacing, args.hash, store), unmatched)
+        if store is not None:
+            store.close()
+        return 0
+
+    start = time.perf_counter()
+    if args.store:
+        # h5py is only needed for this export mode
+        from LungNoduleROILib.roistore import ROIStore
+
+        with ROIStore(args.store, 'a', args.codec, args.level) as store:
+            results = run_batch(cases, args.output, args.workers, store=store, **options)
+    else:
+        results = run_batch(cases, args.output, args.workers, **options)
+    exportSeconds = time.perf_counter() - start
+    if args.segment:
+        with tracer.stage('segment'):
+            segment_results(results, args.segment, args.threshold)
+    report(results, exportSeconds, args.report, unmatched)
+    if args.trace:
+        tracer.report()
+        print(f'Trace written to {tracer.write(args.trace)}')
+
+    return 0 if all(result.success for result in results) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,524 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import SimpleITK as sitk
+
+from LungNoduleROILib import manifest
+from LungNoduleROILib.instrument import peak_rss_mb
+from LungNoduleROILib.roi import ImageROI
+
+BENCHMARK_VERSION = 1
+BENCHMARKS = ('roi', 'manifest', 'decode', 'loader', 'unet', 'unet_configs')
+
+# sample volumes shipped with the repo, relative to the repository root
+SAMPLE_VOLUMES = os.path.join('argon_export_images', '**', '*.nii.gz')
+
+# sizes per benchmark, quick keeps a full run to about a minute on a laptop
+SIZES = {
+    'full': {
+        'volumes': [(64, 256, 256), (128, 512, 512), (256, 512, 512)],
+        'rois': [20, 40, 64],
+        'manifest_cases': [1000, 10000, 50000],
+        'loader_cases': 256,
+        'loader_workers': [0, 2, 4],
+        'loader_batches': [8, 32],
+        'unet_batches': [1, 2, 4, 8],
+        'unet_features': [64, 128, 256, 512],
+        'unet_roi': 40,
+        'unet_configs': [
+            {'depth': 4, 'base_width': 32, 'norm': 'batch', 'checkpointing': False, 'roi': 64, 'batch_size': 4},
+            {'depth': 4, 'base_width': 32, 'norm': 'batch', 'checkpointing': True, 'roi': 64, 'batch_size': 4},
+            {'depth': 4, 'base_width': 32, 'norm': 'instance', 'checkpointing': True, 'roi': 64, 'batch_size': 4},
+            {'depth': 4, 'base_width': 32, 'norm': 'batch', 'checkpointing': False, 'roi': 96, 'batch_size': 2},
+            {'depth': 4, 'base_width': 32, 'norm': 'batch', 'checkpointing': True, 'roi': 96, 'batch_size': 2},
+            {'depth': 5, 'base_width': 16, 'norm': 'group', 'checkpointing': True, 'roi': 96, 'batch_size': 4},
+        ],
+    },
+    'quick': {
+        'volumes': [(64, 128, 128), (128, 256, 256)],
+        'rois': [20, 40],
+        'manifest_cases': [1000, 10000],
+        'loader_cases': 64,
+        'loader_workers': [0, 2],
+        'loader_batches': [16],
+        'unet_batches': [1, 4],
+        'unet_features': [16, 32, 64, 128],
+        'unet_roi': 40,
+        'unet_configs': [
+            {'depth': 3, 'base_width': 16, 'norm': 'batch', 'checkpointing': False, 'roi': 48, 'batch_size': 2},
+            {'depth': 3, 'base_width': 16, 'norm': 'batch', 'checkpointing': True, 'roi': 48, 'batch_size': 2},
+            {'depth': 4, 'base_width': 8, 'norm': 'batch', 'checkpointing': False, 'roi': 64, 'batch_size': 2},
+            {'depth': 4, 'base_width': 8, 'norm': 'batch', 'checkpointing': True, 'roi': 64, 'batch_size': 2},
+            {'depth': 4, 'base_width': 8, 'norm': 'instance', 'checkpointing': True, 'roi': 64, 'batch_size': 2},
+        ],
+    },
+}
+
+
+# wall time of repeated calls, the first warmup calls are not counted
+def measure(fn, repeats=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'mean_s': statistics.fmean(times),
+            'repeats': repeats}
+
+
+# growth of the peak rss since baseline, None where the peak rss cannot be read
+def rss_increase_mb(baseline):
+    peak = peak_rss_mb()
+    return None if peak is None or baseline is None else peak - baseline
+
+
+# synthetic chest CT in HU, air outside a body ellipse and a few soft tissue nodules inside
+def synthetic_ct(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    body = ((y - shape[1] / 2) / (shape[1] * 0.45)) ** 2 + ((x - shape[2] / 2) / (shape[2] * 0.45)) ** 2 <= 1
+
+    ct = np.where(np.broadcast_to(body, shape), -800, -1000).astype(np.int16)
+    for _ in range(5):
+        center = [rng.integers(s // 4, 3 * s // 4) for s in shape]
+        radius = rng.integers(3, 10)
+        nodule = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 <= radius ** 2
+        ct[nodule] = 40
+    ct += rng.normal(0, 20, shape).astype(np.int16)
+
+    img = sitk.GetImageFromArray(ct)
+    img.SetSpacing((0.7, 0.7, 1.25))
+    return img
+
+
+def write_volume(img, path, useCompression=True):
+    sitk.WriteImage(img, path, useCompression=useCompression)
+    return path
+
+
+# every roi extraction path across volume and roi sizes
+def bench_roi(workDir, sizes, repeats):
+    imageROI = ImageROI()
+    results = []
+
+    for shape in sizes['volumes']:
+        img = synthetic_ct(shape)
+        array = sitk.GetArrayFromImage(img)
+        path = write_volume(img, os.path.join(workDir, 'roi_volume.nrrd'), useCompression=False)
+        centroid = [s // 2 for s in img.GetSize()]
+
+        for roi in sizes['rois']:
+            expansion = [roi] * 3
+            case = {'volume': list(shape), 'roi': roi}
+            results.append({'benchmark': 'roi', 'name': 'create_roi_image', 'case': case,
+                            **measure(lambda: imageROI.create_roi_image(img, expansion, centroid), repeats)})
+            results.append({'benchmark': 'roi', 'name': 'create_roi_image_from_array', 'case': case,
+                            **measure(lambda: imageROI.create_roi_image_from_array(array, expansion, centroid),
+                                      repeats)})
+            results.append({'benchmark': 'roi', 'name': 'create_roi_image_from_file', 'case': case,
+                            **measure(lambda: imageROI.create_roi_image_from_file(path, expansion, centroid),
+                                      repeats)})
+
+    return results
+
+
+# globbing and pairing of volume directories and centroid csvs with many cases
+def bench_manifest(workDir, sizes, repeats):
+    results = []
+
+    for cases in sizes['manifest_cases']:
+        caseDir = os.path.join(workDir, f'manifest_{cases}')
+        volumeDir = os.path.join(caseDir, 'volumes')
+        os.makedirs(volumeDir, exist_ok=True)
+        for pid in range(cases):
+            open(os.path.join(volumeDir, f'{pid}_CT.nrrd'), 'w').close()
+
+        csvPath = os.path.join(caseDir, 'centroids.csv')
+        with open(csvPath, 'w') as file_obj:
+            for pid in range(cases):
+                # every tenth case has a second nodule
+                for _ in range(2 if pid % 10 == 0 else 1):
+                    file_obj.write(f'{pid},100,100,50,40\n')
+
+        case = {'cases': cases}
+        results.append({'benchmark': 'manifest', 'name': 'index_files', 'case': case,
+                        **measure(lambda: manifest.index_files(volumeDir, '*'), repeats)})
+        results.append({'benchmark': 'manifest', 'name': 'index_csv', 'case': case,
+                        **measure(lambda: manifest.index_csv(csvPath), repeats)})
+        results.append({'benchmark': 'manifest', 'name': 'build_case_manifest', 'case': case,
+                        **measure(lambda: manifest.build_case_manifest(volumeDir, csvPath), repeats)})
+
+    return results
+
+
+# full volume decode of synthetic CTs in every format we read, and of the sample volumes in the repo
+def bench_decode(workDir, sizes, repeats, sampleDir):
+    results = []
+
+    for shape in sizes['volumes']:
+        img = synthetic_ct(shape)
+        for name, compression in (('ct.nrrd', False), ('ct_gz.nrrd', True), ('ct.nii.gz', True)):
+            path = write_volume(img, os.path.join(workDir, name), compression)
+            timing = measure(lambda: sitk.ReadImage(path), repeats)
+            results.append({'benchmark': 'decode', 'name': name, 'case': {'volume': list(shape)}, **timing,
+                            'megavoxels_per_s': np.prod(shape) / 1e6 / timing['median_s']})
+
+    samples = sorted(glob.glob(os.path.join(sampleDir, SAMPLE_VOLUMES), recursive=True)) if sampleDir else []
+    for path in samples:
+        size = sitk.ReadImage(path).GetSize()
+        timing = measure(lambda: sitk.ReadImage(path), repeats)
+        results.append({'benchmark': 'decode', 'name': 'sample', 'case': {'file': os.path.basename(path),
+                                                                         'volume': list(size[::-1])},
+                        **timing, 'megavoxels_per_s': np.prod(size) / 1e6 / timing['median_s']})
+
+    return results
+
+
+# samples per second of the roi cache and of decoding roi files in loader workers
+def bench_loader(workDir, sizes, repeats):
+    from LungNoduleROILib.cache import ROICacheDataset, build_roi_cache
+    from LungNoduleROILib.data import ROIFileDataset, make_loader
+
+    roiDir = os.path.join(workDir, 'loader')
+    os.makedirs(roiDir, exist_ok=True)
+    pairs = {}
+    for pid in range(sizes['loader_cases']):
+        img = synthetic_ct((40, 40, 40), seed=pid)
+        label = sitk.BinaryThreshold(img, -100, 3000)
+        pairs[str(pid)] = (write_volume(img, os.path.join(roiDir, f'{pid}_scan.nrrd')),
+                           write_volume(label, os.path.join(roiDir, f'{pid}_label.nrrd')))
+
+    build_roi_cache(pairs, os.path.join(roiDir, 'cache'))
+    datasets = {'roi_cache': ROICacheDataset(os.path.join(roiDir, 'cache')),
+                'roi_files': ROIFileDataset(pairs)}
+
+    results = []
+    for name, dataset in datasets.items():
+        for workers in sizes['loader_workers']:
+            for batch_size in sizes['loader_batches']:
+                loader = make_loader(dataset, batch_size, shuffle=True, device='cpu', num_workers=workers)
+
+                def epoch():
+                    for _ in loader:
+                        pass
+
+                timing = measure(epoch, repeats)
+                results.append({'benchmark': 'loader', 'name': name,
+                                'case': {'workers': workers, 'batch_size': batch_size, 'cases': len(dataset)},
+                                **timing, 'samples_per_s': len(dataset) / timing['median_s']})
+
+    return results
+
+
+# forward / backward / optimizer step of the UNet, runs in a fresh process so the peak memory is its own
+def unet_step(batch_size, features, roi, repeats, threads):
+    import torch
+    import torch.optim as optim
+
+    from LungNoduleROILib.losses import DiceLoss
+    from LungNoduleROILib.unet import UNet
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    baseline = peak_rss_mb()
+
+    model = UNet(features=list(features))
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    loss_function = DiceLoss()
+    scans = torch.randn(batch_size, 1, roi, roi, roi)
+    segs = (torch.rand(batch_size, 1, roi, roi, roi) > 0.9).float()
+
+    def forward():
+        with torch.no_grad():
+            model(scans)
+
+    def step():
+        optimizer.zero_grad()
+        loss = loss_function(model(scans), segs)
+        loss.backward()
+        optimizer.step()
+
+    model.train()
+    step_timing = measure(step, repeats)
+    forward_timing = measure(forward, repeats)
+
+    return {'median_s': step_timing['median_s'], 'min_s': step_timing['min_s'], 'mean_s': step_timing['mean_s'],
+            'repeats': repeats, 'forward_median_s': forward_timing['median_s'],
+            'samples_per_s': batch_size / step_timing['median_s'],
+            'peak_rss_mb': peak_rss_mb(), 'peak_rss_increase_mb': rss_increase_mb(baseline)}
+
+
+def bench_unet(workDir, sizes, repeats, threads):
+    results = []
+
+    # spawn so no memory of earlier benchmarks is inherited by the measured process
+    context = multiprocessing.get_context('spawn')
+    for batch_size in sizes['unet_batches']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            timing = executor.submit(unet_step, batch_size, sizes['unet_features'], sizes['unet_roi'], repeats,
+                                     threads).result()
+        results.append({'benchmark': 'unet', 'name': 'train_step',
+                        'case': {'batch_size': batch_size, 'features': sizes['unet_features'],
+                                 'roi': sizes['unet_roi'], 'threads': threads}, **timing})
+
+    return results
+
+
+# multiply-adds of the convolutions of one forward pass, counted twice as flops
+def unet_flops(model, scans):
+    import torch
+    import torch.nn as nn
+
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.weight[0, 0].numel()
+        if isinstance(module, nn.ConvTranspose3d):
+            # every input voxel is spread over a kernel of every output channel
+            flops.append(2 * inputs[0].numel() * module.out_channels * kernel // module.groups)
+        else:
+            flops.append(2 * output.numel() * module.in_channels // module.groups * kernel)
+
+    handles = [module.register_forward_hook(conv_hook) for module in model.modules()
+               if isinstance(module, (nn.Conv3d, nn.ConvTranspose3d))]
+    try:
+        with torch.no_grad():
+            model(scans)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return sum(flops)
+
+
+# MB of the tensors autograd keeps from the forward pass for the backward pass, the memory checkpointing saves
+# parameters are not counted and tensors saved more than once are counted once
+def activation_mb(model, scans, segs, loss_function):
+    import torch
+
+    parameters = {parameter.data_ptr() for parameter in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in parameters:
+            saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = loss_function(model(scans), segs)
+    loss.backward()
+    model.zero_grad()
+
+    return sum(saved.values()) / 1024 ** 2
+
+
+# parameters, flops, activation memory, step time and peak memory of one UNet configuration,
+# runs in a fresh process so the peak memory is its own
+# config -> UNet arguments (depth, base_width, norm, checkpointing) with the roi size and the batch_size
+def unet_config_step(config, repeats, threads):
+    import torch
+    import torch.optim as optim
+
+    from LungNoduleROILib.losses import DiceLoss
+    from LungNoduleROILib.unet import UNet
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    baseline = peak_rss_mb()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    model = UNet(depth=config['depth'], base_width=config['base_width'], norm=config['norm'],
+                 checkpointing=config['checkpointing']).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    loss_function = DiceLoss()
+    shape = (config['batch_size'], 1) + (config['roi'],) * 3
+    scans = torch.randn(shape, device=device)
+    segs = (torch.rand(shape, device=device) > 0.9).float()
+
+    def step():
+        optimizer.zero_grad()
+        loss = loss_function(model(scans), segs)
+        loss.backward()
+        optimizer.step()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    model.eval()
+    flops = unet_flops(model, scans)
+    model.train()
+    activations = activation_mb(model, scans, segs, loss_function)
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    timing = measure(step, repeats)
+
+    result = {**timing, 'samples_per_s': config['batch_size'] / timing['median_s'],
+              'parameters': sum(parameter.numel() for parameter in model.parameters()),
+              'gflops_per_sample': flops / config['batch_size'] / 1e9, 'activation_mb': activations,
+              'peak_rss_mb': peak_rss_mb(), 'peak_rss_increase_mb': rss_increase_mb(baseline), 'device': device}
+    if device == 'cuda':
+        result['cuda_peak_allocated_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+
+    return result
+
+
+# one train step per UNet configuration of SIZES, to pick the depth / width / checkpointing that fits a roi size
+def bench_unet_configs(workDir, sizes, repeats, threads):
+    results = []
+
+    context = multiprocessing.get_context('spawn')
+    for config in sizes['unet_configs']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            timing = executor.submit(unet_config_step, config, repeats, threads).result()
+        results.append({'benchmark': 'unet_configs', 'name': 'train_step', 'case': {**config, 'threads': threads},
+                        **timing})
+
+    return results
+
+
+# machine and code the numbers were taken on
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    meta = {'version': BENCHMARK_VERSION, 'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'simpleitk': sitk.Version.VersionString(), 'numpy': np.__version__}
+    try:
+        import torch
+        meta['torch'] = torch.__version__
+    except ImportError:
+        pass
+
+    return meta
+
+
+# run the selected benchmarks and return {'meta', 'results'}
+# inputs:
+# benchmarks -> names from BENCHMARKS
+# size -> 'quick' or 'full', see SIZES
+# repeats -> timed repetitions per case
+# sampleDir -> repository root holding argon_export_images, None to skip the sample volumes
+# threads -> torch threads of the unet benchmark
+def run_benchmarks(benchmarks=BENCHMARKS, size='quick', repeats=5, sampleDir=None, threads=None):
+    sizes = SIZES[size]
+    threads = threads or os.cpu_count() or 1
+    workDir = tempfile.mkdtemp(prefix='lungnoduleroi_bench_')
+    results = []
+
+    try:
+        for name in benchmarks:
+            start = time.perf_counter()
+            if name == 'roi':
+                results += bench_roi(workDir, sizes, repeats)
+            elif name == 'manifest':
+                results += bench_manifest(workDir, sizes, repeats)
+            elif name == 'decode':
+                results += bench_decode(workDir, sizes, repeats, sampleDir)
+            elif name == 'loader':
+                results += bench_loader(workDir, sizes, repeats)
+            elif name == 'unet':
+                results += bench_unet(workDir, sizes, repeats, threads)
+            elif name == 'unet_configs':
+                results += bench_unet_configs(workDir, sizes, repeats, threads)
+            else:
+                raise ValueError(f'Unknown benchmark {name}, use one of {BENCHMARKS}')
+            print(f'{name}: {time.perf_counter() - start:.1f}s')
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return {'meta': {**environment(), 'size': size}, 'results': results}
+
+
+def result_key(result):
+    return result['benchmark'], result['name'], json.dumps(result['case'], sort_keys=True)
+
+
+# compare two result files by median time, returns rows (benchmark, name, case, baseline, current, ratio)
+# ratio > 1 means the current run is slower
+def compare(baseline, current):
+    baselineResults = {result_key(result): result for result in baseline['results']}
+
+    rows = []
+    for result in current['results']:
+        old = baselineResults.get(result_key(result))
+        if old is not None:
+            rows.append((result['benchmark'], result['name'], result['case'], old['median_s'], result['median_s'],
+                         result['median_s'] / old['median_s']))
+
+    return rows
+
+
+def print_results(results):
+    for result in results:
+        case = ', '.join(f'{key}={value}' for key, value in result['case'].items())
+        print(f'{result["benchmark"]:>8} {result["name"]:<28} {result["median_s"] * 1000:10.2f} ms  {case}')
+        if 'parameters' in result:
+            print(f'{"":>8} {"":<28} {result["parameters"] / 1e6:.2f} M parameters, '
+                  f'{result["gflops_per_sample"]:.1f} GFLOP / sample, {result["activation_mb"]:.0f} MB activations, '
+                  f'{result["peak_rss_increase_mb"] or 0:.0f} MB peak rss increase')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless CPU benchmarks of the ROI, data loading and UNet paths.')
+    parser.add_argument('output', help='json file the results are written to')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--size', choices=sorted(SIZES), default='quick')
+    parser.add_argument('--repeats', type=int, default=5, help='timed repetitions per case')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads of the unet benchmark')
+    parser.add_argument('--samples', default=None,
+                        help='repository root with argon_export_images (default: found from this file)')
+    parser.add_argument('--compare', default=None, metavar='BASELINE',
+                        help='earlier result file, cases slower by more than --tolerance fail the run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    sampleDir = args.samples
+    if sampleDir is None:
+        # LungNoduleROILib -> LungNoduleROI -> LungNoduleROI -> slicer_modules -> repository root
+        sampleDir = os.path.abspath(os.path.join(os.path.dirname(__file__), *[os.pardir] * 4))
+
+    report = run_benchmarks(args.benchmarks, args.size, args.repeats, sampleDir, args.threads)
+    print_results(report['results'])
+
+    with open(args.output, 'w') as file_obj:
+        json.dump(report, file_obj, indent=1, default=float)
+    print(f'{len(report["results"])} results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as file_obj:
+            baseline = json.load(file_obj)
+
+        regressions = 0
+        for benchmark, name, case, old, new, ratio in compare(baseline, report):
+            flag = ''
+            if ratio > 1 + args.tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print(f'{benchmark:>8} {name:<28} {old * 1000:10.2f} -> {new * 1000:10.2f} ms  x{ratio:.2f}  {case}{flag}')
+        print(f'{regressions} regressions against {args.compare} (commit {baseline["meta"].get("commit")})')
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
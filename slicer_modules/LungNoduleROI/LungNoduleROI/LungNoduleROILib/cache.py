@@ -0,0 +1,222 @@
+import json
+import os
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from torch.utils.data import Dataset
+
+from LungNoduleROILib.augment import fit_window
+from LungNoduleROILib.data import header_shape
+from LungNoduleROILib.intensity import IntensityStats
+from LungNoduleROILib.manifest import fingerprint
+
+CACHE_VERSION = 1
+INDEX_FILE = 'index.json'
+SCANS_FILE = 'scans.npy'
+LABELS_FILE = 'labels.npy'
+
+
+def unchanged(old, new):
+    return all(old[key] == new[key] for key in ('scan', 'label', 'scan_fingerprint', 'label_fingerprint'))
+
+
+# center crop / pad a (D, H, W) array to size, used to keep rois of other sizes in the store
+def fit_array(array, size, pad_value):
+    padding, starts = fit_window(array.shape, size)
+    array = np.pad(array, padding, constant_values=pad_value)
+    return array[starts[0]:starts[0] + size[0], starts[1]:starts[1] + size[1], starts[2]:starts[2] + size[2]]
+
+
+def load_index(cacheDir):
+    path = os.path.join(cacheDir, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file_obj:
+        return json.load(file_obj)
+
+
+# build or refresh the memory-mapped roi store
+# scans are stored as float32 in HU and labels binarized (255 -> 1) as uint8, one row per case
+# rows whose scan and label fingerprints are unchanged are copied from the previous store, only new or
+# modified cases are decoded again
+# intensity statistics of the stored scans (min / max, mean / std, percentiles) are gathered row by row while
+# writing and saved in the index, see intensity.IntensityStats
+# inputs:
+# pairs -> {pid: (scan path, label path)}, e.g. manifest.build_label_manifest(...).matched
+# cacheDir -> directory holding scans.npy, labels.npy and index.json
+# desiredSize -> (D, H, W) shape every roi must have, other cases are skipped
+# useHash -> also compare content hashes, slower but robust to copies that reset mtimes
+# fit -> center crop / pad rois of other sizes to desiredSize (scans with -1000 HU, labels with 0) instead of skipping
+def build_roi_cache(pairs, cacheDir, desiredSize=(40, 40, 40), useHash=False, fit=False):
+    os.makedirs(cacheDir, exist_ok=True)
+    desiredSize = tuple(desiredSize)
+
+    oldIndex = load_index(cacheDir)
+    if oldIndex is not None and (oldIndex['version'] != CACHE_VERSION or tuple(oldIndex['shape']) != desiredSize
+                                 or oldIndex.get('fit', False) != fit):
+        oldIndex = None
+
+    oldRows = {}
+    oldSkipped = {}
+    if oldIndex is not None:
+        oldScans = np.load(os.path.join(cacheDir, SCANS_FILE), mmap_mode='r')
+        oldLabels = np.load(os.path.join(cacheDir, LABELS_FILE), mmap_mode='r')
+        for row, entry in enumerate(oldIndex['entries']):
+            oldRows[entry['pid']] = (row, entry)
+        for entry in oldIndex['skipped']:
+            oldSkipped[entry['pid']] = entry
+
+    # decide per case whether the cached row can be reused
+    entries = []
+    skipped = []
+    reused = 0
+    for pid in sorted(pairs):
+        scanPath, labelPath = pairs[pid]
+        entry = {'pid': pid, 'scan': scanPath, 'label': labelPath,
+                 'scan_fingerprint': fingerprint(scanPath, useHash),
+                 'label_fingerprint': fingerprint(labelPath, useHash)}
+
+        old = oldRows.get(pid)
+        if old is not None and unchanged(old[1], entry):
+            entry['source_row'] = old[0]
+            if 'original_shape' in old[1]:
+                entry['original_shape'] = old[1]['original_shape']
+            reused += 1
+        elif pid in oldSkipped and unchanged(oldSkipped[pid], entry):
+            skipped.append(entry)
+            continue
+        entries.append(entry)
+
+    # caches written before the intensity statistics existed are rewritten once, their rows are reused
+    if (oldIndex is not None and reused == len(entries) == len(oldIndex['entries'])
+            and len(skipped) == len(oldIndex['skipped']) and 'intensity' in oldIndex):
+        print(f'ROI cache up to date: {len(entries)} cases')
+        return oldIndex
+
+    # decide from the headers which changed cases fit, so the store can be sized before anything is decoded
+    for entry in entries:
+        if 'source_row' in entry:
+            continue
+
+        scanShape = header_shape(entry['scan'])
+        segShape = header_shape(entry['label'])
+        if fit and scanShape == segShape and scanShape != desiredSize:
+            entry['original_shape'] = list(scanShape)
+        elif scanShape != desiredSize or segShape != desiredSize:
+            print(f'Skipping {entry["pid"]}: scan {scanShape}, label {segShape}')
+            skipped.append(entry)
+            entry['skip'] = True
+
+    entries = [entry for entry in entries if not entry.pop('skip', False)]
+
+    # write the new store next to the old one and swap it in once complete
+    # every changed case is decoded straight into its row, only one case is in memory at a time
+    tmpScans = os.path.join(cacheDir, SCANS_FILE + '.tmp')
+    tmpLabels = os.path.join(cacheDir, LABELS_FILE + '.tmp')
+    scans = np.lib.format.open_memmap(tmpScans, mode='w+', dtype=np.float32, shape=(len(entries),) + desiredSize)
+    labels = np.lib.format.open_memmap(tmpLabels, mode='w+', dtype=np.uint8, shape=(len(entries),) + desiredSize)
+
+    stats = IntensityStats()
+    for row, entry in enumerate(entries):
+        sourceRow = entry.pop('source_row', None)
+        if sourceRow is not None:
+            scans[row] = oldScans[sourceRow]
+            labels[row] = oldLabels[sourceRow]
+        else:
+            scan = sitk.GetArrayFromImage(sitk.ReadImage(entry['scan']))
+            seg = sitk.GetArrayFromImage(sitk.ReadImage(entry['label']))
+            if 'original_shape' in entry:
+                scan, seg = fit_array(scan, desiredSize, -1000), fit_array(seg, desiredSize, 0)
+            scans[row] = scan
+            # labels come as 0/255 from slicer exports or 0/1
+            labels[row] = seg > 0
+        stats.update(scans[row])
+    # dataset wide intensity range used by min-max normalization
+    minimum = stats.running.min if len(entries) else 0.0
+    maximum = stats.running.max if len(entries) else 0.0
+
+    scans.flush()
+    labels.flush()
+    del scans, labels
+    if oldIndex is not None:
+        del oldScans, oldLabels
+
+    os.replace(tmpScans, os.path.join(cacheDir, SCANS_FILE))
+    os.replace(tmpLabels, os.path.join(cacheDir, LABELS_FILE))
+
+    index = {'version': CACHE_VERSION, 'shape': list(desiredSize), 'fit': fit, 'min': minimum, 'max': maximum,
+             'intensity': stats.to_dict(), 'entries': entries, 'skipped': skipped}
+    with open(os.path.join(cacheDir, INDEX_FILE), 'w') as file_obj:
+        json.dump(index, file_obj, indent=1)
+
+    print(f'ROI cache built: {len(entries)} cases, {reused} reused, {len(entries) - reused} decoded')
+    return index
+
+
+# dataset reading samples straight from the memory-mapped store, nothing is loaded up front
+# only the cache directory is pickled, each DataLoader worker maps the files itself on first access, so spawned
+# workers (macOS, Windows) never receive a copy of the arrays
+# inputs:
+# cacheDir -> directory written by build_roi_cache
+# indices -> optional subset of rows, e.g. a train/val/test split
+# normalize -> True for min-max normalization with the dataset wide range saved in the index, or a callable applied
+#              to the float32 scan, e.g. intensity.HUWindow()
+# transform -> optional callable(scan, label) on the CPU tensors, e.g. augment.FitToSize
+class ROICacheDataset(Dataset):
+    def __init__(self, cacheDir, indices=None, normalize=True, transform=None):
+        self.index = load_index(cacheDir)
+        if self.index is None:
+            raise FileNotFoundError(f'No ROI cache in {cacheDir}, run build_roi_cache first')
+
+        self.cacheDir = cacheDir
+        self.indices = list(range(len(self.index['entries']))) if indices is None else list(indices)
+        self.normalize = normalize
+        self.transform = transform
+        self.scans = None
+        self.labels = None
+        self.mapPid = None
+
+    # memmaps are not shared across processes, each DataLoader worker maps the files again on first access
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['scans'] = None
+        state['labels'] = None
+        return state
+
+    @property
+    def pids(self):
+        return [self.index['entries'][row]['pid'] for row in self.indices]
+
+    # statistics of every cached scan, not just of this subset
+    @property
+    def intensity_stats(self):
+        return IntensityStats.from_dict(self.index['intensity']) if 'intensity' in self.index else None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        if self.scans is None or self.mapPid != os.getpid():
+            self.scans = np.load(os.path.join(self.cacheDir, SCANS_FILE), mmap_mode='r')
+            self.labels = np.load(os.path.join(self.cacheDir, LABELS_FILE), mmap_mode='r')
+            self.mapPid = os.getpid()
+
+        row = self.indices[idx]
+        scan = self.scans[row]
+
+        if callable(self.normalize):
+            scan = self.normalize(np.array(scan))
+        elif self.normalize:
+            scan = (scan - self.index['min']) / max(self.index['max'] - self.index['min'], 1e-6)
+        else:
+            scan = np.array(scan)
+
+        label = self.labels[row].astype(np.float32)
+        scan, label = torch.from_numpy(scan).unsqueeze(0), torch.from_numpy(label).unsqueeze(0)
+
+        if self.transform is not None:
+            scan, label = self.transform(scan, label)
+
+        return scan, label
@@ -0,0 +1,81 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+from LungNoduleROILib.unet import UNet, save_config
+
+LATEST = 'latest.pt'
+BEST = 'best.pt'
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# write to a temporary file first so a crash while saving never corrupts the previous checkpoint
+def atomic_save(obj, path):
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+# everything needed to continue training exactly where it stopped
+def save_checkpoint(checkpoint_dir, epoch, model, optimizer, scaler, history):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    atomic_save({
+        'epoch': epoch,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scaler': scaler.state_dict(),
+        'rng': rng_state(),
+        'history': history,
+    }, os.path.join(checkpoint_dir, LATEST))
+
+
+# restore the latest checkpoint into model, optimizer and scaler, returns None when there is nothing to resume
+# device -> device the model trains on, the weights and optimizer state are read straight onto it
+def load_checkpoint(checkpoint_dir, model, optimizer, scaler, device='cpu'):
+    path = os.path.join(checkpoint_dir, LATEST)
+    if not os.path.exists(path):
+        return None
+
+    # our own file, it also holds the numpy / python rng states
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    # the torch / cuda rng states are mapped along with everything else but have to stay cpu ByteTensors
+    rng = checkpoint['rng']
+    rng['torch'] = rng['torch'].cpu()
+    if 'cuda' in rng:
+        rng['cuda'] = [state.cpu() for state in rng['cuda']]
+
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    scaler.load_state_dict(checkpoint['scaler'])
+    set_rng_state(rng)
+
+    return checkpoint
+
+
+# weights of the epoch with the lowest validation loss, loadable with model.load_state_dict
+# the architecture of a UNet is saved next to them, so inference.load_model can build it again
+def save_best(checkpoint_dir, model):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    atomic_save(model.state_dict(), os.path.join(checkpoint_dir, BEST))
+    if isinstance(model, UNet):
+        save_config(model, os.path.join(checkpoint_dir, BEST))
+
+
+def best_path(checkpoint_dir):
+    return os.path.join(checkpoint_dir, BEST)
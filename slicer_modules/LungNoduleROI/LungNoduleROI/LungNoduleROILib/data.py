@@ -0,0 +1,98 @@
+import numpy as np
+import SimpleITK as sitk
+import torch
+from torch.utils.data import DataLoader, Dataset, get_worker_info
+
+
+# pick the fastest device available on this machine
+def default_device():
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    if torch.backends.mps.is_available():
+        return torch.device('mps')
+    return torch.device('cpu')
+
+
+# image size (D, H, W) read from the file header only
+def header_shape(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return tuple(reader.GetSize()[::-1])
+
+
+# dataset decoding scan / label pairs from disk on demand, inside the DataLoader workers
+# inputs:
+# pairs -> {pid: (scan path, label path)} or a list of (pid, scan path, label path)
+# desired_size -> optional (D, H, W), pairs of another size are dropped using their headers only
+# normalize -> optional callable applied to the float32 scan array
+# transform -> optional callable(scan, label) on the CPU tensors, e.g. augmentation
+class ROIFileDataset(Dataset):
+    def __init__(self, pairs, desired_size=None, normalize=None, transform=None):
+        if isinstance(pairs, dict):
+            pairs = [(pid, scan, label) for pid, (scan, label) in sorted(pairs.items())]
+
+        if desired_size is not None:
+            desired_size = tuple(desired_size)
+            pairs = [pair for pair in pairs
+                     if header_shape(pair[1]) == desired_size and header_shape(pair[2]) == desired_size]
+
+        self.pairs = list(pairs)
+        self.normalize = normalize
+        self.transform = transform
+
+    @property
+    def pids(self):
+        return [pair[0] for pair in self.pairs]
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, idx):
+        pid, scan_path, label_path = self.pairs[idx]
+
+        scan = sitk.GetArrayFromImage(sitk.ReadImage(scan_path)).astype(np.float32)
+        # labels come as 0/255 from slicer exports or 0/1
+        label = (sitk.GetArrayFromImage(sitk.ReadImage(label_path)) > 0).astype(np.float32)
+
+        if self.normalize is not None:
+            scan = self.normalize(scan)
+
+        scan = torch.from_numpy(scan).unsqueeze(0)
+        label = torch.from_numpy(label).unsqueeze(0)
+
+        if self.transform is not None:
+            scan, label = self.transform(scan, label)
+
+        return scan, label
+
+
+# each worker decodes one case at a time, keep sitk from starting a thread per core in every worker
+# and give every worker its own numpy seed for augmentation
+def worker_init(worker_id):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    info = get_worker_info()
+    np.random.seed(info.seed % 2**32)
+
+
+# DataLoader set up for decoding in worker processes
+# batches are pinned when training on cuda so to_device can copy them asynchronously
+# inputs:
+# dataset -> any dataset returning (scan, label) CPU tensors
+# device -> device the model trains on
+# num_workers -> decoding processes, 0 decodes in the main process (useful for debugging)
+# prefetch -> batches each worker prepares ahead
+# collate_fn -> optional batch collation, e.g. augment.AugmentCollate to augment whole batches inside the workers
+def make_loader(dataset, batch_size, shuffle, device, num_workers=4, prefetch=2, drop_last=False, collate_fn=None):
+    device = torch.device(device)
+    options = {}
+    if num_workers > 0:
+        options = {'worker_init_fn': worker_init, 'persistent_workers': True, 'prefetch_factor': prefetch}
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=device.type == 'cuda', drop_last=drop_last, collate_fn=collate_fn, **options)
+
+
+# move a (scan, label) batch to the training device, asynchronous from pinned memory
+def to_device(batch, device):
+    return [tensor.to(device, non_blocking=True) for tensor in batch]
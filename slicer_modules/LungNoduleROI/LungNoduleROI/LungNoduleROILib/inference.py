@@ -0,0 +1,352 @@
+import argparse
+import contextlib
+import copy
+import os
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from LungNoduleROILib.metrics import segmentation_metrics
+from LungNoduleROILib.unet import NORMS, DoubleConv, UNet, load_config
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+# input shape of a single training roi, (N, C, D, H, W)
+ROI_SHAPE = (1, 1, 40, 40, 40)
+
+
+# feature widths of a UNet state dict, read from the first convolution of every down block
+def state_dict_features(state_dict):
+    features = []
+    while f'downs.{len(features)}.conv.0.weight' in state_dict:
+        features.append(state_dict[f'downs.{len(features)}.conv.0.weight'].shape[0])
+    return features
+
+
+# normalization of a UNet state dict, batch norm keeps running statistics, instance and group norm only have weights
+# the two cannot be told apart, weights with neither running statistics nor a saved config need norm=
+def state_dict_norm(state_dict):
+    if 'downs.0.conv.1.running_mean' in state_dict:
+        return 'batch'
+    if 'downs.0.conv.1.weight' in state_dict:
+        raise ValueError("Instance and group norm weights look the same, pass norm='instance' or norm='group' "
+                         "or save the model with unet.save_config")
+    return 'none'
+
+
+# UNet weights saved with torch.save(model.state_dict(), ...), e.g. nov26_24.pth or a checkpoint best.pt
+# the architecture is taken from the config saved next to the weights (unet.save_config) or read from the weights
+# features -> feature widths of the UNet, read from the config or the weights when not given
+# norm -> normalization of the UNet, read from the config or the weights when not given
+# resize_skips -> accept rois whose size is not a multiple of the UNet's input_multiple, nov26_24.pth was trained on
+#                 40^3 rois at depth 4 and relies on it
+def load_model(weightsPath, features=None, norm=None, resize_skips=True):
+    state_dict = torch.load(weightsPath, map_location='cpu')
+    config = load_config(weightsPath) or {}
+    model = UNet(config.get('in_channels', 1), config.get('out_channels', 1),
+                 features=list(features or config.get('features') or state_dict_features(state_dict)),
+                 norm=norm or config.get('norm') or state_dict_norm(state_dict), resize_skips=resize_skips)
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+
+# copy of an eval mode UNet with every conv / batchnorm / relu of its DoubleConvs folded into one conv
+# instance and group norm depend on the input and are left unfused
+def fuse_unet(model):
+    from torch.ao.quantization import fuse_modules
+
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        if isinstance(module, DoubleConv) and module.norm == 'batch':
+            fuse_modules(module.conv, [['0', '1', '2'], ['3', '4', '5']], inplace=True)
+
+    return model
+
+
+# UNet forward pass with quant / dequant stubs and a quantizable concatenation, for int8 post training quantization
+# reuses the layers of the (fused) UNet it wraps
+class QuantizableUNet(nn.Module):
+    def __init__(self, unet):
+        super(QuantizableUNet, self).__init__()
+        self.unet = unet
+        self.quant = torch.ao.quantization.QuantStub()
+        self.dequant = torch.ao.quantization.DeQuantStub()
+        self.skip_cat = torch.ao.nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        unet = self.unet
+        unet.check_input(x)
+        x = self.quant(x)
+        skip_connections = []
+
+        for down in unet.downs:
+            x = down(x)
+            skip_connections.append(x)
+            x = unet.pool(x)
+
+        x = unet.bottleneck(x)
+        skip_connections = skip_connections[::-1]
+
+        for idx in range(0, len(unet.ups), 2):
+            x = unet.ups[idx](x)
+            skip_connection = skip_connections[idx // 2]
+
+            if x.shape != skip_connection.shape:
+                x = F.interpolate(x, size=skip_connection.shape[2:])
+
+            x = self.skip_cat.cat([skip_connection, x], dim=1)
+            x = unet.ups[idx + 1](x)
+
+        return self.dequant(unet.final_conv(x))
+
+
+# static int8 post training quantization, activation ranges are calibrated on representative rois
+# dynamic quantization only covers linear / recurrent layers, the UNet is all convolutions
+# inputs:
+# model -> eval mode fp32 UNet
+# calibration -> (N, 1, D, H, W) tensor of normalized rois, a few dozen are enough
+def quantize_int8(model, calibration, micro_batch=8):
+    from torch.ao.quantization import convert, default_qconfig, get_default_qconfig, prepare
+
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+    quantized = QuantizableUNet(fuse_unet(model)).eval()
+    quantized.qconfig = get_default_qconfig(torch.backends.quantized.engine)
+
+    # per channel weights are not supported for transposed convolutions
+    for module in quantized.modules():
+        if isinstance(module, nn.ConvTranspose3d):
+            module.qconfig = default_qconfig
+
+    # the eager quantization api warns that it is deprecated in favour of torchao
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        prepare(quantized, inplace=True)
+        with torch.inference_mode():
+            for start in range(0, len(calibration), micro_batch):
+                quantized(calibration[start:start + micro_batch].float())
+        convert(quantized, inplace=True)
+
+    return quantized
+
+
+# trace and freeze a model into TorchScript, the result can be saved with torch.jit.save and loaded without the UNet source
+def export_torchscript(model, path=None, example_shape=ROI_SHAPE):
+    example = torch.zeros(example_shape)
+    with warnings.catch_warnings(), torch.inference_mode():
+        # the shape check before the skip concatenation is constant for a fixed roi size
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        scripted = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+
+    if path is not None:
+        torch.jit.save(scripted, path)
+
+    return scripted
+
+
+# onnx export of a model saved next to its weights, nov26_24.pth -> nov26_24.onnx
+def onnx_path_for(weightsPath):
+    return os.path.splitext(weightsPath)[0] + '.onnx'
+
+
+# export an fp32 model to ONNX with a dynamic batch axis, needs the onnx package
+def export_onnx(model, path, example_shape=ROI_SHAPE):
+    torch.onnx.export(model.eval(), torch.zeros(example_shape), path, input_names=['scan'], output_names=['logits'],
+                      dynamic_axes={'scan': {0: 'batch'}, 'logits': {0: 'batch'}})
+    return path
+
+
+# onnxruntime session behind the same call signature as a torch model
+class OnnxModel:
+    def __init__(self, path, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, scans):
+        logits = self.session.run(['logits'], {'scan': scans.float().numpy()})[0]
+        return torch.from_numpy(logits)
+
+
+# intra-op threads for the calls of a session only, the previous setting is restored afterwards so torch work
+# elsewhere in the process (slicer, a training loop in the same notebook) keeps its own
+@contextlib.contextmanager
+def num_threads(threads):
+    if threads is None:
+        yield
+        return
+
+    previous = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+# CPU segmentation of rois with an optimized copy of a trained UNet
+# inputs:
+# model -> trained fp32 UNet, left untouched
+# precision -> 'fp32', 'bf16' (autocast, needs a cpu with bf16 support to be faster) or 'int8' (static quantization)
+# backend -> 'eager', 'torchscript' (traced and frozen) or 'onnx' (onnxruntime, fp32 only)
+# threads -> intra-op threads of this session's calls, defaulted to torch's setting, see num_threads
+# micro_batch -> rois per forward pass, bounds peak memory for large inputs
+# calibration -> rois used to calibrate int8 activation ranges
+# example_shape -> roi shape the model is traced for
+# onnx_path -> where the onnx backend writes its export, e.g. onnx_path_for(weightsPath)
+# window -> intensity.HUWindow the model was trained with, applied by segmentation.segment_rois
+class InferenceSession:
+    def __init__(self, model, precision='fp32', backend='torchscript', threads=None, micro_batch=8,
+                 calibration=None, example_shape=ROI_SHAPE, onnx_path=None, window=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, use one of {PRECISIONS}')
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend}, use one of {BACKENDS}')
+        if backend == 'onnx' and precision != 'fp32':
+            raise ValueError('The onnx backend runs fp32 models only')
+        if precision == 'int8' and calibration is None:
+            raise ValueError('int8 needs calibration rois')
+        if backend == 'onnx' and onnx_path is None:
+            raise ValueError('The onnx backend needs onnx_path, e.g. onnx_path_for(weightsPath)')
+
+        self.threads = threads
+        self.precision = precision
+        self.backend = backend
+        self.micro_batch = micro_batch
+        self.example_shape = tuple(example_shape)
+        self.window = window
+        # rois are padded to a multiple of this before segmenting, see UNet.check_input
+        self.input_multiple = 1 if model.resize_skips else model.input_multiple
+
+        with num_threads(threads):
+            model = copy.deepcopy(model).cpu().eval()
+            if precision == 'int8':
+                model = quantize_int8(model, calibration, micro_batch)
+            else:
+                model = fuse_unet(model)
+
+            if backend == 'onnx':
+                self.model = OnnxModel(export_onnx(model, onnx_path, self.example_shape), threads)
+            elif backend == 'torchscript':
+                with self.autocast():
+                    self.model = export_torchscript(model, example_shape=self.example_shape)
+            else:
+                self.model = model
+
+    def autocast(self):
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.precision == 'bf16')
+
+    # fp32 logits for (N, 1, D, H, W) rois, run micro batch by micro batch
+    def logits(self, scans):
+        scans = torch.as_tensor(scans).float()
+        outputs = []
+        with num_threads(self.threads), torch.inference_mode(), self.autocast():
+            for start in range(0, len(scans), self.micro_batch):
+                outputs.append(self.model(scans[start:start + self.micro_batch]).float())
+
+        return torch.cat(outputs)
+
+    def predict(self, scans):
+        return torch.sigmoid(self.logits(scans))
+
+    def segment(self, scans, threshold=0.5):
+        return self.predict(scans) >= threshold
+
+    def save(self, path):
+        if self.backend != 'torchscript':
+            raise ValueError('Only torchscript sessions can be saved, export onnx models with export_onnx')
+        torch.jit.save(self.model, path)
+
+    # latency of single rois and throughput of full micro batches, in milliseconds per roi
+    def benchmark(self, repeats=20, warmup=3):
+        single = torch.zeros(self.example_shape)
+        batch = torch.zeros((self.micro_batch,) + self.example_shape[1:])
+
+        threads = self.threads if self.threads is not None else torch.get_num_threads()
+        results = {'precision': self.precision, 'backend': self.backend, 'threads': threads,
+                   'micro_batch': self.micro_batch}
+        for name, scans in (('latency_ms', single), ('batched_ms_per_roi', batch)):
+            for _ in range(warmup):
+                self.logits(scans)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                self.logits(scans)
+            results[name] = (time.perf_counter() - start) / repeats / len(scans) * 1000
+
+        return results
+
+
+# agreement of an optimized session with the fp32 model, the fp32 masks are treated as ground truth
+# returns the per roi metrics table and a summary with the mean / min dice and the largest probability difference
+def dice_parity(model, session, scans, threshold=0.5, min_dice=0.99):
+    scans = torch.as_tensor(scans).float()
+    with torch.inference_mode():
+        reference = torch.cat([torch.sigmoid(model.eval()(scans[start:start + session.micro_batch]))
+                               for start in range(0, len(scans), session.micro_batch)])
+    candidate = session.predict(scans)
+
+    table = segmentation_metrics(candidate, reference >= threshold, thresholds=[threshold], distances=False)
+    summary = {
+        'mean_dice': float(table['dice'].mean()),
+        'min_dice': float(table['dice'].min()),
+        'max_probability_difference': float((candidate - reference).abs().max()),
+    }
+    summary['passed'] = summary['min_dice'] >= min_dice
+
+    return table, summary
+
+
+def main(argv=None):
+    from LungNoduleROILib.cache import ROICacheDataset
+    from LungNoduleROILib.intensity import load_window
+
+    parser = argparse.ArgumentParser(description='Optimize a trained UNet for CPU inference and check it against fp32.')
+    parser.add_argument('weights', help='UNet state dict, e.g. nov26_24.pth')
+    parser.add_argument('cache', help='roi cache (build_roi_cache) used for calibration and the parity check')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32')
+    parser.add_argument('--backend', choices=BACKENDS, default='torchscript')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads (default: torch setting)')
+    parser.add_argument('--micro-batch', type=int, default=8, help='rois per forward pass')
+    parser.add_argument('--rois', type=int, default=64, help='rois used for calibration and the parity check')
+    parser.add_argument('--features', type=int, nargs='+', default=None,
+                        help='feature widths of the UNet (default: read from the weights)')
+    parser.add_argument('--norm', choices=NORMS, default=None,
+                        help='normalization of the UNet (default: read from the saved config or the weights)')
+    parser.add_argument('--export', default=None, help='optional path the torchscript model is saved to')
+    args = parser.parse_args(argv)
+
+    model = load_model(args.weights, args.features, args.norm)
+    # rois are scaled like in training, with the HU window saved next to the weights or left in HU without one
+    window = load_window(args.weights)
+    dataset = ROICacheDataset(args.cache, normalize=window or False)
+    rows = np.linspace(0, len(dataset) - 1, min(args.rois, len(dataset))).astype(int)
+    scans = torch.stack([dataset[row][0] for row in rows])
+
+    # the onnx export is written next to the weights, not into the working directory
+    session = InferenceSession(model, args.precision, args.backend, args.threads, args.micro_batch,
+                               calibration=scans, example_shape=(1,) + tuple(scans.shape[1:]),
+                               onnx_path=onnx_path_for(args.weights), window=window)
+    _, parity = dice_parity(model, session, scans)
+    timing = session.benchmark()
+    print(f'{args.precision} / {args.backend}: {timing["latency_ms"]:.1f} ms per roi, '
+          f'{timing["batched_ms_per_roi"]:.1f} ms per roi in batches of {args.micro_batch} '
+          f'({timing["threads"]} threads)')
+    print(f'dice vs fp32: mean {parity["mean_dice"]:.4f}, min {parity["min_dice"]:.4f}, '
+          f'max probability difference {parity["max_probability_difference"]:.4f}')
+
+    if args.export:
+        session.save(args.export)
+        print(f'Saved {args.export}')
+
+    return 0 if parity['passed'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,202 @@
+import contextlib
+import csv
+import functools
+import json
+import os
+import sys
+import time
+
+# unix only, windows falls back to psutil when it is installed
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# returned by every stage of a disabled tracer, nothing is timed or stored
+NULL_STAGE = contextlib.nullcontext()
+
+FIELDS = ['stage', 'seconds', 'start', 'tags']
+
+
+# peak resident memory of this process so far in MB, None when the platform offers no way to read it
+def peak_rss_mb():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    # peak working set on windows, current rss elsewhere
+    return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+
+
+# allocator counters of torch in MB, empty when torch is not loaded or runs on the cpu
+def torch_memory_mb():
+    torch = sys.modules.get('torch')
+    if torch is None:
+        return {}
+
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        return {'cuda_allocated_mb': torch.cuda.memory_allocated() / 1024 ** 2,
+                'cuda_peak_allocated_mb': torch.cuda.max_memory_allocated() / 1024 ** 2,
+                'cuda_reserved_mb': torch.cuda.memory_reserved() / 1024 ** 2}
+    if hasattr(torch, 'mps') and torch.backends.mps.is_available():
+        return {'mps_allocated_mb': torch.mps.current_allocated_memory() / 1024 ** 2}
+
+    return {}
+
+
+def cuda_synchronize():
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+class Stage:
+    __slots__ = ('tracer', 'name', 'tags', 'start')
+
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        if self.tracer.synchronize:
+            cuda_synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.tracer.synchronize:
+            cuda_synchronize()
+        self.tracer.record(self.name, time.perf_counter() - self.start, self.start, **self.tags)
+        return False
+
+
+# collects per stage timings, e.g. load / cut / save of a case or data wait / forward / backward of a step
+# a disabled tracer hands out a shared no-op context manager, so instrumented code costs an attribute lookup
+# inputs:
+# enabled -> record anything at all
+# synchronize -> wait for queued cuda work at stage boundaries, needed for true gpu stage times
+class Tracer:
+    def __init__(self, enabled=True, synchronize=False):
+        self.enabled = enabled
+        self.synchronize = synchronize
+        self.records = []
+        self.memory = []
+        self.origin = time.perf_counter()
+
+    # with tracer.stage('forward', epoch=epoch): ...
+    def stage(self, name, **tags):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name, tags)
+
+    # @tracer.timed('save') on a function
+    def timed(self, name=None):
+        def decorator(fn):
+            stageName = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.stage(stageName):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    # time spent waiting on each item of an iterable, e.g. the batches of a DataLoader
+    def iterate(self, iterable, name='data_wait', **tags):
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name, tags)
+
+    def _iterate(self, iterable, name, tags):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start, start, **tags)
+            yield item
+
+    def record(self, name, seconds, start=None, **tags):
+        if self.enabled:
+            start = time.perf_counter() - seconds if start is None else start
+            self.records.append({'stage': name, 'seconds': seconds, 'start': start - self.origin, 'tags': tags})
+
+    # records and memory snapshots taken by another tracer, e.g. in a worker process
+    def extend(self, records, memory=()):
+        if self.enabled:
+            self.records.extend(records)
+            self.memory.extend(memory)
+
+    # snapshot of the peak rss and the torch allocator counters
+    def snapshot(self, **tags):
+        if not self.enabled:
+            return None
+        snapshot = {'time': time.perf_counter() - self.origin, 'peak_rss_mb': peak_rss_mb(), **torch_memory_mb(),
+                    'tags': tags}
+        self.memory.append(snapshot)
+        return snapshot
+
+    # count, total, mean, median, p95 and max seconds per stage, with the share of the traced time
+    def summary(self):
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record['stage'], []).append(record['seconds'])
+
+        total = sum(sum(seconds) for seconds in stages.values()) or 1.0
+        rows = []
+        for name, seconds in stages.items():
+            seconds = sorted(seconds)
+            rows.append({'stage': name, 'count': len(seconds), 'total_s': sum(seconds),
+                         'mean_s': sum(seconds) / len(seconds), 'median_s': seconds[len(seconds) // 2],
+                         'p95_s': seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))], 'max_s': seconds[-1],
+                         'share': sum(seconds) / total})
+
+        return sorted(rows, key=lambda row: -row['total_s'])
+
+    def report(self):
+        if not self.enabled:
+            return
+        print(f'{"stage":<16}{"count":>8}{"total s":>10}{"mean ms":>10}{"p95 ms":>10}{"share":>8}')
+        for row in self.summary():
+            print(f'{row["stage"]:<16}{row["count"]:>8}{row["total_s"]:>10.2f}{row["mean_s"] * 1000:>10.2f}'
+                  f'{row["p95_s"] * 1000:>10.2f}{row["share"]:>8.1%}')
+        peaks = [snapshot['peak_rss_mb'] for snapshot in self.memory if snapshot['peak_rss_mb'] is not None]
+        if peaks:
+            print(f'peak rss {max(peaks):.0f} MB')
+
+    # write the trace as json (records, memory snapshots and summary) or as a csv of the records
+    def write(self, path):
+        if not self.enabled:
+            return None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as file_obj:
+                writer = csv.writer(file_obj)
+                writer.writerow(FIELDS)
+                for record in self.records:
+                    writer.writerow([record['stage'], f'{record["seconds"]:.6f}', f'{record["start"]:.6f}',
+                                     json.dumps(record['tags'], sort_keys=True)])
+        else:
+            with open(path, 'w') as file_obj:
+                json.dump({'records': self.records, 'memory': self.memory, 'summary': self.summary()}, file_obj,
+                          indent=1, default=str)
+
+        return path
+
+
+# shared disabled tracer, the default of every instrumented function
+DISABLED = Tracer(enabled=False)
@@ -0,0 +1,294 @@
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as sitk
+
+# HU window of training and inference, air (-1000) maps to 0, soft tissue and calcifications up to 400 HU to 1
+DEFAULT_WINDOW = (-1000.0, 400.0)
+
+# 1 HU bins of the percentile sketch, values outside land in the first / last bin
+SKETCH_RANGE = (-2048, 4096)
+
+# percentiles reported by IntensityStats.summary
+SUMMARY_PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+
+
+# count, mean, variance, min and max of a stream of arrays, one chunk at a time
+# chunks are combined with the parallel form of Welford's algorithm (Chan et al.), so the result does not depend on
+# how the stream is split and stats of workers can be merged
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, array):
+        array = np.asarray(array, dtype=np.float64).ravel()
+        if not array.size:
+            return self
+
+        chunk = RunningStats()
+        chunk.count = array.size
+        chunk.mean = float(array.mean())
+        chunk.m2 = float(np.square(array - chunk.mean).sum())
+        chunk.min = float(array.min())
+        chunk.max = float(array.max())
+        return self.merge(chunk)
+
+    def merge(self, other):
+        if not other.count:
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def std(self):
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls()
+        stats.count = state['count']
+        stats.mean = state['mean']
+        stats.m2 = state['m2']
+        stats.min = state['min'] if state['min'] is not None else np.inf
+        stats.max = state['max'] if state['max'] is not None else -np.inf
+        return stats
+
+
+# fixed size histogram of the intensities for percentiles without keeping the voxels
+# percentiles are exact for integer HU inside SKETCH_RANGE and within one bin (1 HU) for resampled float scans
+class HistogramSketch:
+    def __init__(self, valueRange=SKETCH_RANGE):
+        self.low, self.high = int(valueRange[0]), int(valueRange[1])
+        self.counts = np.zeros(self.high - self.low, dtype=np.int64)
+
+    def update(self, array):
+        array = np.asarray(array).ravel()
+        if array.size:
+            bins = np.clip(np.floor(array).astype(np.int64) - self.low, 0, len(self.counts) - 1)
+            self.counts += np.bincount(bins, minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        if (other.low, other.high) != (self.low, self.high):
+            raise ValueError(f'Cannot merge sketches of ranges {(self.low, self.high)} and {(other.low, other.high)}')
+        self.counts += other.counts
+        return self
+
+    # q in [0, 100], linear interpolation between the closest ranks like np.percentile
+    def percentile(self, q):
+        total = int(self.counts.sum())
+        if not total:
+            return None
+
+        cumulative = np.cumsum(self.counts)
+        rank = q / 100 * (total - 1)
+        below, above = np.searchsorted(cumulative, [np.floor(rank), np.ceil(rank)], side='right')
+        return float(self.low + below + (rank - np.floor(rank)) * (above - below))
+
+    # only the occupied bins are stored
+    def to_dict(self):
+        occupied = np.flatnonzero(self.counts)
+        if not occupied.size:
+            return {'range': [self.low, self.high], 'offset': 0, 'counts': []}
+        return {'range': [self.low, self.high], 'offset': int(occupied[0]),
+                'counts': self.counts[occupied[0]:occupied[-1] + 1].tolist()}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['range'])
+        sketch.counts[state['offset']:state['offset'] + len(state['counts'])] = state['counts']
+        return sketch
+
+
+# dataset intensity statistics gathered in one pass, one roi or volume at a time
+class IntensityStats:
+    def __init__(self, valueRange=SKETCH_RANGE):
+        self.running = RunningStats()
+        self.sketch = HistogramSketch(valueRange)
+
+    def update(self, array):
+        self.running.update(array)
+        self.sketch.update(array)
+        return self
+
+    def merge(self, other):
+        self.running.merge(other.running)
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def count(self):
+        return self.running.count
+
+    # percentiles clipped to the exact min / max, the sketch clamps values outside its range
+    def percentile(self, q):
+        value = self.sketch.percentile(q)
+        return None if value is None else min(max(value, self.running.min), self.running.max)
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'min': self.running.min, 'max': self.running.max, 'mean': self.running.mean,
+                'std': self.running.std, **{f'p{q:g}': self.percentile(q) for q in SUMMARY_PERCENTILES}}
+
+    def to_dict(self):
+        return {'running': self.running.to_dict(), 'sketch': self.sketch.to_dict(), 'summary': self.summary()}
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls(state['sketch']['range'])
+        stats.running = RunningStats.from_dict(state['running'])
+        stats.sketch = HistogramSketch.from_dict(state['sketch'])
+        return stats
+
+
+# per sample normalization: clip to a fixed HU window and scale it to [0, 1]
+# it needs no dataset statistics, so training, validation and deployment scale every roi the same way
+# picklable, pass it as normalize= of the datasets and to sliding_window.segment_volume
+# inputs:
+# low, high -> HU mapped to 0 and 1, see DEFAULT_WINDOW
+class HUWindow:
+    def __init__(self, low=DEFAULT_WINDOW[0], high=DEFAULT_WINDOW[1]):
+        if high <= low:
+            raise ValueError(f'HU window needs low < high, got ({low}, {high})')
+        self.low = float(low)
+        self.high = float(high)
+
+    # window between two percentiles of the dataset, e.g. to clip the rare streak artifacts of a scanner
+    @classmethod
+    def from_stats(cls, stats, lower=0.5, upper=99.5):
+        return cls(stats.percentile(lower), stats.percentile(upper))
+
+    # numpy arrays come back as float32, torch tensors keep their floating dtype
+    def __call__(self, scan):
+        if isinstance(scan, np.ndarray):
+            scan = np.clip(scan.astype(np.float32, copy=False), self.low, self.high)
+            return (scan - np.float32(self.low)) / np.float32(self.high - self.low)
+        if not scan.is_floating_point():
+            scan = scan.float()
+        return (scan.clamp(self.low, self.high) - self.low) / (self.high - self.low)
+
+    # keeps sweep.trial_key stable, the window is part of a trial's data
+    def __repr__(self):
+        return f'HUWindow(low={self.low:g}, high={self.high:g})'
+
+    def __eq__(self, other):
+        return isinstance(other, HUWindow) and (self.low, self.high) == (other.low, other.high)
+
+    def to_dict(self):
+        return {'low': self.low, 'high': self.high}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['low'], state['high'])
+
+    # write to a temporary file first so a crash while saving never leaves half a file behind
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as file_obj:
+            json.dump(self.to_dict(), file_obj, indent=1)
+        os.replace(tmp, path)
+        return path
+
+
+# window saved next to the weights of a model, nov26_24.pth -> nov26_24_window.json
+def window_path(weightsPath):
+    return os.path.splitext(weightsPath)[0] + '_window.json'
+
+
+# window a model was trained with, None for weights without one (rois stay in HU, see segmentation.normalize_roi)
+def load_window(weightsPath):
+    path = window_path(weightsPath)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file_obj:
+        return HUWindow.from_dict(json.load(file_obj))
+
+
+# statistics of one image file, runs inside a worker process
+def file_stats(path):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    return IntensityStats().update(sitk.GetArrayFromImage(sitk.ReadImage(str(path))))
+
+
+# one pass over image files, only one decoded file per worker is in memory at a time
+# workers -> decoding processes, defaulted to one per core, 1 decodes in this process
+def compute_stats(paths, workers=None):
+    stats = IntensityStats()
+
+    if workers == 1:
+        for path in paths:
+            try:
+                stats.merge(file_stats(path))
+            except Exception as e:
+                print(f'Failed to read {path}: {e}')
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(file_stats, path): path for path in paths}
+            for future in as_completed(futures):
+                try:
+                    stats.merge(future.result())
+                except Exception as e:
+                    print(f'Failed to read {futures[future]}: {e}')
+
+    return stats
+
+
+def save_stats(stats, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as file_obj:
+        json.dump(stats.to_dict(), file_obj)
+    os.replace(tmp, path)
+    return path
+
+
+def load_stats(path):
+    with open(path) as file_obj:
+        return IntensityStats.from_dict(json.load(file_obj))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Intensity statistics of a set of scans in one streaming pass.')
+    parser.add_argument('inputs', nargs='+', help='image files or directories of them')
+    parser.add_argument('--pattern', default='*.nrrd', help='files picked from directories (default: *.nrrd)')
+    parser.add_argument('--output', default=None, help='json file the statistics are written to')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for path in args.inputs:
+        paths += sorted(glob.glob(os.path.join(path, args.pattern))) if os.path.isdir(path) else [path]
+
+    stats = compute_stats(paths, args.workers)
+    for key, value in stats.summary().items():
+        print(f'{key:>8}: {value:g}')
+    print(f'window between p0.5 and p99.5: {HUWindow.from_stats(stats) if stats.count else None}')
+
+    if args.output:
+        print(f'Statistics of {len(paths)} files written to {save_stats(stats, args.output)}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
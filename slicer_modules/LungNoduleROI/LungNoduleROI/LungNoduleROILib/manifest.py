@@ -0,0 +1,110 @@
+import csv
+import glob
+import hashlib
+import os
+
+
+# identify a source file by size and modification time, and optionally by the sha1 of its content
+def fingerprint(path, useHash=False):
+    stat = os.stat(path)
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    if useHash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as file_obj:
+            for chunk in iter(lambda: file_obj.read(1 << 20), b''):
+                sha1.update(chunk)
+        entry['sha1'] = sha1.hexdigest()
+
+    return entry
+
+
+# patient id of a file named <PID>_*
+def pid_from_path(path):
+    return os.path.basename(path).split('_')[0]
+
+
+# key of a training roi, <PID>_<noduleIdx> for rois named <PID>_<noduleIdx>_*, otherwise the patient id
+def case_key_from_path(path):
+    parts = os.path.basename(path).split('_')
+    if len(parts) > 2 and parts[1].isdigit():
+        return parts[0] + '_' + parts[1]
+    return parts[0]
+
+
+# glob a directory once and index the files by patient id
+# inputs:
+# directory -> directory to search
+# pattern -> glob pattern relative to directory, defaulted to every .nrrd below it
+# key -> function giving the index key of a path
+def index_files(directory, pattern='**/*.nrrd', key=pid_from_path):
+    index = {}
+    for path in sorted(glob.glob(os.path.join(directory, pattern), recursive=True)):
+        if os.path.isfile(path):
+            index.setdefault(key(path), []).append(path)
+
+    return index
+
+
+# parse the centroid csv once and index the rows by patient id (first column)
+def index_csv(csvPath):
+    index = {}
+    with open(csvPath) as file_obj:
+        for row in csv.reader(file_obj):
+            if row:
+                index.setdefault(row[0], []).append(row)
+
+    return index
+
+
+# result of pairing two pid indexes
+# matched -> {pid: (left, right)} for pids found exactly once on both sides
+# unmatchedLeft / unmatchedRight -> {pid: [entries]} only found on one side
+# duplicates -> {pid: ([left entries], [right entries])} found more than once on either side
+class Manifest:
+    def __init__(self):
+        self.matched = {}
+        self.unmatchedLeft = {}
+        self.unmatchedRight = {}
+        self.duplicates = {}
+
+    def summary(self):
+        return (f'{len(self.matched)} matched, {len(self.unmatchedLeft)} + {len(self.unmatchedRight)} unmatched, '
+                f'{len(self.duplicates)} duplicated')
+
+
+# pair two pid indexes in a single pass over their keys
+# multipleRight -> the right side may hold several entries per pid (e.g. one csv row per nodule),
+#                  matched then holds (left, [right entries])
+def match_indexes(left, right, multipleRight=False):
+    manifest = Manifest()
+
+    for pid in sorted(left.keys() | right.keys()):
+        leftEntries = left.get(pid, [])
+        rightEntries = right.get(pid, [])
+
+        if len(leftEntries) > 1 or (len(rightEntries) > 1 and not multipleRight):
+            manifest.duplicates[pid] = (leftEntries, rightEntries)
+        elif not rightEntries:
+            manifest.unmatchedLeft[pid] = leftEntries
+        elif not leftEntries:
+            manifest.unmatchedRight[pid] = rightEntries
+        elif multipleRight:
+            manifest.matched[pid] = (leftEntries[0], rightEntries)
+        else:
+            manifest.matched[pid] = (leftEntries[0], rightEntries[0])
+
+    return manifest
+
+
+# pair volumes with their centroid csv rows
+# left side are volume paths, right side are the lists of csv rows, one per nodule
+def build_case_manifest(volumeDir, centroidCsv, pattern='*'):
+    return match_indexes(index_files(volumeDir, pattern), index_csv(centroidCsv), multipleRight=True)
+
+
+# pair training scans with their labels, keyed by <PID> or <PID>_<noduleIdx>
+# left side are scan paths, right side are label paths
+def build_label_manifest(scanDir, labelDir, pattern='**/*.nrrd'):
+    return match_indexes(index_files(scanDir, pattern, case_key_from_path),
+                         index_files(labelDir, pattern, case_key_from_path))
@@ -0,0 +1,166 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+METRICS = ['dice', 'iou', 'precision', 'recall', 'pred_volume', 'target_volume', 'volume_error',
+           'relative_volume_error', 'hausdorff', 'hausdorff95', 'mean_surface_distance']
+COLUMNS = ['case', 'threshold'] + METRICS
+
+# spacing along the stacked case axis for the batched distance transform, large enough that
+# no distance ever crosses from one case into another
+CASE_SEPARATION = 1e6
+
+
+# voxels of a (B, D, H, W) mask touching the background, found with a single 3x3x3 min pool for the batch
+# everything outside of the volume counts as background
+def surface(masks):
+    masks = masks.float().unsqueeze(1)
+    eroded = -F.max_pool3d(F.pad(-masks, (1, 1, 1, 1, 1, 1), value=0), kernel_size=3, stride=1)
+    return (masks - eroded).squeeze(1) > 0
+
+
+# hausdorff, 95th percentile hausdorff and mean symmetric surface distance for (B, D, H, W) boolean masks
+# one euclidean distance transform covers the whole batch, cases are kept apart along the stacked axis
+def surface_distances(pred, target, spacing):
+    from scipy.ndimage import distance_transform_edt
+
+    pred_surface = surface(pred).numpy()
+    target_surface = surface(target).numpy()
+    sampling = (CASE_SEPARATION,) + tuple(spacing)
+
+    # distance of every voxel to the closest surface voxel of the other mask
+    to_target = distance_transform_edt(~target_surface, sampling=sampling)
+    to_pred = distance_transform_edt(~pred_surface, sampling=sampling)
+
+    batch = pred_surface.shape[0]
+    distances = np.concatenate([np.where(pred_surface, to_target, np.nan).reshape(batch, -1),
+                                np.where(target_surface, to_pred, np.nan).reshape(batch, -1)], axis=1)
+
+    # undefined when either mask is empty
+    empty = ~pred_surface.reshape(batch, -1).any(1) | ~target_surface.reshape(batch, -1).any(1)
+    distances[empty] = np.nan
+
+    # all-nan rows warn, their result is nan as intended
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        hausdorff = np.nanmax(distances, axis=1)
+        hausdorff95 = np.nanpercentile(distances, 95, axis=1)
+        mean_distance = np.nanmean(distances, axis=1)
+
+    return hausdorff, hausdorff95, mean_distance
+
+
+# per case segmentation metrics for a whole batch and several thresholds in one call
+# inputs:
+# predictions -> (N, 1, D, H, W) probabilities, or logits with from_logits=True
+# targets -> (N, 1, D, H, W) ground truth, binarized at 0.5
+# thresholds -> list of thresholds applied to the predictions
+# spacing -> (D, H, W) voxel spacing in mm for volumes and surface distances
+# case_ids -> optional ids for the case column, defaulted to 0..N-1
+# distances -> also compute hausdorff / surface distances (needs scipy)
+# returns a tidy DataFrame with one row per case and threshold
+def segmentation_metrics(predictions, targets, thresholds=(0.5,), spacing=(1, 1, 1), case_ids=None,
+                         from_logits=False, distances=True):
+    predictions = torch.as_tensor(predictions).detach().float().cpu()
+    targets = torch.as_tensor(targets).detach().cpu()
+    if from_logits:
+        predictions = torch.sigmoid(predictions)
+
+    cases = predictions.shape[0]
+    threshold_values = np.asarray(list(thresholds), dtype=np.float64)
+    thresholds = torch.as_tensor(threshold_values, dtype=torch.float32)
+    voxel_volume = float(np.prod(spacing))
+
+    # (T, N, V) masks for every threshold at once
+    pred = predictions.reshape(1, cases, -1) >= thresholds.view(-1, 1, 1)
+    target = (targets.reshape(1, cases, -1) >= 0.5).expand_as(pred)
+
+    tp = (pred & target).sum(-1).double()
+    fp = (pred & ~target).sum(-1).double()
+    fn = (~pred & target).sum(-1).double()
+
+    pred_count = tp + fp
+    target_count = tp + fn
+    union = tp + fp + fn
+
+    # empty prediction and empty target count as a perfect match, like dice_coefficient in mk3.ipynb
+    dice = torch.where(union > 0, 2 * tp / (pred_count + target_count).clamp(min=1), torch.ones_like(tp))
+    iou = torch.where(union > 0, tp / union.clamp(min=1), torch.ones_like(tp))
+    precision = torch.where(pred_count > 0, tp / pred_count.clamp(min=1), (fn == 0).double())
+    recall = torch.where(target_count > 0, tp / target_count.clamp(min=1), (fp == 0).double())
+
+    pred_volume = pred_count * voxel_volume
+    target_volume = target_count * voxel_volume
+    volume_error = pred_volume - target_volume
+    relative_volume_error = torch.where(target_volume > 0, volume_error / target_volume,
+                                        torch.full_like(volume_error, float('nan')))
+
+    table = {
+        'case': np.tile(np.asarray(case_ids if case_ids is not None else range(cases)), len(thresholds)),
+        'threshold': np.repeat(threshold_values, cases),
+    }
+    for name, values in [('dice', dice), ('iou', iou), ('precision', precision), ('recall', recall),
+                         ('pred_volume', pred_volume), ('target_volume', target_volume),
+                         ('volume_error', volume_error), ('relative_volume_error', relative_volume_error)]:
+        table[name] = values.reshape(-1).numpy()
+
+    if distances:
+        shape = predictions.shape[2:]
+        hausdorff, hausdorff95, mean_distance = surface_distances(pred.reshape(-1, *shape),
+                                                                  target.reshape(-1, *shape), spacing)
+        table['hausdorff'] = hausdorff
+        table['hausdorff95'] = hausdorff95
+        table['mean_surface_distance'] = mean_distance
+    else:
+        for name in ('hausdorff', 'hausdorff95', 'mean_surface_distance'):
+            table[name] = np.full(len(table['case']), np.nan)
+
+    return pd.DataFrame(table, columns=COLUMNS)
+
+
+# collect metrics batch by batch
+# running sums per threshold are always kept so summary() costs nothing extra, per case rows only when keep_cases
+class MetricAccumulator:
+    def __init__(self, thresholds=(0.5,), spacing=(1, 1, 1), from_logits=False, distances=True, keep_cases=True):
+        self.options = {'thresholds': thresholds, 'spacing': spacing, 'from_logits': from_logits,
+                        'distances': distances}
+        self.keep_cases = keep_cases
+        self.tables = []
+        self.count = None
+        self.sums = None
+        self.squares = None
+        self.cases = 0
+
+    def update(self, predictions, targets, case_ids=None):
+        if case_ids is None:
+            case_ids = range(self.cases, self.cases + len(predictions))
+        self.cases += len(predictions)
+
+        table = segmentation_metrics(predictions, targets, case_ids=case_ids, **self.options)
+        if self.keep_cases:
+            self.tables.append(table)
+
+        values = table[METRICS]
+        count = values.groupby(table['threshold']).count()
+        sums = values.groupby(table['threshold']).sum()
+        squares = (values ** 2).groupby(table['threshold']).sum()
+        if self.sums is None:
+            self.count, self.sums, self.squares = count, sums, squares
+        else:
+            self.count, self.sums, self.squares = self.count + count, self.sums + sums, self.squares + squares
+
+        return table
+
+    def table(self):
+        if not self.tables:
+            return pd.DataFrame(columns=COLUMNS)
+        return pd.concat(self.tables, ignore_index=True)
+
+    # mean and standard deviation of every metric per threshold, nan cases are left out
+    def summary(self):
+        mean = self.sums / self.count
+        std = np.sqrt((self.squares / self.count - mean ** 2).clip(lower=0))
+        return pd.concat({'mean': mean, 'std': std}, axis=1)
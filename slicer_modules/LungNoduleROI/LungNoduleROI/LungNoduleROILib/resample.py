@@ -0,0 +1,173 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+
+from LungNoduleROILib import transforms
+from LungNoduleROILib.manifest import fingerprint
+
+# bump when the resampling itself changes so old cache entries are not reused
+RESAMPLE_VERSION = 1
+
+INTERPOLATORS = {
+    'linear': sitk.sitkLinear,
+    'nearest': sitk.sitkNearestNeighbor,
+    'bspline': sitk.sitkBSpline,
+}
+
+
+# size of the grid covering the same physical extent at the target spacing
+def resampled_size(size, spacing, target_spacing):
+    return [max(1, int(round(size[i] * spacing[i] / target_spacing[i]))) for i in range(3)]
+
+
+# resample an image to the target spacing, origin and direction are kept so physical points do not move
+# inputs:
+# img -> SimpleITK image
+# target_spacing -> output spacing in mm, e.g. (1, 1, 1)
+# interpolator -> 'linear', 'nearest' (labels) or 'bspline'
+# default_value -> value outside of the source image, defaulted to air (-1000 HU)
+# threads -> threads used by the filter, defaulted to SimpleITK's global setting
+def resample_image(img, target_spacing=(1, 1, 1), interpolator='linear', default_value=-1000, threads=None):
+    target_spacing = [float(s) for s in target_spacing]
+
+    resample = sitk.ResampleImageFilter()
+    resample.SetOutputOrigin(img.GetOrigin())
+    resample.SetOutputDirection(img.GetDirection())
+    resample.SetOutputSpacing(target_spacing)
+    resample.SetSize(resampled_size(img.GetSize(), img.GetSpacing(), target_spacing))
+    resample.SetInterpolator(INTERPOLATORS[interpolator])
+    resample.SetDefaultPixelValue(default_value)
+    resample.SetOutputPixelType(img.GetPixelID())
+    if threads is not None:
+        resample.SetNumberOfThreads(threads)
+
+    return resample.Execute(img)
+
+
+# map voxel indices of the source grid onto the resampled grid through physical space
+# inputs:
+# indices -> (N, 3) or (3,) voxel indices (x, y, z) in the source image
+# source_geometry / target_geometry -> (origin, spacing, direction), see transforms.geometry_from_image
+def map_indices(indices, source_geometry, target_geometry, rounded=True):
+    return transforms.physical_to_index(transforms.index_to_physical(indices, source_geometry), target_geometry,
+                                        rounded)
+
+
+# key of a resampled volume, covers the source file, the target spacing and the resampling options
+def resample_key(path, target_spacing, interpolator='linear', useHash=False):
+    text = json.dumps({
+        'version': RESAMPLE_VERSION,
+        'source': os.path.abspath(path),
+        'fingerprint': fingerprint(path, useHash),
+        'spacing': [round(float(s), 6) for s in target_spacing],
+        'interpolator': interpolator,
+    }, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# resampled copy of a volume from the on disk cache, the volume is only resampled when it is missing
+# files are named <source name>_<key>.nrrd, so a changed source or spacing never hits an old entry
+# inputs:
+# path -> source volume
+# target_spacing -> output spacing in mm
+# cacheDir -> directory of resampled volumes, can be shared between experiments
+# threads -> threads used by the filter, defaulted to SimpleITK's global setting
+# returns the path of the resampled volume
+def cached_resample(path, target_spacing, cacheDir, interpolator='linear', threads=None, useHash=False):
+    os.makedirs(cacheDir, exist_ok=True)
+
+    name = os.path.basename(path).split('.')[0]
+    key = resample_key(path, target_spacing, interpolator, useHash)
+    outputPath = os.path.join(cacheDir, f'{name}_{key[:16]}.nrrd')
+    if os.path.exists(outputPath):
+        return outputPath
+
+    img = sitk.ReadImage(str(path))
+    default_value = 0 if interpolator == 'nearest' else -1000
+    resampled = resample_image(img, target_spacing, interpolator, default_value, threads)
+
+    # written under a temporary name and renamed so a crash or a parallel writer never leaves half a volume
+    tmp = outputPath[:-len('.nrrd')] + f'.{os.getpid()}.tmp.nrrd'
+    sitk.WriteImage(resampled, tmp, useCompression=True)
+    os.replace(tmp, outputPath)
+
+    return outputPath
+
+
+def resample_worker(path, target_spacing, cacheDir, interpolator, threads, useHash):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    return path, cached_resample(path, target_spacing, cacheDir, interpolator, threads, useHash)
+
+
+# resample many volumes across worker processes, each worker gets an equal share of the cores
+# inputs:
+# paths -> source volumes
+# target_spacing, cacheDir, interpolator, useHash -> same as cached_resample
+# workers -> number of worker processes, defaulted to one per core
+# returns {source path: resampled path}, failed volumes are reported and left out
+def resample_files(paths, target_spacing, cacheDir, workers=None, interpolator='linear', useHash=False):
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    resampled = {}
+
+    if workers == 1:
+        for path in paths:
+            try:
+                resampled[path] = cached_resample(path, target_spacing, cacheDir, interpolator, threads, useHash)
+            except Exception as e:
+                print(f'Failed to resample {path}: {e}')
+        return resampled
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(resample_worker, path, target_spacing, cacheDir, interpolator, threads, useHash): path
+                   for path in paths}
+        for future in as_completed(futures):
+            try:
+                path, outputPath = future.result()
+            except Exception as e:
+                print(f'Failed to resample {futures[future]}: {e}')
+                continue
+            resampled[path] = outputPath
+
+    return resampled
+
+
+# spacing given on the command line, one value for isotropic or three values (x, y, z)
+def parse_spacing(text):
+    values = [float(v) for v in str(text).replace(',', ' ').split()]
+    if len(values) == 1:
+        values = values * 3
+    if len(values) != 3 or any(v <= 0 for v in values):
+        raise ValueError(f'spacing needs one or three positive values, got {text!r}')
+
+    return values
+
+
+def spacing_tag(target_spacing):
+    return 'x'.join(f'{s:g}' for s in target_spacing)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resample every volume of a directory into the resampling cache.')
+    parser.add_argument('volumes', help='directory of volumes')
+    parser.add_argument('cache', help='directory the resampled volumes are cached in')
+    parser.add_argument('--spacing', default='1', help='target spacing in mm, one value or "x,y,z" (default: 1)')
+    parser.add_argument('--pattern', default='*', help='glob pattern of the volumes relative to the directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    spacing = parse_spacing(args.spacing)
+    paths = sorted(p for p in glob.glob(os.path.join(args.volumes, args.pattern)) if os.path.isfile(p))
+    resampled = resample_files(paths, spacing, args.cache, args.workers)
+    print(f'{len(resampled)}/{len(paths)} volumes resampled to {spacing_tag(spacing)} mm in {args.cache}')
+
+    return 0 if len(resampled) == len(paths) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
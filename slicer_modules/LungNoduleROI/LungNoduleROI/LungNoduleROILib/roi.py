@@ -0,0 +1,94 @@
+import numpy as np
+import SimpleITK as sitk
+
+
+class ImageROI:
+    # index window [start, start + size) of the roi for each image axis (x, y, z)
+    # inputs:
+    # expansion -> size of the roi in voxels for each direction
+    # centroid -> centroid of lung nodule in voxel indices
+    def roi_window(self, expansion, centroid):
+        start = [int(centroid[i]) - int(expansion[i] / 2) for i in range(3)]
+        size = [2 * int(expansion[i] / 2) for i in range(3)]
+
+        return start, size
+
+    # create roi image from sitk image
+    # only the voxels inside the roi window are copied out of img, the full volume is never converted to numpy
+    # inputs:
+    # img -> SimpleITK image
+    # centroid -> centroid of lung nodule in coordinates using [1,1,1] spacing NOT SLICER
+    # expansion -> amount to expand ROI from centroid in +/- for each direction
+    # pad_value -> value used for the part of the roi that falls outside of img, defaulted to air (-1000 HU)
+    def create_roi_image(self, img, expansion, centroid, pad_value=-1000):
+        start, size = self.roi_window(expansion, centroid)
+        lower, upper = self.clip_window(start, size, img.GetSize())
+
+        # window entirely outside of the image, read a single voxel to keep the pixel type
+        if any(upper[i] <= lower[i] for i in range(3)):
+            np_roi = sitk.GetArrayFromImage(sitk.RegionOfInterest(img, [1, 1, 1], [0, 0, 0]))[:0, :0, :0]
+        else:
+            region = sitk.RegionOfInterest(img, [upper[i] - lower[i] for i in range(3)], lower)
+            np_roi = sitk.GetArrayFromImage(region)
+
+        return self.pad_roi(np_roi, start, size, lower, upper, pad_value)
+
+    # create roi image straight from a file on disk
+    # the reader is asked for the roi window only, so formats that support streaming (nrrd, nii) never decode the full CT
+    # inputs:
+    # path -> path to the volume
+    # expansion, centroid, pad_value -> same as create_roi_image
+    def create_roi_image_from_file(self, path, expansion, centroid, pad_value=-1000):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(path))
+        reader.ReadImageInformation()
+
+        start, size = self.roi_window(expansion, centroid)
+        lower, upper = self.clip_window(start, size, reader.GetSize())
+
+        # window entirely outside of the image, read a single voxel to keep the pixel type
+        if any(upper[i] <= lower[i] for i in range(3)):
+            reader.SetExtractIndex([0, 0, 0])
+            reader.SetExtractSize([1, 1, 1])
+            np_roi = sitk.GetArrayFromImage(reader.Execute())[:0, :0, :0]
+        else:
+            reader.SetExtractIndex(lower)
+            reader.SetExtractSize([upper[i] - lower[i] for i in range(3)])
+            np_roi = sitk.GetArrayFromImage(reader.Execute())
+
+        return self.pad_roi(np_roi, start, size, lower, upper, pad_value)
+
+    # create roi image from a numpy volume indexed (z, y, x), e.g. a slicer.util.arrayFromVolume view
+    # the volume is sliced in place, only the roi itself is copied
+    # inputs:
+    # volume_array -> numpy array of the full volume
+    # expansion, centroid, pad_value -> same as create_roi_image, centroid in (x, y, z) voxel indices
+    def create_roi_image_from_array(self, volume_array, expansion, centroid, pad_value=-1000):
+        start, size = self.roi_window(expansion, centroid)
+        lower, upper = self.clip_window(start, size, volume_array.shape[::-1])
+
+        np_roi = volume_array[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+
+        # copy so the roi never aliases the source volume
+        return np.array(self.pad_roi(np_roi, start, size, lower, upper, pad_value))
+
+    # intersect the roi window with the image extent
+    def clip_window(self, start, size, img_size):
+        lower = [min(max(start[i], 0), img_size[i]) for i in range(3)]
+        upper = [max(min(start[i] + size[i], img_size[i]), lower[i]) for i in range(3)]
+
+        return lower, upper
+
+    # pad the extracted region back to the requested roi size
+    # numpy arrays are indexed (z, y, x) so the padding is reversed from the sitk index order
+    def pad_roi(self, np_roi, start, size, lower, upper, pad_value):
+        if list(np_roi.shape[::-1]) == size:
+            return np_roi
+
+        if np_roi.size == 0:
+            return np.full(size[::-1], pad_value, dtype=np_roi.dtype)
+
+        before = [lower[i] - start[i] for i in range(3)]
+        after = [(start[i] + size[i]) - upper[i] for i in range(3)]
+        padding = [(before[i], after[i]) for i in reversed(range(3))]
+        return np.pad(np_roi, padding, mode='constant', constant_values=pad_value)
@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import h5py
+import numpy as np
+import SimpleITK as sitk
+import torch
+from torch.utils.data import Dataset
+
+from LungNoduleROILib import manifest, transforms
+from LungNoduleROILib.intensity import IntensityStats
+
+STORE_VERSION = 1
+ROIS = 'rois'
+LABELS = 'labels'
+
+# compressions of the samples, gzip takes a level 0-9, lzf is faster and has none
+CODECS = ('gzip', 'lzf', 'none')
+
+
+# all rois of an export in one chunked, compressed HDF5 file instead of thousands of small nrrd files
+# every sample is its own dataset stored as a single chunk, so a random read is one seek and one decompression
+# per sample attributes: pid, source volume, (origin, spacing, direction) of the volume it was cut from,
+# centroid (voxel index in that volume) and the fingerprint of the source file
+# HDF5 allows a single writer, workers decode in parallel and hand their arrays to the process that appends;
+# appends from threads of that process are serialized by a lock
+# intensity statistics of all rois are merged on every append and saved when the store is closed, replacing a
+# sample makes them stale and they are gathered again in one pass over the store, see intensity.IntensityStats
+# inputs:
+# path -> .h5 file, created when missing
+# mode -> 'a' to append, 'r' to read, 'w' to start over
+# codec, level -> compression of new samples, see CODECS
+class ROIStore:
+    def __init__(self, path, mode='a', codec='gzip', level=4):
+        if codec not in CODECS:
+            raise ValueError(f'Unknown codec {codec}, use one of {CODECS}')
+
+        self.path = path
+        self.codec = codec
+        self.level = level
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.stats = None
+        self.statsChanged = False
+        self.statsStale = False
+        if mode != 'r':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = h5py.File(path, mode)
+
+        if mode != 'r':
+            self.file.require_group(ROIS)
+            self.file.require_group(LABELS)
+            self.file.attrs.setdefault('version', STORE_VERSION)
+        if self.file.attrs.get('version', STORE_VERSION) != STORE_VERSION:
+            raise ValueError(f'{path} is a version {self.file.attrs["version"]} store, expected {STORE_VERSION}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self.file.id.valid:
+            if self.mode != 'r' and (self.statsChanged or self.statsStale):
+                self.save_stats()
+            self.file.close()
+
+    def __len__(self):
+        return len(self.names())
+
+    def __contains__(self, name):
+        return ROIS in self.file and name in self.file[ROIS]
+
+    def names(self, labelled=False):
+        if ROIS not in self.file:
+            return []
+        names = sorted(self.file[ROIS])
+        if labelled:
+            names = [name for name in names if name in self.file[LABELS]]
+        return names
+
+    def compression(self, shape):
+        if self.codec == 'none':
+            return {}
+        options = {'compression': self.codec, 'shuffle': True, 'chunks': tuple(shape)}
+        if self.codec == 'gzip':
+            options['compression_opts'] = self.level
+        return options
+
+    def write(self, group, name, array):
+        group = self.file[group]
+        if name in group:
+            del group[name]
+        return group.create_dataset(name, data=array, **self.compression(array.shape))
+
+    # add or replace one sample
+    # inputs:
+    # name -> sample key, e.g. <PID>_<noduleIdx>
+    # roi -> (D, H, W) array, stored in its own dtype
+    # label -> optional (D, H, W) mask, binarized to uint8
+    # geometry -> optional (origin, spacing, direction) of the volume the roi was cut from
+    # centroid -> optional voxel index of the roi center in that volume
+    # attrs -> any other per sample attributes, e.g. pid, source, fingerprint
+    def append(self, name, roi, label=None, geometry=None, centroid=None, **attrs):
+        roi = np.asarray(roi)
+        with self.lock:
+            if name in self:
+                self.statsStale = True
+            elif not self.statsStale:
+                self.intensity_stats().update(roi)
+                self.statsChanged = True
+
+            dataset = self.write(ROIS, name, roi)
+            if label is not None:
+                self.write(LABELS, name, (np.asarray(label) > 0).astype(np.uint8))
+            elif name in self.file[LABELS]:
+                del self.file[LABELS][name]
+
+            if geometry is not None:
+                origin, spacing, direction = geometry
+                dataset.attrs['origin'] = np.asarray(origin, dtype=np.float64)
+                dataset.attrs['spacing'] = np.asarray(spacing, dtype=np.float64)
+                dataset.attrs['direction'] = np.asarray(direction, dtype=np.float64).reshape(3, 3)
+            if centroid is not None:
+                dataset.attrs['centroid'] = np.asarray(centroid, dtype=np.int64)
+            for key, value in attrs.items():
+                # dicts such as the fingerprint are kept as json text
+                if isinstance(value, dict):
+                    value = json.dumps(value, sort_keys=True)
+                if value is not None:
+                    dataset.attrs[key] = value
+
+            # dataset wide range for min-max normalization, widened by every append
+            if roi.size:
+                self.file.attrs['min'] = min(float(roi.min()), self.file.attrs.get('min', np.inf))
+                self.file.attrs['max'] = max(float(roi.max()), self.file.attrs.get('max', -np.inf))
+
+    def read(self, name):
+        roi = self.file[ROIS][name][()]
+        label = self.file[LABELS][name][()] if name in self.file[LABELS] else None
+        return roi, label
+
+    def metadata(self, name):
+        dataset = self.file[ROIS][name]
+        metadata = {}
+        for key, value in dataset.attrs.items():
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif isinstance(value, str) and value.startswith('{'):
+                value = json.loads(value)
+            metadata[key] = value
+        metadata['shape'] = list(dataset.shape)
+        metadata['labelled'] = name in self.file[LABELS]
+        return metadata
+
+    @property
+    def range(self):
+        return float(self.file.attrs.get('min', 0.0)), float(self.file.attrs.get('max', 0.0))
+
+    # statistics of every roi in the store, gathered in one pass when the file has none yet or they are stale
+    def intensity_stats(self):
+        if self.stats is None and not self.statsStale and 'intensity' in self.file.attrs:
+            self.stats = IntensityStats.from_dict(json.loads(self.file.attrs['intensity']))
+        if self.stats is None or self.statsStale:
+            self.stats = IntensityStats()
+            for name in self.names():
+                self.stats.update(self.file[ROIS][name][()])
+            self.statsStale = False
+            self.statsChanged = True
+        return self.stats
+
+    def save_stats(self):
+        self.file.attrs['intensity'] = json.dumps(self.intensity_stats().to_dict())
+        self.statsChanged = False
+
+
+# dataset reading samples straight from an ROIStore, each DataLoader worker opens its own handle to the file
+# inputs:
+# path -> .h5 file written by ROIStore / write_pairs / batch --store
+# names -> optional subset of samples, e.g. a train/val/test split, defaulted to every labelled sample
+#          every name needs a roi and a label in the store, otherwise a ValueError is raised here instead of at fetch
+# desired_size -> optional (D, H, W), samples of another size are dropped using their stored shapes
+# normalize -> True for min-max normalization with the store's range, or a callable applied to the float32 scan
+# transform -> optional callable(scan, label) on the CPU tensors, e.g. augmentation
+class ROIStoreDataset(Dataset):
+    def __init__(self, path, names=None, desired_size=None, normalize=None, transform=None):
+        self.path = path
+        with ROIStore(path, 'r') as store:
+            labelled = store.names(labelled=True)
+            self.names = labelled if names is None else list(names)
+            if names is not None:
+                missing = sorted(set(self.names) - set(labelled))
+                if missing:
+                    raise ValueError(f'{len(missing)} samples have no roi or no label in {path}, '
+                                     f'e.g. {", ".join(missing[:5])}')
+            if desired_size is not None:
+                shapes = {name: store.file[ROIS][name].shape for name in self.names}
+                self.names = [name for name in self.names if shapes[name] == tuple(desired_size)]
+            self.range = store.range
+
+        self.normalize = normalize
+        self.transform = transform
+        self.store = None
+        self.storePid = None
+
+    # h5py handles are not shared across processes, each DataLoader worker reopens the file on first access
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['store'] = None
+        return state
+
+    @property
+    def pids(self):
+        return list(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        if self.store is None or self.storePid != os.getpid():
+            self.store = ROIStore(self.path, 'r')
+            self.storePid = os.getpid()
+
+        roi, label = self.store.read(self.names[idx])
+        scan = roi.astype(np.float32)
+        if self.normalize is True:
+            vmin, vmax = self.range
+            scan = (scan - vmin) / max(vmax - vmin, 1e-6)
+        elif self.normalize is not None:
+            scan = self.normalize(scan)
+
+        scan = torch.from_numpy(scan).unsqueeze(0)
+        label = torch.from_numpy(label.astype(np.float32)).unsqueeze(0)
+
+        if self.transform is not None:
+            scan, label = self.transform(scan, label)
+
+        return scan, label
+
+
+# decode one scan / label pair, runs inside a worker process
+def read_pair(name, scanPath, labelPath, useHash=False):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    img = sitk.ReadImage(str(scanPath))
+    label = sitk.GetArrayFromImage(sitk.ReadImage(str(labelPath))) if labelPath else None
+
+    return name, sitk.GetArrayFromImage(img), label, transforms.geometry_from_image(img), {
+        'pid': name.split('_')[0], 'source': str(scanPath),
+        'fingerprint': manifest.fingerprint(scanPath, useHash)}
+
+
+# copy scan / label file pairs into a store, pairs whose scan fingerprint is already stored are skipped
+# inputs:
+# pairs -> {pid: (scan path, label path)}, e.g. manifest.build_label_manifest(...).matched
+# storePath -> .h5 file, created or appended to
+# codec, level -> compression, see ROIStore
+# workers -> decoding processes, defaulted to one per core
+# returns the names written in this call
+def write_pairs(pairs, storePath, codec='gzip', level=4, workers=None, useHash=False):
+    written = []
+    with ROIStore(storePath, 'a', codec, level) as store:
+        todo = [(pid, scan, label) for pid, (scan, label) in sorted(pairs.items())
+                if pid not in store or store.metadata(pid).get('fingerprint') != manifest.fingerprint(scan, useHash)]
+
+        def append(name, roi, label, geometry, attrs):
+            store.append(name, roi, label, geometry, **attrs)
+            written.append(name)
+
+        if workers == 1:
+            for pid, scan, label in todo:
+                try:
+                    append(*read_pair(pid, scan, label, useHash))
+                except Exception as e:
+                    print(f'Failed to store {pid}: {e}')
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(read_pair, pid, scan, label, useHash): pid for pid, scan, label in todo}
+                for future in as_completed(futures):
+                    try:
+                        append(*future.result())
+                    except Exception as e:
+                        print(f'Failed to store {futures[future]}: {e}')
+
+        print(f'ROI store {storePath}: {len(written)} written, {len(pairs) - len(todo)} unchanged, {len(store)} total')
+
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack scan / label roi pairs into one chunked HDF5 file.')
+    parser.add_argument('scans', help='directory of roi scans named <PID>_*')
+    parser.add_argument('labels', help='directory of labels named <PID>_*')
+    parser.add_argument('store', help='.h5 file the rois are written to, appended to when it exists')
+    parser.add_argument('--codec', choices=CODECS, default='gzip')
+    parser.add_argument('--level', type=int, default=4, help='gzip level 0-9 (default: 4)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    labelManifest = manifest.build_label_manifest(args.scans, args.labels)
+    print(f'Label manifest: {labelManifest.summary()}')
+    write_pairs(labelManifest.matched, args.store, args.codec, args.level, args.workers)
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
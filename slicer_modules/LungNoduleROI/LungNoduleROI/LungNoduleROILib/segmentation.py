@@ -0,0 +1,136 @@
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+from LungNoduleROILib.inference import InferenceSession, load_model
+from LungNoduleROILib.intensity import load_window
+
+# sessions by weights file and options, only the most recently used model is kept in memory
+_sessions = {}
+
+
+# trained UNet ready for CPU inference, loaded once and reused until the weights file changes
+# the HU window saved next to the weights (intensity.window_path) is applied to every roi, as in training
+# inputs:
+# weightsPath -> UNet state dict, e.g. nov26_24.pth
+# features -> feature widths the UNet was trained with, read from the weights when not given
+# precision -> 'fp32' or 'bf16', see inference.InferenceSession
+# threads -> intra-op threads, defaulted to torch's setting
+def load_session(weightsPath, features=None, precision='fp32', threads=None, micro_batch=8):
+    window = load_window(weightsPath)
+    key = (os.path.abspath(weightsPath), os.stat(weightsPath).st_mtime_ns, tuple(features or ()), precision, threads,
+           micro_batch, repr(window))
+
+    if key not in _sessions:
+        _sessions.clear()
+        # eager so rois of any size can be segmented, a traced model is fixed to one input shape
+        _sessions[key] = InferenceSession(load_model(weightsPath, features), precision, backend='eager',
+                                          threads=threads, micro_batch=micro_batch, window=window)
+
+    return _sessions[key]
+
+
+# scale an roi the way the network was trained
+# window -> intensity.HUWindow of the model, used when given
+# intensityRange -> optional (min, max) of the training data for min-max scaling to [0, 1]
+# without either the roi is passed on in HU, nov26_24.pth was trained on unscaled rois
+def normalize_roi(roi, intensityRange=None, window=None):
+    if window is not None:
+        return window(np.asarray(roi))
+
+    roi = np.asarray(roi, dtype=np.float32)
+    if intensityRange is None:
+        return roi
+
+    vmin, vmax = intensityRange
+    return (roi - vmin) / max(float(vmax - vmin), 1e-6)
+
+
+# centered padding that grows a (D, H, W) shape to at least minShape and to a multiple of multiple
+def centered_padding(shape, minShape, multiple=1):
+    target = [-(-max(shape[i], minShape[i]) // multiple) * multiple for i in range(3)]
+    extra = [target[i] - shape[i] for i in range(3)]
+    return [(e // 2, e - e // 2) for e in extra]
+
+
+# binary nodule masks for a list of (D, H, W) rois, rois of the same shape share forward passes
+# rois smaller than the training roi size are padded with their minimum (air) and cropped back, like FitToSize does,
+# each pooling level of the UNet halves the roi so small rois would vanish before the bottleneck
+# rois are also padded to a size the UNet accepts, see UNet.check_input
+def segment_rois(session, rois, threshold=0.5, intensityRange=None, minShape=(40, 40, 40)):
+    masks = [None] * len(rois)
+
+    shapes = {}
+    for idx, roi in enumerate(rois):
+        shapes.setdefault(np.shape(roi), []).append(idx)
+
+    for shape, indices in shapes.items():
+        padding = centered_padding(shape, minShape, session.input_multiple)
+        scans = [normalize_roi(rois[idx], intensityRange, session.window) for idx in indices]
+        scans = np.stack([np.pad(scan, padding, constant_values=scan.min() if scan.size else 0) for scan in scans])
+
+        segmented = session.segment(torch.from_numpy(scans).unsqueeze(1), threshold)[:, 0].numpy().astype(np.uint8)
+        crop = tuple(slice(before, before + shape[i]) for i, (before, _) in enumerate(padding))
+        for idx, mask in zip(indices, segmented):
+            masks[idx] = mask[crop]
+
+    return masks
+
+
+def segment_roi(session, roi, threshold=0.5, intensityRange=None):
+    return segment_rois(session, [roi], threshold, intensityRange)[0]
+
+
+# path the segmentation of an exported roi is written to, <PID>_<noduleIdx>_roi.nrrd -> <PID>_<noduleIdx>_seg.nrrd
+def segmentation_path(roiPath):
+    if roiPath.endswith('_roi.nrrd'):
+        return roiPath[:-len('_roi.nrrd')] + '_seg.nrrd'
+    return os.path.splitext(roiPath)[0] + '_seg.nrrd'
+
+
+# segment exported roi files and write a labelmap with the same geometry next to each of them
+# inputs:
+# roiPaths -> roi files, e.g. the outputs of batch.run_batch
+# weightsPath, features, precision, threads -> see load_session
+# threshold -> probability threshold of the masks
+# intensityRange -> see normalize_roi
+# progress -> optional callable(roiPath, segmentationPath, done, total)
+# returns {roi path: segmentation path}, failed rois are reported and left out
+def segment_files(roiPaths, weightsPath, threshold=0.5, intensityRange=None, features=None,
+                  precision='fp32', threads=None, progress=None):
+    start = time.perf_counter()
+    session = load_session(weightsPath, features, precision, threads)
+    segmented = {}
+
+    for chunk_start in range(0, len(roiPaths), session.micro_batch):
+        chunk = roiPaths[chunk_start:chunk_start + session.micro_batch]
+
+        imgs = {}
+        for roiPath in chunk:
+            try:
+                imgs[roiPath] = sitk.ReadImage(str(roiPath))
+            except Exception as e:
+                print(f'Failed to read {roiPath}: {e}')
+
+        paths = list(imgs)
+        try:
+            masks = segment_rois(session, [sitk.GetArrayFromImage(imgs[path]) for path in paths], threshold,
+                                 intensityRange)
+        except Exception as e:
+            print(f'Failed to segment {", ".join(paths)}: {e}')
+            continue
+
+        for roiPath, mask in zip(paths, masks):
+            mask_img = sitk.GetImageFromArray(mask)
+            mask_img.CopyInformation(imgs[roiPath])
+            sitk.WriteImage(mask_img, segmentation_path(roiPath), useCompression=True)
+            segmented[roiPath] = segmentation_path(roiPath)
+            if progress:
+                progress(roiPath, segmented[roiPath], len(segmented), len(roiPaths))
+
+    print(f'{len(segmented)}/{len(roiPaths)} rois segmented in {time.perf_counter() - start:.1f}s')
+
+    return segmented
@@ -0,0 +1,118 @@
+import itertools
+import time
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+
+# start indices of the patches along one axis, the last patch is aligned with the end of the axis
+def patch_starts(size, patch, stride):
+    if size <= patch:
+        return [0]
+
+    starts = list(range(0, size - patch + 1, stride))
+    if starts[-1] != size - patch:
+        starts.append(size - patch)
+
+    return starts
+
+
+# weight map used to blend overlapping patches, highest in the patch center
+# inputs:
+# patch_size -> (D, H, W)
+# mode -> 'gaussian' or 'linear' (tent shaped), 'constant' averages overlaps evenly
+# sigma_scale -> gaussian sigma as a fraction of the patch size
+def blend_weights(patch_size, mode='gaussian', sigma_scale=1 / 8):
+    axes = []
+    for size in patch_size:
+        position = np.arange(size, dtype=np.float32) - (size - 1) / 2
+
+        if mode == 'gaussian':
+            sigma = max(size * sigma_scale, 1e-3)
+            axes.append(np.exp(-0.5 * (position / sigma) ** 2))
+        elif mode == 'linear':
+            axes.append(1 - np.abs(position) / (size / 2))
+        elif mode == 'constant':
+            axes.append(np.ones(size, dtype=np.float32))
+        else:
+            raise ValueError(f'Unknown blend mode {mode}')
+
+    weights = axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]
+    weights = weights / weights.max()
+
+    # keep the patch borders from dividing by zero where only one patch covers a voxel
+    return np.maximum(weights, 1e-3).astype(np.float32)
+
+
+# run a segmentation model over a whole volume patch by patch and blend the outputs
+# inputs:
+# model -> network mapping (N, 1, D, H, W) to (N, 1, D, H, W) logits, e.g. the 3D UNet
+# volume -> (D, H, W) numpy array, e.g. sitk.GetArrayFromImage(ct)
+# patch_size -> (D, H, W) of the patches fed to the model
+# stride -> step between patches, 0 < stride <= patch_size on every axis, smaller than patch_size for overlap
+# batch_size -> patches per forward pass
+# mode -> blend weighting, see blend_weights
+# normalize -> optional callable applied to the float32 volume before tiling
+# pad_value -> value used when the volume is smaller than a patch, defaulted to air (-1000 HU)
+# returns the (D, H, W) probability map and a dict with the patch count, seconds and patches/sec
+def sliding_window_inference(model, volume, patch_size=(40, 40, 40), stride=(20, 20, 20), batch_size=8,
+                             mode='gaussian', device='cpu', normalize=None, pad_value=-1000):
+    start = time.perf_counter()
+    patch_size = tuple(patch_size)
+    stride = tuple(stride)
+    shape = volume.shape
+
+    # a larger stride leaves voxels between patches that no patch covers, they would come out as 0 / 0 = nan
+    if len(stride) != 3 or len(patch_size) != 3:
+        raise ValueError(f'patch_size and stride need 3 values, got {patch_size} and {stride}')
+    if not all(0 < stride[i] <= patch_size[i] for i in range(3)):
+        raise ValueError(f'stride {stride} must be positive and at most patch_size {patch_size} on every axis')
+
+    # volumes smaller than a patch are padded and cropped back at the end
+    padding = [(0, max(patch_size[i] - shape[i], 0)) for i in range(3)]
+    volume = np.pad(volume, padding, mode='constant', constant_values=pad_value).astype(np.float32, copy=False)
+    if normalize is not None:
+        volume = normalize(volume)
+
+    padded_shape = volume.shape
+    volume = torch.from_numpy(np.ascontiguousarray(volume))
+
+    weights = torch.from_numpy(blend_weights(patch_size, mode))
+    output = torch.zeros(padded_shape, dtype=torch.float32)
+    weight_sum = torch.zeros(padded_shape, dtype=torch.float32)
+
+    starts = list(itertools.product(*[patch_starts(padded_shape[i], patch_size[i], stride[i]) for i in range(3)]))
+    slices = [tuple(slice(s[i], s[i] + patch_size[i]) for i in range(3)) for s in starts]
+
+    model.eval()
+    with torch.inference_mode():
+        for batch_start in range(0, len(slices), batch_size):
+            batch_slices = slices[batch_start:batch_start + batch_size]
+
+            patches = torch.stack([volume[s] for s in batch_slices]).unsqueeze(1).to(device)
+            probabilities = torch.sigmoid(model(patches).float())[:, 0].cpu()
+
+            for s, probability in zip(batch_slices, probabilities):
+                output[s] += probability * weights
+                weight_sum[s] += weights
+
+    output = (output / weight_sum)[:shape[0], :shape[1], :shape[2]].numpy()
+
+    seconds = time.perf_counter() - start
+    stats = {'patches': len(slices), 'seconds': seconds, 'patches_per_second': len(slices) / seconds}
+
+    return output, stats
+
+
+# whole-scan mode, segment a CT file and return the probability map with the CT geometry
+def segment_volume_file(model, path, **options):
+    img = sitk.ReadImage(str(path))
+    probabilities, stats = sliding_window_inference(model, sitk.GetArrayFromImage(img), **options)
+    print(f'{path}: {stats["patches"]} patches in {stats["seconds"]:.1f}s '
+          f'({stats["patches_per_second"]:.1f} patches/sec)')
+
+    probability_img = sitk.GetImageFromArray(probabilities)
+    probability_img.CopyInformation(img)
+
+    return probability_img, stats
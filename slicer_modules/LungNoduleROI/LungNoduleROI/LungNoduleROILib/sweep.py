@@ -0,0 +1,199 @@
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from LungNoduleROILib import losses
+from LungNoduleROILib.augment import BatchAugment, FitToSize
+from LungNoduleROILib.cache import ROICacheDataset
+from LungNoduleROILib.data import make_loader, to_device
+from LungNoduleROILib.metrics import segmentation_metrics
+from LungNoduleROILib.training import train
+from LungNoduleROILib.unet import UNet
+
+# loss functions a trial config can name
+LOSSES = {
+    'dice': losses.DiceLoss,
+    'tversky': losses.TverskyLoss,
+    'bce': nn.BCEWithLogitsLoss,
+    'iou': losses.IoULoss,
+    'dice_bce': losses.DiceBCELoss,
+    'focal_tversky': losses.FocalTverskyLoss,
+}
+
+# values used for anything a trial config leaves out
+DEFAULT_CONFIG = {'epochs': 50, 'lr': 1e-3, 'batch_size': 16, 'loss': 'dice', 'features': [64, 128, 256, 512],
+                  'patience': None, 'threshold': 0.5, 'seed': 0}
+
+
+# every combination of the given values, e.g. grid(lr=[1e-3, 1e-4], loss=['dice', 'bce'])
+def grid(**values):
+    names = list(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values.values())]
+
+
+# key of a trial in the results store, covers the config and the data split it was trained on
+def trial_key(config, data):
+    text = json.dumps({'config': config, 'data': data}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# directory of <key>.json files, one per finished trial
+# each trial is written to a temporary file and renamed so parallel writers never leave half a file behind
+class ResultStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key)) as file_obj:
+            return json.load(file_obj)
+
+    def put(self, key, result):
+        tmp = self.path(key) + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as file_obj:
+            json.dump(result, file_obj, indent=1)
+        os.replace(tmp, self.path(key))
+
+    def results(self):
+        rows = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.json'):
+                with open(os.path.join(self.directory, name)) as file_obj:
+                    rows.append(json.load(file_obj))
+        return rows
+
+
+# train and evaluate a freshly initialized UNet, runs inside a worker process
+# inputs:
+# config -> trial hyperparameters, see DEFAULT_CONFIG
+# data -> {'cache_dir', 'train_idx', 'val_idx', 'test_idx', optional 'normalize' and 'size'} of an roi cache,
+#         with a size the rois are cropped to it, randomly for training batches and centered for validation / test,
+#         normalize is passed to ROICacheDataset, e.g. intensity.HUWindow()
+# config['augment'] -> optional, train on batches augmented by augment.BatchAugment
+# config['norm'], config['checkpointing'] -> optional normalization and activation checkpointing of the UNet,
+#                                            left out of DEFAULT_CONFIG so earlier trials keep their keys
+# device -> device the trial trains on
+# checkpoint_dir -> optional directory the trial checkpoints to, an interrupted trial resumes from it
+def run_trial(config, data, device, checkpoint_dir=None):
+    config = {**DEFAULT_CONFIG, **config}
+    start = time.perf_counter()
+    torch.manual_seed(config['seed'])
+
+    normalize = data.get('normalize', False)
+    size = data.get('size')
+    evalTransform = FitToSize(size) if size is not None else None
+    train_data = ROICacheDataset(data['cache_dir'], data['train_idx'], normalize)
+    val_data = ROICacheDataset(data['cache_dir'], data['val_idx'], normalize, evalTransform)
+    test_data = ROICacheDataset(data['cache_dir'], data['test_idx'], normalize, evalTransform)
+
+    augment = None
+    if config.get('augment'):
+        augment = BatchAugment(crop_size=size, seed=config['seed'])
+    elif size is not None:
+        augment = BatchAugment(crop_size=size, flip=0, rot90=0, affine=0, seed=config['seed'])
+
+    # workers are already spread over processes, decode in the trial process itself
+    train_loader = make_loader(train_data, config['batch_size'], shuffle=True, device=device, num_workers=0)
+    val_loader = make_loader(val_data, config['batch_size'], shuffle=False, device=device, num_workers=0)
+    test_loader = make_loader(test_data, config['batch_size'], shuffle=False, device=device, num_workers=0)
+
+    device_type = torch.device(device).type
+    model = UNet(features=config['features'], norm=config.get('norm', 'batch'),
+                 checkpointing=config.get('checkpointing', False)).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=config['lr'])
+    scaler = torch.amp.GradScaler(device_type)
+    loss_function = LOSSES[config['loss']]()
+
+    train_loss_history, val_loss_history = train(model, train_loader, val_loader, optimizer, loss_function, scaler,
+                                                 config['epochs'], progress_bar=False, device=device,
+                                                 checkpoint_dir=checkpoint_dir, patience=config['patience'],
+                                                 augment=augment)
+
+    model.eval()
+    tables = []
+    with torch.no_grad():
+        for data_batch in test_loader:
+            scans, segs = to_device(data_batch, device)
+            tables.append(segmentation_metrics(model(scans), segs, thresholds=[config['threshold']],
+                                               from_logits=True, distances=False))
+
+    return {
+        'config': config,
+        'train_loss': train_loss_history,
+        'val_loss': val_loss_history,
+        'test_dice': float(pd.concat(tables)['dice'].mean()),
+        'seconds': time.perf_counter() - start,
+        'device': str(device),
+    }
+
+
+# run every trial not already in the store, several at a time
+# inputs:
+# configs -> list of trial configs, e.g. from grid(...)
+# data -> roi cache split shared by every trial, see run_trial
+# store_dir -> results directory, finished trials are skipped when a sweep is run again
+# workers -> trials run concurrently
+# devices -> devices handed out to trials round robin, e.g. ['cuda:0', 'cuda:1']
+# returns a DataFrame with one row per config
+def run_sweep(configs, data, store_dir, workers=1, devices=('cpu',)):
+    store = ResultStore(store_dir)
+    results = {}
+    pending = []
+    queued = set()
+
+    for config in configs:
+        key = trial_key({**DEFAULT_CONFIG, **config}, data)
+        result = store.get(key)
+        if result is not None:
+            results[key] = result
+        elif key not in queued:
+            queued.add(key)
+            pending.append((key, config))
+
+    print(f'{len(configs)} trials, {len(results)} already in {store_dir}, running {len(pending)}')
+
+    # spawn so cuda can be initialized inside the workers
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {}
+        for trial, (key, config) in enumerate(pending):
+            checkpoint_dir = os.path.join(store_dir, 'checkpoints', key)
+            future = executor.submit(run_trial, config, data, devices[trial % len(devices)], checkpoint_dir)
+            futures[future] = key
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f'Trial {key} failed: {e}')
+                continue
+
+            result['key'] = key
+            store.put(key, result)
+            results[key] = result
+            print(f'{result["config"]}: test dice {result["test_dice"]:.4f} ({result["seconds"]:.0f}s)')
+
+    rows = []
+    for config in configs:
+        result = results.get(trial_key({**DEFAULT_CONFIG, **config}, data))
+        if result is not None:
+            rows.append({**result['config'], 'test_dice': result['test_dice'],
+                         'final_train_loss': result['train_loss'][-1], 'final_val_loss': result['val_loss'][-1],
+                         'seconds': result['seconds']})
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,121 @@
+import torch
+from tqdm.auto import tqdm
+
+from LungNoduleROILib import checkpoint, instrument
+from LungNoduleROILib.data import to_device
+
+
+# checkpoint_dir -> optional directory for latest.pt (model, optimizer, scaler, rng, losses) and best.pt
+#                   (weights with the lowest validation loss), training resumes from latest.pt when it exists
+# checkpoint_every -> epochs between checkpoints
+# patience -> stop once the validation loss has not improved by min_delta for this many epochs
+# tracer -> optional instrument.Tracer, records data_wait / forward / backward / optimizer per step and
+#           validation / checkpoint per epoch
+# augment -> optional callable(scans, segs) applied to every training batch on the device, e.g. augment.BatchAugment
+# device -> full device the model trains on, e.g. 'cuda:1', autocast only needs its type
+def train(model, data_loader, val_loader, optimizer, loss_function, scaler, epochs, progress_bar, device="cuda",
+          checkpoint_dir=None, checkpoint_every=1, patience=None, min_delta=0.0, tracer=instrument.DISABLED,
+          augment=None):
+    train_loss_history = []
+    val_loss_history = []
+    history = {'train_loss': train_loss_history, 'val_loss': val_loss_history,
+               'best_val_loss': float('inf'), 'epochs_without_improvement': 0, 'stopped_early': False}
+    start_epoch = 0
+    
+    # Move the model to the specified device
+    model.to(device)
+    device_type = torch.device(device).type
+
+    # Pick up where a crashed or preempted run stopped
+    if checkpoint_dir is not None:
+        resumed = checkpoint.load_checkpoint(checkpoint_dir, model, optimizer, scaler, device)
+        if resumed is not None:
+            history.update(resumed['history'])
+            train_loss_history = history['train_loss']
+            val_loss_history = history['val_loss']
+            start_epoch = resumed['epoch'] + 1
+            print(f'Resuming from epoch {start_epoch} in {checkpoint_dir}')
+
+            if history['stopped_early']:
+                return train_loss_history, val_loss_history
+
+    # Set up the progress bar
+    if progress_bar:
+        epochs_range = tqdm(range(start_epoch, epochs), initial=start_epoch, total=epochs)
+    else:
+        epochs_range = range(start_epoch, epochs)
+
+    for epoch in epochs_range:
+        # Training loop
+        model.train()  # Set model to training mode
+        running_train_loss = 0.0
+        for idx, data in enumerate(tracer.iterate(data_loader, epoch=epoch)):
+            with tracer.stage('to_device', epoch=epoch, step=idx):
+                scans, segs = to_device(data, device)
+            if augment is not None:
+                with tracer.stage('augment', epoch=epoch, step=idx):
+                    scans, segs = augment(scans, segs)
+
+            # Forward pass with automatic mixed precision
+            with tracer.stage('forward', epoch=epoch, step=idx), torch.amp.autocast(device_type):
+                predictions = model(scans)
+                loss = loss_function(predictions, segs)
+
+            # Backward pass and optimizer step
+            optimizer.zero_grad()
+            with tracer.stage('backward', epoch=epoch, step=idx):
+                scaler.scale(loss).backward()
+            with tracer.stage('optimizer', epoch=epoch, step=idx):
+                scaler.step(optimizer)
+                scaler.update()
+
+            running_train_loss += loss.item()
+
+        avg_train_loss = running_train_loss / len(data_loader)
+        train_loss_history.append(avg_train_loss)
+
+        # Validation loop
+        model.eval()  # Set model to evaluation mode
+        running_val_loss = 0.0
+        with torch.no_grad(), tracer.stage('validation', epoch=epoch):
+            for idx, data in enumerate(val_loader):
+                scans, segs = to_device(data, device)
+
+                # Forward pass
+                with torch.amp.autocast(device_type):
+                    predictions = model(scans)
+                    val_loss = loss_function(predictions, segs)
+
+                running_val_loss += val_loss.item()
+
+        avg_val_loss = running_val_loss / len(val_loader)
+        val_loss_history.append(avg_val_loss)
+
+        # Keep the best model and count epochs without improvement for early stopping
+        if avg_val_loss < history['best_val_loss'] - min_delta:
+            history['best_val_loss'] = avg_val_loss
+            history['epochs_without_improvement'] = 0
+            if checkpoint_dir is not None:
+                checkpoint.save_best(checkpoint_dir, model)
+        else:
+            history['epochs_without_improvement'] += 1
+
+        stop = patience is not None and history['epochs_without_improvement'] >= patience
+        history['stopped_early'] = stop
+
+        if checkpoint_dir is not None and (stop or (epoch + 1) % checkpoint_every == 0 or epoch + 1 == epochs):
+            with tracer.stage('checkpoint', epoch=epoch):
+                checkpoint.save_checkpoint(checkpoint_dir, epoch, model, optimizer, scaler, history)
+        tracer.snapshot(epoch=epoch)
+
+        # Update progress bar with losses
+        if progress_bar:
+            epochs_range.set_description(
+                f"Epoch {epoch + 1}: Train Loss: {avg_train_loss:.4f}, Val Loss: {avg_val_loss:.4f}"
+            )
+
+        if stop:
+            print(f'Early stopping at epoch {epoch + 1}, best val loss {history["best_val_loss"]:.4f}')
+            break
+
+    return train_loss_history, val_loss_history
@@ -0,0 +1,71 @@
+import numpy as np
+import SimpleITK as sitk
+
+# slicer works in RAS, SimpleITK / ITK files in LPS, the two differ by the sign of x and y
+RAS_TO_LPS = np.array([-1.0, -1.0, 1.0])
+
+
+# origin, spacing and 3x3 direction matrix of a SimpleITK image, in LPS
+def geometry_from_image(img):
+    return (np.array(img.GetOrigin()), np.array(img.GetSpacing()),
+            np.array(img.GetDirection()).reshape(3, 3))
+
+
+# geometry of a volume on disk, read from the header only
+def geometry_from_file(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return (np.array(reader.GetOrigin()), np.array(reader.GetSpacing()),
+            np.array(reader.GetDirection()).reshape(3, 3))
+
+
+def ras_to_lps(points):
+    return np.asarray(points, dtype=np.float64) * RAS_TO_LPS
+
+
+def lps_to_ras(points):
+    return np.asarray(points, dtype=np.float64) * RAS_TO_LPS
+
+
+# convert many LPS physical points to voxel indices in one call
+# index = (direction * diag(spacing))^-1 * (point - origin), same as sitk TransformPhysicalPointToIndex
+# inputs:
+# points -> (N, 3) or (3,) physical points in LPS
+# geometry -> (origin, spacing, direction), see geometry_from_image / geometry_from_file
+# rounded -> round to the nearest voxel and return ints, otherwise continuous indices
+def physical_to_index(points, geometry, rounded=True):
+    origin, spacing, direction = geometry
+    points = np.asarray(points, dtype=np.float64)
+
+    physical_to_ijk = np.linalg.inv(direction * spacing)
+    indices = (points - origin) @ physical_to_ijk.T
+
+    if rounded:
+        return np.floor(indices + 0.5).astype(int)
+    return indices
+
+
+# convert many (continuous) voxel indices to LPS physical points in one call
+def index_to_physical(indices, geometry):
+    origin, spacing, direction = geometry
+    indices = np.asarray(indices, dtype=np.float64)
+
+    return indices @ (direction * spacing).T + origin
+
+
+# apply a 4x4 homogeneous matrix, e.g. slicer's GetRASToIJKMatrix, to (N, 3) or (3,) points
+def apply_matrix(matrix, points):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+# voxel indices of RAS points (slicer markups) given a volume's RAS to IJK matrix
+def ras_to_index(points, ras_to_ijk, rounded=True):
+    indices = apply_matrix(ras_to_ijk, points)
+
+    if rounded:
+        return np.floor(indices + 0.5).astype(int)
+    return indices
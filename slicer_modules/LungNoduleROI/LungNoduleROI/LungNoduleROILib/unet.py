@@ -0,0 +1,170 @@
+import json
+import os
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+# normalization layers a UNet can be built with
+NORMS = ('batch', 'instance', 'group', 'none')
+
+
+def norm_layer(norm, channels):
+    if norm == 'batch':
+        return nn.BatchNorm3d(channels)
+    if norm == 'instance':
+        return nn.InstanceNorm3d(channels, affine=True)
+    if norm == 'group':
+        # 8 channels per group, fewer groups for narrow layers
+        return nn.GroupNorm(max(1, channels // 8), channels)
+    if norm == 'none':
+        return nn.Identity()
+    raise ValueError(f'Unknown norm {norm}, use one of {NORMS}')
+
+
+class UNet(nn.Module):
+    def __init__(self,
+                 in_channels=1,
+                 out_channels=1,  # 1 for binary segmentation
+                 features=None,  # Number of feature maps for each layer, defaulted from depth and base_width
+                 depth=4,  # Number of poolings
+                 base_width=64,  # Feature maps of the first layer, doubled at every level
+                 norm='batch',  # Normalization after every convolution, see NORMS
+                 checkpointing=False,  # Recompute DoubleConv activations during backward instead of storing them
+                 resize_skips=True):  # Interpolate upsampled maps onto mismatching skips, False rejects such inputs up front
+        super(UNet, self).__init__()
+
+        if features is None:
+            features = [base_width * 2 ** level for level in range(depth)]
+        self.features = list(features)
+        self.in_channels = in_channels
+        self.norm = norm
+        self.resize_skips = resize_skips
+
+        self.downs = nn.ModuleList()  # Down convolutions
+        self.ups = nn.ModuleList()    # Up convolutions
+        self.pool = nn.MaxPool3d(kernel_size=2, stride=2)  # Max pooling for 3D
+
+        # down convolutions
+        for feature in features:
+            self.downs.append(DoubleConv(in_channels, feature, norm))
+            in_channels = feature  # Update in_channels for next layer
+
+        # bottleneck layer
+        self.bottleneck = DoubleConv(features[-1], features[-1] * 2, norm)
+
+        # up convolutions
+        for feature in reversed(features):
+            self.ups.append(nn.ConvTranspose3d(feature * 2, feature, kernel_size=2, stride=2))  # Transpose convolution
+            self.ups.append(DoubleConv(feature * 2, feature, norm))
+
+        # Final output layer (segmentation output)
+        self.final_conv = nn.Conv3d(features[0], out_channels, kernel_size=1)  # Output layer for segmentation
+
+        self.set_checkpointing(checkpointing)
+
+    # every pooling halves the roi, D, H and W must be divisible by this for the skips to line up
+    @property
+    def input_multiple(self):
+        return 2 ** len(self.downs)
+
+    # architecture of the UNet, enough to build it again for its state dict, see save_config
+    def config(self):
+        return {'in_channels': self.in_channels, 'out_channels': self.final_conv.out_channels,
+                'features': self.features, 'norm': self.norm}
+
+    def set_checkpointing(self, enabled):
+        self.checkpointing = enabled
+        for module in self.modules():
+            if isinstance(module, DoubleConv):
+                module.checkpointing = enabled
+
+    # reject inputs the UNet cannot reconstruct exactly, e.g. 40^3 rois at depth 4 (40 -> 20 -> 10 -> 5 -> 2)
+    # opt in with resize_skips=False, by default the skips are resized and every roi size the repo writes is accepted
+    def check_input(self, x):
+        if x.dim() != 5 or x.shape[1] != self.in_channels:
+            raise ValueError(f'UNet expects (N, {self.in_channels}, D, H, W) input, got {tuple(x.shape)}')
+
+        multiple = self.input_multiple
+        if not self.resize_skips and any(size % multiple for size in x.shape[2:]):
+            fitting = [-(-size // multiple) * multiple for size in x.shape[2:]]
+            raise ValueError(f'UNet of depth {len(self.downs)} needs D, H, W divisible by {multiple}, got '
+                             f'{tuple(x.shape[2:])}; crop / pad to {tuple(fitting)} or use a shallower UNet')
+
+    def forward(self, x):
+        self.check_input(x)
+        skip_connections = []
+
+        # Downward pass: encoding layers
+        for down in self.downs:
+            x = down(x)
+            skip_connections.append(x)
+            x = self.pool(x)
+
+        # Bottleneck (lowest part of U-Net)
+        x = self.bottleneck(x)
+
+        # Reverse the skip connections for upward pass
+        skip_connections = skip_connections[::-1]
+
+        # Upward pass: decoding layers
+        for idx in range(0, len(self.ups), 2):
+            x = self.ups[idx](x)  # Transpose convolution (upscale)
+            skip_connection = skip_connections[idx // 2]
+
+            # Only models built with resize_skips (the default) get here with mismatching sizes, see check_input
+            if x.shape != skip_connection.shape:
+                x = torch.nn.functional.interpolate(x, size=skip_connection.shape[2:])
+
+            # Concatenate skip connection with the upsampled feature map
+            x = torch.cat((skip_connection, x), dim=1)  # Concatenate along the channel dimension
+            x = self.ups[idx + 1](x)  # Apply the second double convolution
+        return self.final_conv(x)
+
+class DoubleConv(nn.Module):
+    def __init__(self, in_channels, out_channels, norm='batch'):
+        super(DoubleConv, self).__init__()
+        self.norm = norm
+        self.checkpointing = False
+        # convolutions before a normalization do not need a bias
+        bias = norm == 'none'
+        self.conv = nn.Sequential(
+            nn.Conv3d(in_channels, out_channels, 3, 1, 1, bias=bias),
+            norm_layer(norm, out_channels),
+            nn.ReLU(inplace=True),
+            nn.Conv3d(out_channels, out_channels, 3, 1, 1, bias=bias),
+            norm_layer(norm, out_channels),
+            nn.ReLU(inplace=True)
+        )
+
+    def forward(self, x):
+        # only the block input is kept for backward, the block is run again to get its activations
+        # batch norm running statistics are updated by the recomputation as well
+        if self.checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(self.conv, x, use_reentrant=False)
+        return self.conv(x)
+
+
+# architecture saved next to the weights of a model, nov26_24.pth -> nov26_24_unet.json
+# instance and group norm weights look the same in a state dict, the file tells them apart
+def config_path(weightsPath):
+    return os.path.splitext(weightsPath)[0] + '_unet.json'
+
+
+# write to a temporary file first so a crash while saving never leaves half a file behind
+def save_config(model, weightsPath):
+    path = config_path(weightsPath)
+    with open(path + '.tmp', 'w') as file_obj:
+        json.dump(model.config(), file_obj, indent=1)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+# architecture of the model the weights belong to, None for weights saved without one (e.g. nov26_24.pth)
+def load_config(weightsPath):
+    path = config_path(weightsPath)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file_obj:
+        return json.load(file_obj)
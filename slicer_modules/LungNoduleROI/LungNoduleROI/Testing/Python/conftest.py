@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# LungNoduleROILib is imported the way the module and mk3.ipynb do, from the module directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+
+# training pairs named like the exported rois, <PID>_<noduleIdx>_roi.nrrd / <PID>_<noduleIdx>_label.nrrd
+# five 40^3 pairs and one 44^3 pair, scans are random HU, labels a 0 / 255 cube around the center like slicer exports
+@pytest.fixture
+def roi_pairs(tmp_path):
+    import SimpleITK as sitk
+
+    rng = np.random.default_rng(0)
+    pairs = {}
+    for case, size in enumerate([40, 40, 40, 40, 40, 44]):
+        pid = f'{100 + case}_0'
+        scan = rng.integers(-1000, 400, size=(size,) * 3).astype(np.int16)
+        label = np.zeros((size,) * 3, dtype=np.uint8)
+        label[size // 2 - 4 - case:size // 2 + 4, size // 2 - 4:size // 2 + 4, size // 2 - 4:size // 2 + 4] = 255
+
+        scanPath = str(tmp_path / 'scans' / f'{pid}_roi.nrrd')
+        labelPath = str(tmp_path / 'labels' / f'{pid}_label.nrrd')
+        os.makedirs(os.path.dirname(scanPath), exist_ok=True)
+        os.makedirs(os.path.dirname(labelPath), exist_ok=True)
+        sitk.WriteImage(sitk.GetImageFromArray(scan), scanPath)
+        sitk.WriteImage(sitk.GetImageFromArray(label), labelPath)
+        pairs[pid] = (scanPath, labelPath)
+
+    return pairs
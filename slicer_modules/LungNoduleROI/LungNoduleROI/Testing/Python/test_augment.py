@@ -0,0 +1,99 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from LungNoduleROILib.augment import AugmentCollate, BatchAugment, FitToSize, crop_or_pad
+
+
+# (N, 1, D, H, W) random blob labels and scans holding 100 inside the labels, so a scan voxel tells its label
+def labelled_batch(n=6, shape=(12, 16, 16), seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    labels = (torch.rand((n, 1) + shape, generator=generator) > 0.7).float()
+    return labels * 100, labels
+
+
+# crops, flips and axial rotations move every scan voxel together with its label voxel
+@pytest.mark.parametrize('crop_size', [None, (8, 10, 12), (14, 16, 18)])
+def test_exact_transforms_keep_labels_aligned(crop_size):
+    scans, labels = labelled_batch()
+    augment = BatchAugment(crop_size=crop_size, flip=0.5, rot90=1.0, affine=0.0, seed=3)
+
+    augmentedScans, augmentedLabels = augment(scans, labels)
+
+    assert augmentedScans.shape == augmentedLabels.shape
+    assert augmentedScans.shape[2:] == (crop_size or scans.shape[2:])
+    torch.testing.assert_close(augmentedScans, augmentedLabels * 100)
+    # every sample is transformed on its own, the batch is not mixed up
+    assert not torch.equal(augmentedLabels, augmentedLabels[[1, 0, 2, 3, 4, 5]])
+
+
+# the affine transform interpolates scans and labels with the same grid, labels are binarized again
+def test_affine_keeps_labels_aligned():
+    labels = torch.zeros(4, 1, 16, 16, 16)
+    labels[:, :, 4:12, 5:11, 6:10] = 1
+    augment = BatchAugment(flip=0.0, rot90=0.0, affine=1.0, max_angle=20, seed=1)
+
+    scans, augmentedLabels = augment(labels * 100, labels)
+
+    assert set(augmentedLabels.unique().tolist()) <= {0.0, 1.0}
+    assert not torch.equal(augmentedLabels, labels)
+    agreement = ((scans >= 50) == (augmentedLabels > 0)).float().mean()
+    assert agreement > 0.99
+
+
+def test_nothing_picked_is_bit_exact():
+    scans, labels = labelled_batch()
+
+    augmentedScans, augmentedLabels = BatchAugment(flip=0.0, rot90=0.0, affine=0.0)(scans, labels)
+
+    assert torch.equal(augmentedScans, scans) and torch.equal(augmentedLabels, labels)
+
+
+def test_intensity_jitter_leaves_labels():
+    scans, labels = labelled_batch()
+    augment = BatchAugment(flip=0.0, rot90=0.0, affine=0.0, intensity_shift=50, intensity_scale=0.1, noise=1.0)
+
+    augmentedScans, augmentedLabels = augment(scans, labels)
+
+    assert torch.equal(augmentedLabels, labels)
+    assert not torch.equal(augmentedScans, scans)
+
+
+def test_seeded_runs_repeat():
+    scans, labels = labelled_batch()
+
+    first = BatchAugment(crop_size=(8, 8, 8), affine=0.5, seed=7)(scans, labels)
+    second = BatchAugment(crop_size=(8, 8, 8), affine=0.5, seed=7)(scans, labels)
+    other = BatchAugment(crop_size=(8, 8, 8), affine=0.5, seed=8)(scans, labels)
+
+    assert all(torch.equal(a, b) for a, b in zip(first, second))
+    assert not torch.equal(first[0], other[0])
+
+
+def test_fit_to_size_pads_with_air():
+    scan = torch.full((1, 6, 10, 10), -1000.0)
+    scan[:, :, 4:6, 4:6] = 40
+    label = (scan > 0).float()
+
+    fitted, fittedLabel = FitToSize((8, 8, 8))(scan, label)
+
+    assert fitted.shape == fittedLabel.shape == (1, 8, 8, 8)
+    assert fitted.min() == -1000 and fittedLabel.sum() == label.sum()
+    torch.testing.assert_close(crop_or_pad(fitted, (6, 10, 10), pad_value=-1000.0), scan)
+
+
+# rois of several sizes are fitted per sample and augmented as whole batches inside the workers
+def test_augment_collate_in_workers():
+    samples = []
+    for idx, shape in enumerate([(10, 12, 12), (14, 16, 16), (12, 12, 12), (16, 20, 20)]):
+        scans, labels = labelled_batch(1, shape, seed=idx)
+        samples.append(FitToSize((12, 12, 12))(scans[0], labels[0]))
+    collate = AugmentCollate(BatchAugment(crop_size=(8, 8, 8), affine=0.0))
+
+    loader = DataLoader(samples, batch_size=2, num_workers=2, collate_fn=collate)
+    batches = list(loader)
+
+    assert len(batches) == 2
+    for scans, labels in batches:
+        assert scans.shape == (2, 1, 8, 8, 8)
+        torch.testing.assert_close(scans, labels * 100)
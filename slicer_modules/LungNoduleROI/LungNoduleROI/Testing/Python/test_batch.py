@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from LungNoduleROILib import batch
+from LungNoduleROILib.roi import ImageROI
+
+
+# three 20 x 24 x 28 CT volumes whose voxels hold their own flat index, 100 and 101 have a nodule row each,
+# 102 has two nodules and 103 a row without a volume
+@pytest.fixture
+def export_inputs(tmp_path):
+    volumeDir = tmp_path / 'volumes'
+    volumeDir.mkdir()
+    for pid in (100, 101, 102):
+        volume = (np.arange(20 * 24 * 28, dtype=np.int32).reshape(20, 24, 28) % 3000 - 1000).astype(np.int16)
+        sitk.WriteImage(sitk.GetImageFromArray(volume + pid), str(volumeDir / f'{pid}_CT.nrrd'))
+
+    csvPath = tmp_path / 'centroids.csv'
+    csvPath.write_text('100,10,12,8,8\n101,2,3,4,6\n102,5,5,5,4\n102,20,20,15,8\n103,1,1,1,4\n')
+
+    return str(volumeDir), str(csvPath), str(tmp_path / 'rois')
+
+
+def read_roi(path):
+    return sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+
+# rows cut short or with empty columns are reported like rows without a volume instead of raising
+def test_collect_cases_reports_incomplete_rows(export_inputs, tmp_path):
+    volumeDir, csvPath, outputDir = export_inputs
+    shortCsv = tmp_path / 'short.csv'
+    shortCsv.write_text('100,10,12,8\n101,2,3,4,6\n\n102,5,,5,4\n102,20,20,15,8\n')
+
+    cases, unmatched = batch.collect_cases(volumeDir, str(shortCsv))
+
+    assert [case.name for case in cases] == ['101_0', '102_1']
+    assert sorted(unmatched) == [('100_0', 'incomplete csv row'), ('102_0', 'incomplete csv row')]
+
+
+def test_run_batch_exports_every_nodule(export_inputs):
+    volumeDir, csvPath, outputDir = export_inputs
+    cases, unmatched = batch.collect_cases(volumeDir, csvPath)
+
+    results = batch.run_batch(cases, outputDir, workers=1)
+
+    assert unmatched == [('103_0', 'no volume')]
+    assert sorted(result.PID for result in results) == ['100_0', '101_0', '102_0', '102_1']
+    assert all(result.success for result in results)
+
+    # both nodules of 102 are cut from one decode of the volume, the single nodules are read from the file window,
+    # every path gives the same roi as a crop of the full array
+    for case in cases:
+        volume = read_roi(case.volumePath)
+        expected = ImageROI().create_roi_image_from_array(volume, case.roi_size(), case.centroid())
+        np.testing.assert_array_equal(read_roi(os.path.join(outputDir, case.name + '_roi.nrrd')), expected)
+
+
+# the nodules of a volume are cut from one decode, not one read per nodule
+def test_export_volume_reads_a_volume_once(export_inputs, monkeypatch):
+    volumeDir, csvPath, outputDir = export_inputs
+    cases, unmatched = batch.collect_cases(volumeDir, csvPath)
+    group = [case for case in cases if case.PID == '102']
+    os.makedirs(outputDir)
+
+    reads = []
+    readImage = sitk.ReadImage
+
+    def counting_read(*args, **kwargs):
+        reads.append(args[0])
+        return readImage(*args, **kwargs)
+
+    monkeypatch.setattr(sitk, 'ReadImage', counting_read)
+    results = batch.export_volume(group, outputDir)
+
+    assert reads == [group[0].volumePath]
+    assert [result.PID for result in results] == ['102_0', '102_1']
+    assert all(result.success for result in results)
+
+
+def test_run_batch_is_incremental(export_inputs):
+    volumeDir, csvPath, outputDir = export_inputs
+    cases, unmatched = batch.collect_cases(volumeDir, csvPath)
+    batch.run_batch(cases, outputDir, workers=1, incremental=True)
+
+    results = batch.run_batch(cases, outputDir, workers=1, incremental=True)
+    assert all(result.skipped for result in results)
+
+    # a moved centroid and a deleted roi are exported again, the rest stays up to date
+    cases[0].centroidS = '11'
+    os.remove(os.path.join(outputDir, '101_0_roi.nrrd'))
+    plan = batch.plan_batch(cases, outputDir)
+    assert {case.name: reason for case, inputs, reason in plan} == {
+        '100_0': 'centroid, size or spacing changed', '101_0': 'output missing', '102_0': None, '102_1': None}
+
+    results = batch.run_batch(cases, outputDir, workers=1, incremental=True)
+    assert sorted(result.PID for result in results if not result.skipped) == ['100_0', '101_0']
+    assert len(batch.load_export_manifest(outputDir)) == 4
+
+
+def test_run_batch_retries_failed_cases(export_inputs):
+    volumeDir, csvPath, outputDir = export_inputs
+    cases, unmatched = batch.collect_cases(volumeDir, csvPath)
+    cases[1].size = 'large'
+
+    results = batch.run_batch(cases, outputDir, workers=1, incremental=True)
+    failed = [result for result in results if not result.success]
+    assert [result.PID for result in failed] == ['101_0']
+    assert batch.load_export_manifest(outputDir)['101_0']['success'] is False
+
+    cases[1].size = '6'
+    results = batch.run_batch(cases, outputDir, workers=1, incremental=True)
+    assert [result.PID for result in results if not result.skipped] == ['101_0']
+    assert all(result.success for result in results)
+
+
+# stands in for export_volume in a worker that is killed, e.g. out of memory
+def die_in_worker(cases, outputDir, **options):
+    os._exit(1)
+
+
+def test_run_batch_records_a_broken_pool(export_inputs, monkeypatch):
+    volumeDir, csvPath, outputDir = export_inputs
+    cases, unmatched = batch.collect_cases(volumeDir, csvPath)
+    monkeypatch.setattr(batch, 'export_volume', die_in_worker)
+
+    results = batch.run_batch(cases, outputDir, workers=2, incremental=True)
+
+    assert sorted(result.PID for result in results) == ['100_0', '101_0', '102_0', '102_1']
+    assert not any(result.success for result in results)
+    assert all('BrokenProcessPool' in result.error for result in results)
+    assert all(not entry['success'] for entry in batch.load_export_manifest(outputDir).values())
+
+
+def test_batch_arguments_run_main(export_inputs, tmp_path):
+    volumeDir, csvPath, outputDir = export_inputs
+    reportPath = str(tmp_path / 'report.csv')
+
+    arguments = batch.batch_arguments(volumeDir, csvPath, outputDir, workers=1, spacing=[1, 1, 2],
+                                      incremental=False, reportPath=reportPath)
+
+    assert arguments[:5] == [volumeDir, csvPath, outputDir, '--centroid-space', 'index']
+    assert arguments[arguments.index('--spacing') + 1] == '1.0,1.0,2.0'
+    assert '--force' in arguments
+    assert batch.main(arguments) == 0
+    assert len(batch.load_export_manifest(outputDir)) == 4
+    assert os.path.exists(os.path.join(outputDir, 'resampled'))
+    assert '103_0' in open(reportPath).read()
+
+
+# a line cut short by a crash is ignored, the compacted journal keeps the last line of every case
+def test_export_manifest_survives_a_torn_line(export_inputs):
+    volumeDir, csvPath, outputDir = export_inputs
+    cases, unmatched = batch.collect_cases(volumeDir, csvPath)
+    batch.run_batch(cases, outputDir, workers=1, incremental=True)
+
+    with open(batch.export_manifest_path(outputDir), 'a') as file_obj:
+        file_obj.write('{"name": "100_0", "succ')
+
+    entries = batch.load_export_manifest(outputDir)
+    assert sorted(entries) == ['100_0', '101_0', '102_0', '102_1']
+    assert all(result.skipped for result in batch.run_batch(cases, outputDir, workers=1, incremental=True))
+    with open(batch.export_manifest_path(outputDir)) as file_obj:
+        assert len(file_obj.readlines()) == 4
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from LungNoduleROILib import benchmark
+
+# a few cases per benchmark so the harness itself runs in seconds
+TINY = {
+    'volumes': [(16, 32, 32)],
+    'rois': [8],
+    'manifest_cases': [20],
+    'loader_cases': 4,
+    'loader_workers': [0],
+    'loader_batches': [2],
+}
+
+
+@pytest.fixture
+def tiny_sizes(monkeypatch):
+    monkeypatch.setitem(benchmark.SIZES, 'tiny', TINY)
+    return 'tiny'
+
+
+def test_measure_counts_only_timed_calls():
+    calls = []
+    timing = benchmark.measure(lambda: calls.append(1), repeats=3, warmup=2)
+
+    assert len(calls) == 5
+    assert timing['repeats'] == 3
+    assert 0 <= timing['min_s'] <= timing['median_s']
+
+
+def test_run_benchmarks(tiny_sizes):
+    report = benchmark.run_benchmarks(['roi', 'manifest', 'decode', 'loader'], tiny_sizes, repeats=1)
+
+    assert report['meta']['version'] == benchmark.BENCHMARK_VERSION
+    assert report['meta']['size'] == 'tiny'
+    names = {(result['benchmark'], result['name']) for result in report['results']}
+    assert ('roi', 'create_roi_image_from_file') in names
+    assert ('manifest', 'build_case_manifest') in names
+    assert ('decode', 'ct.nii.gz') in names
+    assert ('loader', 'roi_cache') in names and ('loader', 'roi_files') in names
+    assert all(result['median_s'] > 0 for result in report['results'])
+
+
+def test_run_benchmarks_unknown_name(tiny_sizes):
+    with pytest.raises(ValueError, match='Unknown benchmark'):
+        benchmark.run_benchmarks(['nope'], tiny_sizes, repeats=1)
+
+
+def test_compare_matches_cases():
+    def result(case, seconds):
+        return {'benchmark': 'roi', 'name': 'create_roi_image', 'case': case, 'median_s': seconds}
+
+    baseline = {'results': [result({'roi': 20}, 1.0), result({'roi': 40}, 2.0)]}
+    current = {'results': [result({'roi': 40}, 3.0), result({'roi': 64}, 1.0)]}
+
+    rows = benchmark.compare(baseline, current)
+
+    assert rows == [('roi', 'create_roi_image', {'roi': 40}, 2.0, 3.0, 1.5)]
+
+
+def test_main_fails_on_regression(tmp_path, tiny_sizes, monkeypatch):
+    fast = {'meta': {'commit': 'abc'}, 'results': [
+        {'benchmark': 'manifest', 'name': 'index_csv', 'case': {'cases': 20}, 'median_s': 1.0}]}
+    slow = {'meta': {'commit': 'def'}, 'results': [
+        {'benchmark': 'manifest', 'name': 'index_csv', 'case': {'cases': 20}, 'median_s': 1.5}]}
+    baselinePath = tmp_path / 'baseline.json'
+    baselinePath.write_text(json.dumps(fast))
+    outputPath = tmp_path / 'current.json'
+
+    monkeypatch.setattr(benchmark, 'run_benchmarks', lambda *args: slow)
+    assert benchmark.main([str(outputPath), '--compare', str(baselinePath)]) == 1
+    assert json.loads(outputPath.read_text())['results'] == slow['results']
+
+    assert benchmark.main([str(outputPath), '--compare', str(baselinePath), '--tolerance', '0.6']) == 0
@@ -0,0 +1,79 @@
+import os
+import pickle
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+from LungNoduleROILib.cache import ROICacheDataset, build_roi_cache
+
+
+def test_cache_rows_match_the_files(roi_pairs, tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    index = build_roi_cache(roi_pairs, cacheDir)
+
+    # the 44^3 pair is skipped without fit
+    assert [entry['pid'] for entry in index['entries']] == sorted(roi_pairs)[:5]
+    assert [entry['pid'] for entry in index['skipped']] == ['105_0']
+
+    dataset = ROICacheDataset(cacheDir, normalize=False)
+    for row, pid in enumerate(dataset.pids):
+        scan, label = dataset[row]
+        scanPath, labelPath = roi_pairs[pid]
+        np.testing.assert_array_equal(scan[0].numpy(), sitk.GetArrayFromImage(sitk.ReadImage(scanPath)))
+        np.testing.assert_array_equal(label[0].numpy(), sitk.GetArrayFromImage(sitk.ReadImage(labelPath)) > 0)
+
+
+def test_fit_keeps_rois_of_other_sizes(roi_pairs, tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    index = build_roi_cache(roi_pairs, cacheDir, fit=True)
+
+    assert len(index['entries']) == 6
+    assert index['entries'][-1]['original_shape'] == [44, 44, 44]
+    scan, label = ROICacheDataset(cacheDir, [5], normalize=False)[0]
+    full = sitk.GetArrayFromImage(sitk.ReadImage(roi_pairs['105_0'][0]))
+    np.testing.assert_array_equal(scan[0].numpy(), full[2:42, 2:42, 2:42])
+
+
+def test_unchanged_rows_are_reused(roi_pairs, tmp_path, capsys):
+    cacheDir = str(tmp_path / 'cache')
+    build_roi_cache(roi_pairs, cacheDir)
+    before = np.load(os.path.join(cacheDir, 'scans.npy'))
+
+    build_roi_cache(roi_pairs, cacheDir)
+    assert 'up to date' in capsys.readouterr().out
+
+    # replace one scan, only that row is decoded again
+    scanPath = roi_pairs['101_0'][0]
+    sitk.WriteImage(sitk.GetImageFromArray(np.full((40, 40, 40), 7, dtype=np.int16)), scanPath)
+    build_roi_cache(roi_pairs, cacheDir)
+    assert '4 reused, 1 decoded' in capsys.readouterr().out
+
+    after = np.load(os.path.join(cacheDir, 'scans.npy'))
+    assert (after[1] == 7).all()
+    np.testing.assert_array_equal(np.delete(after, 1, axis=0), np.delete(before, 1, axis=0))
+
+
+# spawned DataLoader workers get the dataset pickled, only the paths may travel, never the arrays
+def test_dataset_pickles_without_the_arrays(roi_pairs, tmp_path):
+    cacheDir = str(tmp_path / 'cache')
+    build_roi_cache(roi_pairs, cacheDir)
+    dataset = ROICacheDataset(cacheDir, [0, 2], normalize=False)
+    expected = dataset[1]
+
+    payload = pickle.dumps(dataset)
+    assert len(payload) < 40 ** 3
+
+    copy = pickle.loads(payload)
+    for tensor, value in zip(copy[1], expected):
+        torch.testing.assert_close(tensor, value)
+
+
+def test_min_max_normalization_of_a_constant_cache(roi_pairs, tmp_path):
+    for scanPath, labelPath in roi_pairs.values():
+        sitk.WriteImage(sitk.GetImageFromArray(np.full((40, 40, 40), -1000, dtype=np.int16)), scanPath)
+    cacheDir = str(tmp_path / 'cache')
+    build_roi_cache(roi_pairs, cacheDir)
+
+    scan, _ = ROICacheDataset(cacheDir, normalize=True)[0]
+    assert torch.isfinite(scan).all()
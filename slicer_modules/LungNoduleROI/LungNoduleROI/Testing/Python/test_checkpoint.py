@@ -0,0 +1,92 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from LungNoduleROILib import checkpoint
+
+
+def training_state(seed=0):
+    torch.manual_seed(seed)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 1))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+    scaler = torch.amp.GradScaler('cpu', enabled=False)
+    return model, optimizer, scaler
+
+
+def step(model, optimizer):
+    optimizer.zero_grad()
+    loss = model(torch.randn(16, 4)).square().mean()
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+# draws of every generator a resumed run depends on, e.g. shuffling, augmentation and dropout
+def draws():
+    return random.random(), np.random.rand(), torch.rand(1).item()
+
+
+def test_load_without_checkpoint(tmp_path):
+    assert checkpoint.load_checkpoint(str(tmp_path / 'missing'), *training_state()) is None
+
+
+def test_resume_continues_like_an_uninterrupted_run(tmp_path):
+    model, optimizer, scaler = training_state()
+    for epoch in range(3):
+        step(model, optimizer)
+    checkpoint.save_checkpoint(str(tmp_path), 2, model, optimizer, scaler, {'loss': [1.0, 0.5, 0.25]})
+
+    expected_draws = draws()
+    expected_losses = [step(model, optimizer) for epoch in range(2)]
+    expected_weights = {name: value.clone() for name, value in model.state_dict().items()}
+
+    # fresh process state, different weights and generators
+    resumed_model, resumed_optimizer, resumed_scaler = training_state(seed=1)
+    random.seed(1)
+    np.random.seed(1)
+    state = checkpoint.load_checkpoint(str(tmp_path), resumed_model, resumed_optimizer, resumed_scaler)
+
+    assert state['epoch'] == 2
+    assert state['history'] == {'loss': [1.0, 0.5, 0.25]}
+    assert draws() == expected_draws
+    assert [step(resumed_model, resumed_optimizer) for epoch in range(2)] == expected_losses
+    for name, value in resumed_model.state_dict().items():
+        torch.testing.assert_close(value, expected_weights[name])
+
+
+# the checkpoint is read onto the training device, set_rng_state only accepts cpu ByteTensors
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_load_onto_device_keeps_rng_on_the_cpu(tmp_path, monkeypatch, device):
+    model, optimizer, scaler = training_state()
+    checkpoint.save_checkpoint(str(tmp_path), 0, model, optimizer, scaler, {})
+
+    locations = []
+    load = torch.load
+
+    def spy_load(*args, **kwargs):
+        locations.append(kwargs['map_location'])
+        return load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, 'load', spy_load)
+    model.to(device)
+    state = checkpoint.load_checkpoint(str(tmp_path), model, optimizer, scaler, device=device)
+
+    assert locations == [device]
+    assert state['model']['0.weight'].device.type == device
+    assert state['rng']['torch'].device.type == 'cpu'
+    assert state['rng']['torch'].dtype == torch.uint8
+
+
+def test_save_best(tmp_path):
+    model, _, _ = training_state()
+    checkpoint.save_best(str(tmp_path), model)
+
+    restored, _, _ = training_state(seed=1)
+    restored.load_state_dict(torch.load(checkpoint.best_path(str(tmp_path))))
+    for name, value in restored.state_dict().items():
+        torch.testing.assert_close(value, model.state_dict()[name])
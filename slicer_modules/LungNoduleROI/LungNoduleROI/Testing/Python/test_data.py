@@ -0,0 +1,64 @@
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+from LungNoduleROILib.data import ROIFileDataset, header_shape, make_loader, to_device
+
+
+def test_header_shape(roi_pairs):
+    scan, label = roi_pairs['105_0']
+
+    assert header_shape(scan) == (44, 44, 44)
+
+
+def test_dataset_decodes_pairs(roi_pairs):
+    dataset = ROIFileDataset(roi_pairs, normalize=lambda scan: scan / 1000)
+
+    assert dataset.pids == sorted(roi_pairs)
+    scan, label = dataset[0]
+    expected = sitk.GetArrayFromImage(sitk.ReadImage(roi_pairs['100_0'][0])) / 1000
+
+    assert scan.shape == label.shape == (1, 40, 40, 40)
+    assert scan.dtype == label.dtype == torch.float32
+    np.testing.assert_allclose(scan[0].numpy(), expected, rtol=1e-6)
+    # 0 / 255 labels come out as 0 / 1
+    assert set(label.unique().tolist()) == {0.0, 1.0}
+
+
+# pairs of another size are dropped from their headers, before anything is decoded
+def test_dataset_desired_size(roi_pairs):
+    dataset = ROIFileDataset(roi_pairs, desired_size=(40, 40, 40))
+
+    assert '105_0' not in dataset.pids
+    assert len(dataset) == 5
+
+
+def test_dataset_transform(roi_pairs):
+    dataset = ROIFileDataset(roi_pairs, desired_size=(40, 40, 40),
+                             transform=lambda scan, label: (scan.flip(-1), label.flip(-1)))
+    plain = ROIFileDataset(roi_pairs, desired_size=(40, 40, 40))
+
+    scan, label = dataset[1]
+    torch.testing.assert_close(scan, plain[1][0].flip(-1))
+    torch.testing.assert_close(label, plain[1][1].flip(-1))
+
+
+# worker processes give the same batches as decoding in the main process
+def test_loader_workers_match_main_process(roi_pairs):
+    dataset = ROIFileDataset(roi_pairs, desired_size=(40, 40, 40))
+
+    batches = [list(make_loader(dataset, 2, shuffle=False, device='cpu', num_workers=workers))
+               for workers in (0, 2)]
+
+    assert [scan.shape[0] for scan, label in batches[0]] == [2, 2, 1]
+    for (scan, label), (workerScan, workerLabel) in zip(*batches):
+        torch.testing.assert_close(scan, workerScan)
+        torch.testing.assert_close(label, workerLabel)
+
+
+def test_loader_pins_only_for_cuda(roi_pairs):
+    dataset = ROIFileDataset(roi_pairs)
+
+    assert not make_loader(dataset, 2, shuffle=True, device='cpu', num_workers=0).pin_memory
+    assert make_loader(dataset, 2, shuffle=True, device='cuda', num_workers=0).pin_memory
+    assert all(tensor.device.type == 'cpu' for tensor in to_device(dataset[0], 'cpu'))
@@ -0,0 +1,119 @@
+import pytest
+import torch
+
+from LungNoduleROILib import checkpoint, inference
+from LungNoduleROILib.unet import UNet, config_path, save_config
+
+SHAPE = (1, 1, 16, 16, 16)
+
+
+# small eval mode UNet whose batch norms hold running statistics of a few training batches
+def trained_unet(norm='batch'):
+    torch.manual_seed(0)
+    model = UNet(features=[4, 8], norm=norm)
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.randn(4, 1, 16, 16, 16))
+    return model.eval()
+
+
+# every optimized session has to agree with the fp32 eager model it was built from
+@pytest.mark.parametrize('precision, backend, tolerance', [
+    ('fp32', 'eager', 1e-5),
+    ('fp32', 'torchscript', 1e-5),
+    ('bf16', 'eager', 2e-2),
+    ('int8', 'eager', 5e-2),
+    ('int8', 'torchscript', 5e-2),
+])
+def test_session_parity(precision, backend, tolerance):
+    model = trained_unet()
+    torch.manual_seed(1)
+    calibration = torch.randn(16, *SHAPE[1:])
+
+    session = inference.InferenceSession(model, precision, backend, micro_batch=4, calibration=calibration,
+                                         example_shape=SHAPE)
+    table, summary = inference.dice_parity(model, session, torch.randn(6, *SHAPE[1:]))
+
+    assert len(table) == 6
+    assert summary['max_probability_difference'] < tolerance
+    assert summary['passed']
+
+
+def test_onnx_parity(tmp_path):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    model = trained_unet()
+    weightsPath = str(tmp_path / 'unet.pth')
+
+    session = inference.InferenceSession(model, backend='onnx', example_shape=SHAPE,
+                                         onnx_path=inference.onnx_path_for(weightsPath))
+    _, summary = inference.dice_parity(model, session, torch.randn(3, *SHAPE[1:]))
+
+    assert (tmp_path / 'unet.onnx').exists()
+    assert summary['max_probability_difference'] < 1e-4
+
+
+def test_saved_torchscript_session(tmp_path):
+    model = trained_unet()
+    session = inference.InferenceSession(model, example_shape=SHAPE)
+    path = str(tmp_path / 'unet.pt')
+    session.save(path)
+
+    scans = torch.randn(2, *SHAPE[1:])
+    with torch.inference_mode():
+        torch.testing.assert_close(torch.jit.load(path)(scans), model(scans), atol=1e-5, rtol=1e-4)
+
+
+def test_session_restores_threads():
+    threads = torch.get_num_threads()
+    session = inference.InferenceSession(trained_unet(), backend='eager', threads=threads + 1)
+
+    session.logits(torch.zeros(SHAPE))
+
+    assert torch.get_num_threads() == threads
+
+
+def test_session_rejects_bad_options():
+    model = trained_unet()
+    with pytest.raises(ValueError, match='calibration'):
+        inference.InferenceSession(model, precision='int8')
+    with pytest.raises(ValueError, match='onnx_path'):
+        inference.InferenceSession(model, backend='onnx')
+    with pytest.raises(ValueError, match='fp32'):
+        inference.InferenceSession(model, precision='bf16', backend='onnx')
+
+
+def test_state_dict_norm():
+    assert inference.state_dict_norm(trained_unet('batch').state_dict()) == 'batch'
+    assert inference.state_dict_norm(trained_unet('none').state_dict()) == 'none'
+    # group and instance norm weights have the same names and shapes
+    for norm in ('group', 'instance'):
+        with pytest.raises(ValueError, match='norm='):
+            inference.state_dict_norm(trained_unet(norm).state_dict())
+
+
+@pytest.mark.parametrize('norm', ['group', 'instance'])
+def test_load_model_norm(tmp_path, norm):
+    model = trained_unet(norm)
+    weightsPath = str(tmp_path / 'unet.pth')
+    torch.save(model.state_dict(), weightsPath)
+    scans = torch.randn(2, *SHAPE[1:])
+
+    with pytest.raises(ValueError, match='norm='):
+        inference.load_model(weightsPath)
+    assert inference.load_model(weightsPath, norm=norm).norm == norm
+
+    # the config saved next to the weights builds the same model without arguments
+    assert save_config(model, weightsPath) == config_path(weightsPath) == str(tmp_path / 'unet_unet.json')
+    loaded = inference.load_model(weightsPath)
+    assert loaded.norm == norm and loaded.features == [4, 8]
+    with torch.inference_mode():
+        torch.testing.assert_close(loaded(scans), model(scans))
+
+
+def test_save_best_writes_the_config(tmp_path):
+    model = trained_unet('group')
+
+    checkpoint.save_best(str(tmp_path), model)
+
+    assert inference.load_model(checkpoint.best_path(str(tmp_path))).norm == 'group'
@@ -0,0 +1,95 @@
+import csv
+import json
+
+import pytest
+
+from LungNoduleROILib import instrument
+
+
+def test_stages_are_recorded_with_tags():
+    tracer = instrument.Tracer()
+
+    with tracer.stage('load', case='100_0'):
+        pass
+    with pytest.raises(RuntimeError):
+        with tracer.stage('cut', case='100_0'):
+            raise RuntimeError('cut failed')
+
+    # a stage that raises is still recorded, the error is not swallowed
+    assert [record['stage'] for record in tracer.records] == ['load', 'cut']
+    assert all(record['tags'] == {'case': '100_0'} for record in tracer.records)
+    assert all(record['seconds'] >= 0 and record['start'] >= 0 for record in tracer.records)
+
+
+def test_timed_and_iterate():
+    tracer = instrument.Tracer()
+
+    @tracer.timed()
+    def save(value):
+        return value * 2
+
+    assert save(2) == 4
+    assert list(tracer.iterate(range(3), epoch=1)) == [0, 1, 2]
+    assert [record['stage'] for record in tracer.records] == ['save', 'data_wait', 'data_wait', 'data_wait']
+    assert tracer.records[-1]['tags'] == {'epoch': 1}
+
+
+# the disabled tracer is shared by every instrumented default, it must stay empty
+def test_disabled_tracer_records_nothing():
+    tracer = instrument.DISABLED
+    items = range(3)
+
+    assert tracer.stage('load') is instrument.NULL_STAGE
+    assert tracer.iterate(items) is items
+    assert tracer.timed()(len)([1, 2]) == 2
+    tracer.record('save', 1.0)
+    tracer.extend([{'stage': 'cut'}], [{'peak_rss_mb': 1}])
+
+    assert tracer.snapshot() is None and tracer.write('unused.json') is None
+    assert tracer.records == [] and tracer.memory == []
+
+
+def test_summary():
+    tracer = instrument.Tracer()
+    for seconds in (1.0, 2.0, 3.0):
+        tracer.record('cut', seconds)
+    tracer.record('save', 4.0)
+
+    rows = {row['stage']: row for row in tracer.summary()}
+
+    assert list(rows) == ['cut', 'save']
+    assert rows['cut']['count'] == 3 and rows['cut']['total_s'] == 6.0 and rows['cut']['median_s'] == 2.0
+    assert rows['cut']['max_s'] == 3.0 and rows['save']['share'] == 0.4
+
+
+# worker records are merged into the parent tracer, e.g. by batch.run_batch
+def test_extend_and_snapshot():
+    worker = instrument.Tracer()
+    worker.record('load_cut', 0.5, volume='100')
+    worker.snapshot(pid=1)
+    parent = instrument.Tracer()
+
+    parent.extend(worker.records, worker.memory)
+
+    assert parent.records == worker.records
+    assert parent.memory[0]['tags'] == {'pid': 1}
+    peak = parent.memory[0]['peak_rss_mb']
+    assert peak is None or peak > 0
+
+
+def test_write(tmp_path):
+    tracer = instrument.Tracer()
+    tracer.record('cut', 0.25, case='100_0')
+    tracer.snapshot()
+
+    jsonPath = tracer.write(str(tmp_path / 'trace' / 'batch_trace.json'))
+    csvPath = tracer.write(str(tmp_path / 'batch_trace.csv'))
+
+    with open(jsonPath) as file_obj:
+        trace = json.load(file_obj)
+    assert trace['records'][0]['tags'] == {'case': '100_0'}
+    assert len(trace['memory']) == 1 and trace['summary'][0]['stage'] == 'cut'
+    with open(csvPath, newline='') as file_obj:
+        rows = list(csv.reader(file_obj))
+    assert rows[0] == instrument.FIELDS
+    assert rows[1][0] == 'cut' and float(rows[1][1]) == 0.25 and json.loads(rows[1][3]) == {'case': '100_0'}
@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import torch
+
+from LungNoduleROILib import intensity
+from LungNoduleROILib.intensity import HUWindow, IntensityStats, RunningStats
+
+
+def chunks(seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.normal(-500, 300, size).astype(np.float32) for size in (1, 17, 1000, 4096, 0, 250)]
+
+
+# the merged stats match numpy on all the values at once, however the stream is split
+def test_running_stats_match_numpy():
+    values = np.concatenate(chunks()).astype(np.float64)
+
+    streamed = RunningStats()
+    for chunk in chunks():
+        streamed.update(chunk)
+
+    # stats of two workers merged in the parent
+    left, right = RunningStats(), RunningStats()
+    for idx, chunk in enumerate(chunks()):
+        (left if idx % 2 else right).update(chunk)
+    merged = left.merge(right)
+
+    for stats in (streamed, merged):
+        assert stats.count == values.size
+        assert stats.mean == pytest.approx(values.mean(), rel=1e-12)
+        assert stats.std == pytest.approx(values.std(), rel=1e-9)
+        assert (stats.min, stats.max) == (values.min(), values.max())
+
+
+def test_running_stats_round_trip():
+    stats = RunningStats()
+    assert stats.to_dict()['min'] is None
+    assert RunningStats.from_dict(stats.to_dict()).merge(RunningStats().update([1, 2])).mean == 1.5
+
+    stats.update(np.arange(10))
+    restored = RunningStats.from_dict(json.loads(json.dumps(stats.to_dict())))
+    assert (restored.count, restored.mean, restored.m2, restored.min, restored.max) == \
+        (stats.count, stats.mean, stats.m2, stats.min, stats.max)
+
+
+# integer HU inside the sketch range give the percentiles of np.percentile exactly
+def test_percentiles_match_numpy():
+    values = np.random.default_rng(0).integers(-1024, 3000, 20000)
+    stats = IntensityStats()
+    for chunk in np.array_split(values, 7):
+        stats.update(chunk)
+
+    for q in intensity.SUMMARY_PERCENTILES:
+        assert stats.percentile(q) == pytest.approx(np.percentile(values, q))
+    # float scans are within one bin and never below the exact min, e.g. fractional HU floored into a lower bin
+    fractional = IntensityStats().update([0.25, 0.75])
+    assert fractional.percentile(0) == 0.25
+    assert abs(fractional.percentile(100) - 0.75) < 1
+
+
+def test_intensity_stats_round_trip_and_merge():
+    first, second = IntensityStats().update([-1000, 0, 40]), IntensityStats().update([400, 1000])
+
+    restored = IntensityStats.from_dict(json.loads(json.dumps(first.to_dict()))).merge(second)
+
+    assert restored.summary()['count'] == 5
+    assert restored.percentile(50) == 40
+    with pytest.raises(ValueError, match='merge'):
+        first.merge(IntensityStats(valueRange=(-100, 100)))
+
+
+def test_compute_stats(tmp_path):
+    arrays = [np.full((4, 4, 4), value, dtype=np.int16) for value in (-1000, 0, 500)]
+    paths = []
+    for idx, array in enumerate(arrays):
+        paths.append(str(tmp_path / f'{idx}.nrrd'))
+        sitk.WriteImage(sitk.GetImageFromArray(array), paths[-1])
+
+    stats = intensity.compute_stats(paths + [str(tmp_path / 'missing.nrrd')], workers=1)
+
+    assert stats.count == 3 * 64
+    assert stats.running.mean == pytest.approx(np.mean(arrays))
+    assert intensity.load_stats(intensity.save_stats(stats, str(tmp_path / 'stats.json'))).count == stats.count
+
+
+def test_hu_window():
+    window = HUWindow(-1000, 400)
+
+    np.testing.assert_allclose(window(np.array([-2000, -1000, -300, 400, 3000])), [0, 0, 0.5, 1, 1])
+    torch.testing.assert_close(window(torch.tensor([-300.0], dtype=torch.float64)),
+                               torch.tensor([0.5], dtype=torch.float64))
+    assert window(np.zeros(2, dtype=np.int16)).dtype == np.float32
+    with pytest.raises(ValueError, match='low < high'):
+        HUWindow(400, -1000)
+
+
+def test_window_from_stats_and_weights(tmp_path):
+    stats = IntensityStats().update(np.arange(-1000, 1001))
+    window = HUWindow.from_stats(stats, 5, 95)
+    assert (window.low, window.high) == (-900, 900)
+
+    weightsPath = str(tmp_path / 'unet48.pth')
+    assert intensity.load_window(weightsPath) is None
+    window.save(intensity.window_path(weightsPath))
+    assert intensity.window_path(weightsPath) == str(tmp_path / 'unet48_window.json')
+    assert intensity.load_window(weightsPath) == window
@@ -0,0 +1,33 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from LungNoduleROILib.losses import DiceBCELoss
+from LungNoduleROILib.sweep import LOSSES
+
+
+def test_dice_bce_matches_the_probability_form():
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.randn(2, 1, 8, 8, 8, generator=generator)
+    targets = (torch.rand(2, 1, 8, 8, 8, generator=generator) > 0.5).float()
+
+    probabilities = torch.sigmoid(logits).reshape(-1)
+    flat = targets.reshape(-1)
+    dice = 1 - (2 * (probabilities * flat).sum() + 1) / (probabilities.sum() + flat.sum() + 1)
+    expected = F.binary_cross_entropy(probabilities, flat) + dice
+
+    torch.testing.assert_close(DiceBCELoss()(logits, targets), expected)
+
+
+# sweep trials compute their loss under autocast, see training.train
+@pytest.mark.parametrize('name', sorted(LOSSES))
+def test_sweep_losses_run_under_autocast(name):
+    logits = torch.randn(2, 1, 8, 8, 8, requires_grad=True)
+    targets = (torch.rand(2, 1, 8, 8, 8) > 0.5).float()
+
+    with torch.amp.autocast('cpu'):
+        loss = LOSSES[name]()(logits * 1, targets)
+    loss.backward()
+
+    assert torch.isfinite(loss)
+    assert torch.isfinite(logits.grad).all()
@@ -0,0 +1,65 @@
+from LungNoduleROILib import manifest
+
+
+def touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+    return str(path)
+
+
+def test_pid_from_path():
+    assert manifest.pid_from_path('/data/100012_CT.nrrd') == '100012'
+    assert manifest.pid_from_path('100012.nrrd') == '100012.nrrd'
+
+
+def test_case_key_from_path():
+    assert manifest.case_key_from_path('/rois/100012_2_roi.nrrd') == '100012_2'
+    assert manifest.case_key_from_path('/rois/100012_CT.nrrd') == '100012'
+    assert manifest.case_key_from_path('/rois/100012_roi.nrrd') == '100012'
+
+
+def test_match_indexes():
+    left = {'1': ['a'], '2': ['b'], '3': ['c', 'c2'], '5': ['e']}
+    right = {'1': ['A'], '3': ['C'], '4': ['D'], '5': ['E', 'E2']}
+
+    result = manifest.match_indexes(left, right)
+
+    assert result.matched == {'1': ('a', 'A')}
+    assert result.unmatchedLeft == {'2': ['b']}
+    assert result.unmatchedRight == {'4': ['D']}
+    assert result.duplicates == {'3': (['c', 'c2'], ['C']), '5': (['e'], ['E', 'E2'])}
+
+
+def test_match_indexes_multiple_right():
+    result = manifest.match_indexes({'5': ['e']}, {'5': ['E', 'E2']}, multipleRight=True)
+
+    assert result.matched == {'5': ('e', ['E', 'E2'])}
+    assert not result.duplicates
+
+
+def test_build_case_manifest(tmp_path):
+    volume = touch(tmp_path / 'vols' / '100_CT.nrrd')
+    touch(tmp_path / 'vols' / '101_CT.nrrd')
+    csvPath = tmp_path / 'centroids.csv'
+    csvPath.write_text('100,1,2,3\n100,4,5,6\n\n102,7,8,9\n')
+
+    result = manifest.build_case_manifest(str(tmp_path / 'vols'), str(csvPath))
+
+    # one row per nodule, pids are compared as strings so 100 never matches 1000
+    assert result.matched == {'100': (volume, [['100', '1', '2', '3'], ['100', '4', '5', '6']])}
+    assert list(result.unmatchedLeft) == ['101']
+    assert list(result.unmatchedRight) == ['102']
+    assert result.summary() == '1 matched, 1 + 1 unmatched, 0 duplicated'
+
+
+def test_build_label_manifest(tmp_path):
+    scan = touch(tmp_path / 'scans' / '100_0_roi.nrrd')
+    label = touch(tmp_path / 'labels' / 'nested' / '100_0_label.nrrd')
+    touch(tmp_path / 'scans' / '100_1_roi.nrrd')
+    touch(tmp_path / 'scans' / '1000_0_roi.nrrd')
+
+    result = manifest.build_label_manifest(str(tmp_path / 'scans'), str(tmp_path / 'labels'))
+
+    assert result.matched == {'100_0': (scan, label)}
+    assert sorted(result.unmatchedLeft) == ['1000_0', '100_1']
+    assert not result.unmatchedRight
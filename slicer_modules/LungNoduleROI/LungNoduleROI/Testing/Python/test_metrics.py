@@ -0,0 +1,99 @@
+import numpy as np
+import torch
+
+from LungNoduleROILib.metrics import segmentation_metrics, surface
+
+
+# per case dice loop of mk3.ipynb that segmentation_metrics replaced
+def dice_coefficient(tensor1, tensor2, threshold=.5):
+    tensor1 = (tensor1 >= threshold).float()
+    tensor2 = (tensor2 >= threshold).float()
+
+    intersection = torch.sum(tensor1 * tensor2)
+    union = torch.sum(tensor1) + torch.sum(tensor2)
+
+    if union == 0:
+        return torch.tensor(1.0)
+    else:
+        return 2 * intersection / union
+
+
+def batch():
+    generator = torch.Generator().manual_seed(0)
+    predictions = torch.rand(6, 1, 12, 12, 12, generator=generator)
+    targets = (torch.rand(6, 1, 12, 12, 12, generator=generator) > 0.7).float()
+
+    # empty prediction and target, empty prediction only, empty target only
+    predictions[3] = 0
+    targets[3] = 0
+    predictions[4] = 0
+    targets[5] = 0
+    return predictions, targets
+
+
+def test_dice_matches_per_case_loop():
+    predictions, targets = batch()
+    thresholds = [0.2, 0.5, 0.9]
+
+    table = segmentation_metrics(predictions, targets, thresholds=thresholds, distances=False)
+
+    assert len(table) == len(thresholds) * len(predictions)
+    for threshold in thresholds:
+        rows = table[table.threshold == threshold]
+        expected = [dice_coefficient(predictions[i], targets[i], threshold).item() for i in range(len(predictions))]
+        assert list(rows.case) == list(range(len(predictions)))
+        np.testing.assert_allclose(rows.dice.values, expected, rtol=1e-6)
+
+
+def test_overlap_metrics_and_volumes():
+    predictions, targets = batch()
+    spacing = (2.0, 1.0, 0.5)
+
+    table = segmentation_metrics(predictions, targets, spacing=spacing, case_ids=list('abcdef'), distances=False)
+
+    for i, row in enumerate(table.itertuples()):
+        pred = (predictions[i] >= 0.5).numpy()
+        target = (targets[i] >= 0.5).numpy()
+        tp, fp, fn = (pred & target).sum(), (pred & ~target).sum(), (~pred & target).sum()
+
+        assert row.case == 'abcdef'[i]
+        assert row.pred_volume == (tp + fp) * 1.0
+        assert row.target_volume == (tp + fn) * 1.0
+        if tp + fp + fn:
+            assert np.isclose(row.iou, tp / (tp + fp + fn))
+        else:
+            assert row.iou == 1.0
+    assert np.isnan(table.hausdorff).all()
+
+
+def test_from_logits():
+    predictions, targets = batch()
+    logits = torch.logit(predictions.clamp(1e-4, 1 - 1e-4))
+
+    np.testing.assert_allclose(segmentation_metrics(logits, targets, from_logits=True, distances=False).dice,
+                               segmentation_metrics(predictions, targets, distances=False).dice, rtol=1e-6)
+
+
+def test_surface_of_a_cube():
+    masks = torch.zeros(1, 7, 7, 7, dtype=torch.bool)
+    masks[0, 1:6, 1:6, 1:6] = True
+
+    # 5^3 cube, everything but its 3^3 core touches the background
+    assert surface(masks).sum() == 5 ** 3 - 3 ** 3
+
+
+def test_surface_distances_of_shifted_cubes():
+    predictions = torch.zeros(2, 1, 16, 16, 16)
+    targets = torch.zeros(2, 1, 16, 16, 16)
+    predictions[0, 0, 4:10, 4:10, 4:10] = 1
+    targets[0, 0, 4:10, 4:10, 6:12] = 1
+    predictions[1, 0, 4:10, 4:10, 4:10] = 1
+
+    table = segmentation_metrics(predictions, targets, spacing=(1, 1, 3))
+
+    # shifted by two voxels along the last axis, 6 mm with a spacing of 3
+    assert table.hausdorff[0] == 6
+    assert table.hausdorff95[0] <= 6
+    assert 0 < table.mean_surface_distance[0] < 6
+    # undefined against an empty target
+    assert np.isnan(table.hausdorff[1])
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from LungNoduleROILib import batch, resample, transforms
+
+
+# anisotropic CT with a rotated direction and an offset origin, like a scanner export
+def ct_image():
+    img = sitk.GetImageFromArray(np.random.default_rng(0).integers(-1000, 400, (12, 20, 24)).astype(np.int16))
+    img.SetSpacing((0.7, 0.8, 2.5))
+    img.SetOrigin((-120.0, 30.0, 85.0))
+    img.SetDirection((0, 1, 0, -1, 0, 0, 0, 0, 1))
+    return img
+
+
+def test_parse_spacing():
+    assert resample.parse_spacing('1') == [1.0, 1.0, 1.0]
+    assert resample.parse_spacing('0.7, 0.7 1.25') == [0.7, 0.7, 1.25]
+    with pytest.raises(ValueError, match='spacing'):
+        resample.parse_spacing('1,2')
+    with pytest.raises(ValueError, match='spacing'):
+        resample.parse_spacing('0')
+
+
+def test_resample_keeps_the_physical_extent():
+    img = ct_image()
+
+    resampled = resample.resample_image(img, (1, 1, 1))
+
+    assert resampled.GetSize() == (17, 16, 30)
+    assert resampled.GetOrigin() == img.GetOrigin()
+    assert resampled.GetDirection() == img.GetDirection()
+    assert resampled.GetPixelID() == img.GetPixelID()
+
+
+# a voxel index maps onto the resampled voxel at the same physical point, the direction included
+def test_map_indices_through_physical_space():
+    img = ct_image()
+    resampled = resample.resample_image(img, (1, 1, 1))
+    source, target = transforms.geometry_from_image(img), transforms.geometry_from_image(resampled)
+    index = [10, 5, 6]
+
+    mapped = resample.map_indices(index, source, target)
+
+    point = img.TransformIndexToPhysicalPoint(index)
+    assert list(mapped) == list(resampled.TransformPhysicalPointToIndex(point))
+    np.testing.assert_allclose(resample.map_indices(mapped, target, source, rounded=False), index, atol=0.5)
+
+
+def test_cached_resample_reuses_entries(tmp_path):
+    path = str(tmp_path / '100_CT.nrrd')
+    sitk.WriteImage(ct_image(), path)
+    cacheDir = str(tmp_path / 'cache')
+
+    first = resample.cached_resample(path, (1, 1, 1), cacheDir)
+    mtime = os.stat(first).st_mtime_ns
+
+    assert resample.cached_resample(path, (1, 1, 1), cacheDir) == first
+    assert os.stat(first).st_mtime_ns == mtime
+    # another spacing is another entry, the source is never touched
+    assert resample.cached_resample(path, (2, 2, 2), cacheDir) != first
+    assert sitk.ReadImage(first).GetSpacing() == (1.0, 1.0, 1.0)
+
+
+# an index centroid of the original volume lands on the same anatomy in the roi cut from the resampled copy
+def test_batch_maps_index_centroids_onto_the_resampled_grid(tmp_path):
+    volume = np.full((12, 20, 24), -1000, dtype=np.int16)
+    volume[5:8, 8:12, 10:14] = 40
+    img = sitk.GetImageFromArray(volume)
+    img.SetSpacing((0.5, 0.5, 2.0))
+    path = str(tmp_path / '100_CT.nrrd')
+    sitk.WriteImage(img, path)
+
+    case = batch.Case(path, '100', 12, 10, 6, 6)
+    results = batch.run_batch([case], str(tmp_path / 'rois'), workers=1, spacing=(1, 1, 1),
+                              resampleDir=str(tmp_path / 'cache'))
+
+    assert results[0].success
+    roi = sitk.GetArrayFromImage(sitk.ReadImage(results[0].outputPath))
+    assert roi.shape == (6, 6, 6)
+    assert roi[3, 3, 3] == 40
+    assert os.listdir(str(tmp_path / 'cache'))
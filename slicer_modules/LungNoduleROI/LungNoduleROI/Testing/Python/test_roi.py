@@ -0,0 +1,77 @@
+import numpy as np
+import SimpleITK as sitk
+
+from LungNoduleROILib.roi import ImageROI
+
+SIZE = [8, 6, 4]
+
+
+# (z, y, x) volume whose voxels hold their own flat index, so every copied voxel can be traced back
+def volume_array():
+    return np.arange(10 * 12 * 14, dtype=np.int16).reshape(10, 12, 14)
+
+
+def test_roi_inside_volume_is_a_plain_crop():
+    volume = volume_array()
+    roi = ImageROI().create_roi_image_from_array(volume, SIZE, (7, 6, 5))
+
+    assert roi.shape == (4, 6, 8)
+    np.testing.assert_array_equal(roi, volume[3:7, 3:9, 3:11])
+
+
+def test_roi_at_lower_border_is_padded_before():
+    volume = volume_array()
+    roi = ImageROI().create_roi_image_from_array(volume, SIZE, (1, 0, 5), pad_value=-1000)
+
+    # x starts at -3 and y at -3, three columns and rows of padding before the copied voxels
+    assert roi.shape == (4, 6, 8)
+    assert (roi[:, :3, :] == -1000).all()
+    assert (roi[:, :, :3] == -1000).all()
+    np.testing.assert_array_equal(roi[:, 3:, 3:], volume[3:7, 0:3, 0:5])
+
+
+def test_roi_at_upper_border_is_padded_after():
+    volume = volume_array()
+    roi = ImageROI().create_roi_image_from_array(volume, SIZE, (13, 11, 9), pad_value=-1000)
+
+    # x window [9, 17) keeps 5 of 14 columns, y [8, 14) 4 of 12 rows, z [7, 11) 3 of 10 slices
+    assert roi.shape == (4, 6, 8)
+    np.testing.assert_array_equal(roi[:3, :4, :5], volume[7:10, 8:12, 9:14])
+    assert (roi[3:] == -1000).all()
+    assert (roi[:, 4:] == -1000).all()
+    assert (roi[:, :, 5:] == -1000).all()
+
+
+def test_roi_outside_volume_is_all_padding():
+    roi = ImageROI().create_roi_image_from_array(volume_array(), SIZE, (100, 100, 100), pad_value=-1000)
+
+    assert roi.shape == (4, 6, 8)
+    assert roi.dtype == np.int16
+    assert (roi == -1000).all()
+
+
+def test_roi_does_not_alias_the_volume():
+    volume = volume_array()
+    roi = ImageROI().create_roi_image_from_array(volume, SIZE, (7, 6, 5))
+    roi[:] = 0
+
+    assert volume[3, 3, 3] == 3 * 12 * 14 + 3 * 14 + 3
+
+
+def test_image_file_and_array_rois_agree(tmp_path):
+    volume = volume_array()
+    path = str(tmp_path / 'volume.nrrd')
+    sitk.WriteImage(sitk.GetImageFromArray(volume), path)
+
+    imageROI = ImageROI()
+    for centroid in [(7, 6, 5), (1, 0, 5), (13, 11, 9), (100, 100, 100)]:
+        expected = imageROI.create_roi_image_from_array(volume, SIZE, centroid)
+        np.testing.assert_array_equal(imageROI.create_roi_image(sitk.ReadImage(path), SIZE, centroid), expected)
+        np.testing.assert_array_equal(imageROI.create_roi_image_from_file(path, SIZE, centroid), expected)
+
+
+# batch export and the benchmarks create an ImageROI per case, it must not write to stdout
+def test_image_roi_is_silent(capsys):
+    ImageROI()
+
+    assert capsys.readouterr().out == ''
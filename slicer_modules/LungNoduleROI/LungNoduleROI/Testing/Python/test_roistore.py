@@ -0,0 +1,111 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+# the store is optional, h5py is only needed to export into one file
+pytest.importorskip('h5py')
+
+from LungNoduleROILib.roistore import ROIStore, ROIStoreDataset, write_pairs  # noqa: E402
+
+GEOMETRY = ((-120.0, 30.0, 85.0), (0.7, 0.8, 2.5), np.eye(3).ravel().tolist())
+
+
+def roi(seed, shape=(8, 8, 8)):
+    return np.random.default_rng(seed).integers(-1000, 400, shape).astype(np.int16)
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'lzf', 'none'])
+def test_round_trip(tmp_path, codec):
+    path = str(tmp_path / 'rois.h5')
+    label = np.zeros((8, 8, 8), dtype=np.uint8)
+    label[2:5, 2:5, 2:5] = 255
+
+    with ROIStore(path, codec=codec) as store:
+        store.append('100_0', roi(0), label, GEOMETRY, centroid=[10, 12, 4], pid='100',
+                     fingerprint={'size': 1, 'mtime_ns': 2})
+        store.append('101_0', roi(1))
+
+    with ROIStore(path, 'r') as store:
+        assert store.names() == ['100_0', '101_0'] and store.names(labelled=True) == ['100_0']
+        stored, storedLabel = store.read('100_0')
+        np.testing.assert_array_equal(stored, roi(0))
+        assert stored.dtype == np.int16
+        # masks are kept binary
+        np.testing.assert_array_equal(storedLabel, label > 0)
+        assert store.read('101_0')[1] is None
+
+        metadata = store.metadata('100_0')
+        assert metadata['origin'] == list(GEOMETRY[0]) and metadata['spacing'] == list(GEOMETRY[1])
+        assert metadata['direction'] == np.eye(3).tolist() and metadata['centroid'] == [10, 12, 4]
+        assert metadata['pid'] == '100' and metadata['fingerprint'] == {'size': 1, 'mtime_ns': 2}
+        assert metadata['shape'] == [8, 8, 8] and metadata['labelled']
+        assert store.range == (float(min(roi(0).min(), roi(1).min())), float(max(roi(0).max(), roi(1).max())))
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError, match='codec'):
+        ROIStore(str(tmp_path / 'rois.h5'), codec='zstd')
+
+
+# stats are merged on append, a replaced sample makes them stale and they are gathered again from the store
+def test_intensity_stats_after_replace(tmp_path):
+    path = str(tmp_path / 'rois.h5')
+    with ROIStore(path) as store:
+        store.append('100_0', roi(0))
+        store.append('101_0', roi(1))
+        assert store.intensity_stats().count == 2 * 8 ** 3
+
+    with ROIStore(path) as store:
+        store.append('100_0', roi(2, (4, 4, 4)))
+        stats = store.intensity_stats()
+
+    values = np.concatenate([roi(2, (4, 4, 4)).ravel(), roi(1).ravel()]).astype(np.float64)
+    assert stats.count == values.size
+    assert stats.running.mean == pytest.approx(values.mean())
+    assert stats.running.min == values.min() and stats.running.max == values.max()
+
+    # the saved stats are read back, not gathered again
+    with ROIStore(path, 'r') as store:
+        assert store.intensity_stats().running.mean == pytest.approx(values.mean())
+
+
+def test_write_pairs_skips_unchanged(roi_pairs, tmp_path):
+    path = str(tmp_path / 'rois.h5')
+
+    assert len(write_pairs(roi_pairs, path, workers=1)) == 6
+    assert write_pairs(roi_pairs, path, workers=1) == []
+
+    with ROIStore(path, 'r') as store:
+        assert store.metadata('105_0')['shape'] == [44, 44, 44]
+        assert store.metadata('100_0')['pid'] == '100'
+
+
+def test_dataset(roi_pairs, tmp_path):
+    path = str(tmp_path / 'rois.h5')
+    write_pairs(roi_pairs, path, workers=1)
+
+    dataset = ROIStoreDataset(path, desired_size=(40, 40, 40), normalize=True)
+    assert dataset.pids == ['100_0', '101_0', '102_0', '103_0', '104_0']
+
+    scan, label = dataset[0]
+    assert scan.shape == label.shape == (1, 40, 40, 40)
+    assert 0 <= scan.min() and scan.max() <= 1
+    assert set(label.unique().tolist()) == {0.0, 1.0}
+
+    # the open handle is not pickled into DataLoader workers, the copy reopens the file
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy.store is None
+    torch.testing.assert_close(copy[0][0], scan)
+    dataset.store.close()
+    copy.store.close()
+
+
+def test_dataset_rejects_unlabelled_names(roi_pairs, tmp_path):
+    path = str(tmp_path / 'rois.h5')
+    with ROIStore(path) as store:
+        store.append('200_0', roi(0))
+
+    with pytest.raises(ValueError, match='200_0'):
+        ROIStoreDataset(path, names=['200_0'])
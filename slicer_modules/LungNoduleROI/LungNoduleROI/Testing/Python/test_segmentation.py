@@ -0,0 +1,88 @@
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+from LungNoduleROILib import segmentation
+from LungNoduleROILib.intensity import HUWindow
+from LungNoduleROILib.unet import UNet
+
+
+# stands in for an InferenceSession, a voxel is nodule where its scan value is positive
+class ThresholdSession:
+    def __init__(self, input_multiple=1, window=None):
+        self.input_multiple = input_multiple
+        self.window = window
+        self.calls = []
+
+    def segment(self, scans, threshold=0.5):
+        self.calls.append(tuple(scans.shape))
+        return scans > 0
+
+
+def random_roi(shape, seed):
+    return np.random.default_rng(seed).integers(-1000, 400, shape).astype(np.int16)
+
+
+# masks come back in the shape and position of their rois, however they were padded on the way
+def test_segment_rois_crops_back():
+    rois = [random_roi((20, 20, 20), 0), random_roi((40, 40, 40), 1), random_roi((44, 40, 36), 2),
+            random_roi((20, 20, 20), 3)]
+    session = ThresholdSession(input_multiple=16)
+
+    masks = segmentation.segment_rois(session, rois)
+
+    for roi, mask in zip(rois, masks):
+        assert mask.shape == roi.shape and mask.dtype == np.uint8
+        np.testing.assert_array_equal(mask, roi > 0)
+    # rois of one shape share a forward pass, every input is at least 40^3 and a multiple of 16
+    assert sorted(session.calls) == [(1, 1, 48, 48, 48), (1, 1, 48, 48, 48), (2, 1, 48, 48, 48)]
+
+
+# small rois are padded with air, the padding never shows up as nodule
+def test_segment_rois_pads_with_the_minimum():
+    roi = np.full((10, 10, 10), 50, dtype=np.int16)
+
+    mask = segmentation.segment_roi(ThresholdSession(), roi)
+
+    assert mask.shape == (10, 10, 10) and mask.all()
+
+
+def test_segment_rois_applies_the_window():
+    roi = random_roi((40, 40, 40), 0)
+    window = HUWindow(-1000, 400)
+
+    mask = segmentation.segment_roi(ThresholdSession(window=window), roi)
+
+    np.testing.assert_array_equal(mask, window(roi) > 0)
+
+
+def test_segmentation_path():
+    assert segmentation.segmentation_path('/rois/100_0_roi.nrrd') == '/rois/100_0_seg.nrrd'
+    assert segmentation.segmentation_path('/rois/scan.nii') == '/rois/scan_seg.nrrd'
+
+
+# labelmaps are written next to their rois with the roi geometry, the model is loaded once
+def test_segment_files(tmp_path):
+    torch.manual_seed(0)
+    weightsPath = str(tmp_path / 'unet.pth')
+    torch.save(UNet(features=[4, 8]).eval().state_dict(), weightsPath)
+
+    roiPaths = []
+    for idx, shape in enumerate([(40, 40, 40), (30, 36, 40)]):
+        img = sitk.GetImageFromArray(random_roi(shape, idx))
+        img.SetSpacing((0.7, 0.7, 1.25))
+        img.SetOrigin((idx, 2.0, -3.0))
+        roiPaths.append(str(tmp_path / f'10{idx}_0_roi.nrrd'))
+        sitk.WriteImage(img, roiPaths[-1])
+    roiPaths.append(str(tmp_path / 'missing_roi.nrrd'))
+
+    segmented = segmentation.segment_files(roiPaths, weightsPath)
+    session = segmentation.load_session(weightsPath)
+
+    assert list(segmented) == roiPaths[:2]
+    assert segmentation.load_session(weightsPath) is session
+    for roiPath, segmentationPath in segmented.items():
+        roi, mask = sitk.ReadImage(roiPath), sitk.ReadImage(segmentationPath)
+        assert mask.GetSize() == roi.GetSize()
+        assert mask.GetSpacing() == roi.GetSpacing() and mask.GetOrigin() == roi.GetOrigin()
+        assert set(np.unique(sitk.GetArrayFromImage(mask))) <= {0, 1}
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import torch
+
+from LungNoduleROILib.sliding_window import blend_weights, patch_starts, sliding_window_inference
+
+
+# logits equal to the input, so the blended probabilities have to equal sigmoid(volume) wherever patches overlap
+class Identity(torch.nn.Module):
+    def forward(self, x):
+        return x
+
+
+# each patch sees only itself, a constant output per patch shows up as seams if stitching goes wrong
+class PatchMean(torch.nn.Module):
+    def forward(self, x):
+        return x.mean(dim=(2, 3, 4), keepdim=True).expand_as(x)
+
+
+def test_patch_starts_cover_the_axis():
+    assert patch_starts(10, 16, 8) == [0]
+    assert patch_starts(16, 16, 8) == [0]
+    assert patch_starts(40, 16, 8) == [0, 8, 16, 24]
+    assert patch_starts(41, 16, 8) == [0, 8, 16, 24, 25]
+    assert patch_starts(41, 16, 16) == [0, 16, 25]
+
+
+@pytest.mark.parametrize('mode', ['gaussian', 'linear', 'constant'])
+def test_blend_weights(mode):
+    weights = blend_weights((5, 6, 7), mode)
+
+    assert weights.shape == (5, 6, 7)
+    assert weights.max() == 1
+    assert weights.min() > 0
+    np.testing.assert_allclose(weights, weights[::-1, ::-1, ::-1])
+
+
+@pytest.mark.parametrize('mode', ['gaussian', 'linear', 'constant'])
+@pytest.mark.parametrize('stride', [(8, 8, 8), (16, 16, 16), (5, 7, 16)])
+def test_identity_model_reproduces_the_volume(mode, stride):
+    volume = np.random.default_rng(0).normal(size=(30, 37, 41)).astype(np.float32)
+
+    probabilities, stats = sliding_window_inference(Identity(), volume, patch_size=(16, 16, 16), stride=stride,
+                                                    batch_size=3, mode=mode)
+
+    assert probabilities.shape == volume.shape
+    np.testing.assert_allclose(probabilities, 1 / (1 + np.exp(-volume)), atol=1e-5)
+    assert stats['patches'] == np.prod([len(patch_starts(size, 16, s)) for size, s in zip(volume.shape, stride)])
+
+
+@pytest.mark.parametrize('stride', [(0, 8, 8), (8, -8, 8), (8, 8, 17), (8, 8)])
+def test_invalid_stride_is_rejected(stride):
+    with pytest.raises(ValueError):
+        sliding_window_inference(Identity(), np.zeros((32, 32, 32), dtype=np.float32), patch_size=(16, 16, 16),
+                                 stride=stride)
+
+
+def test_volume_smaller_than_a_patch_is_padded_and_cropped():
+    volume = np.full((10, 12, 20), 2.0, dtype=np.float32)
+
+    probabilities, stats = sliding_window_inference(PatchMean(), volume, patch_size=(16, 16, 16), stride=(8, 8, 8),
+                                                    pad_value=0)
+
+    # padded to (16, 16, 20), two patches along the last axis
+    assert probabilities.shape == volume.shape
+    assert stats['patches'] == 2
+    padded_mean = 2.0 * (10 * 12) / (16 * 16)
+    np.testing.assert_allclose(probabilities, 1 / (1 + np.exp(-padded_mean)), rtol=1e-5)
+
+
+def test_normalize_is_applied_before_tiling():
+    volume = np.full((16, 16, 16), -1000.0, dtype=np.float32)
+
+    probabilities, _ = sliding_window_inference(Identity(), volume, patch_size=(16, 16, 16), stride=(16, 16, 16),
+                                                normalize=lambda v: v * 0)
+
+    np.testing.assert_allclose(probabilities, 0.5)
@@ -0,0 +1,72 @@
+import numpy as np
+import SimpleITK as sitk
+
+from LungNoduleROILib import transforms
+
+
+# oblique image with anisotropic spacing, the case the closed form has to get right
+def image():
+    img = sitk.Image([20, 30, 40], sitk.sitkInt16)
+    img.SetOrigin((-120.5, 80.25, -300.0))
+    img.SetSpacing((0.7, 0.8, 2.5))
+    rotation = sitk.VersorTransform((0.1, 0.3, 0.2), 0.4).GetMatrix()
+    img.SetDirection(rotation)
+    return img
+
+
+# RAS to IJK matrix the way slicer builds it from the LPS geometry of a file
+def ras_to_ijk(img):
+    origin, spacing, direction = transforms.geometry_from_image(img)
+    ijkToRas = np.eye(4)
+    ijkToRas[:3, :3] = np.diag(transforms.RAS_TO_LPS) @ direction * spacing
+    ijkToRas[:3, 3] = transforms.lps_to_ras(origin)
+    return np.linalg.inv(ijkToRas)
+
+
+def test_ras_lps_round_trip():
+    points = np.array([[1.0, -2.0, 3.0], [0.5, 0.25, -7.0]])
+
+    np.testing.assert_array_equal(transforms.ras_to_lps(points), [[-1.0, 2.0, 3.0], [-0.5, -0.25, -7.0]])
+    np.testing.assert_array_equal(transforms.lps_to_ras(transforms.ras_to_lps(points)), points)
+
+
+def test_physical_to_index_matches_sitk():
+    img = image()
+    geometry = transforms.geometry_from_image(img)
+    rng = np.random.default_rng(0)
+    indices = rng.uniform(-0.49, [19.49, 29.49, 39.49], size=(50, 3))
+    points = [img.TransformContinuousIndexToPhysicalPoint(index.tolist()) for index in indices]
+
+    expected = [img.TransformPhysicalPointToIndex(point) for point in points]
+    np.testing.assert_array_equal(transforms.physical_to_index(points, geometry), expected)
+    np.testing.assert_allclose(transforms.physical_to_index(points, geometry, rounded=False), indices, atol=1e-9)
+    np.testing.assert_allclose(transforms.index_to_physical(indices, geometry), points, atol=1e-9)
+
+
+def test_geometry_from_file_matches_image(tmp_path):
+    img = image()
+    path = str(tmp_path / 'volume.nrrd')
+    sitk.WriteImage(img, path)
+
+    for read, expected in zip(transforms.geometry_from_file(path), transforms.geometry_from_image(img)):
+        np.testing.assert_allclose(read, expected, atol=1e-6)
+
+
+def test_ras_to_index_matches_sitk():
+    img = image()
+    indices = np.array([[0, 0, 0], [19, 29, 39], [3, 17, 22]])
+    lps = [img.TransformIndexToPhysicalPoint(index.tolist()) for index in indices]
+
+    np.testing.assert_array_equal(transforms.ras_to_index(transforms.lps_to_ras(lps), ras_to_ijk(img)), indices)
+
+    # a single point keeps its (3,) shape
+    single = transforms.ras_to_index(transforms.lps_to_ras(lps[2]), ras_to_ijk(img))
+    np.testing.assert_array_equal(single, indices[2])
+
+
+def test_ras_to_index_rounds_half_voxels_up():
+    rasToIjk = np.eye(4)
+
+    np.testing.assert_array_equal(transforms.ras_to_index([[0.5, -0.5, 1.49]], rasToIjk), [[1, 0, 1]])
+    np.testing.assert_allclose(transforms.ras_to_index([[0.5, -0.5, 1.49]], rasToIjk, rounded=False),
+                               [[0.5, -0.5, 1.49]])
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from LungNoduleROILib.inference import ROI_SHAPE, InferenceSession
+from LungNoduleROILib.unet import UNet
+
+
+# every producer in the repo writes 40^3 rois (ImageROI, build_roi_cache, ROI_SHAPE), the defaults must take them
+def test_default_unet_and_session_take_the_default_roi_shape():
+    torch.manual_seed(0)
+    model = UNet().eval()
+    scans = torch.randn(ROI_SHAPE)
+
+    with torch.inference_mode():
+        expected = model(scans)
+    session = InferenceSession(model, backend='torchscript')
+
+    assert expected.shape == ROI_SHAPE
+    assert session.input_multiple == 1
+    torch.testing.assert_close(session.logits(scans), expected, atol=1e-4, rtol=1e-4)
+
+
+def test_strict_unet_rejects_sizes_it_cannot_reconstruct():
+    model = UNet(features=[4, 8, 16, 32], resize_skips=False).eval()
+
+    with pytest.raises(ValueError, match='divisible by 16'):
+        model(torch.zeros(ROI_SHAPE))
+    with pytest.raises(ValueError, match='expects'):
+        model(torch.zeros(1, 2, 48, 48, 48))
+    assert model(torch.zeros(1, 1, 48, 48, 48)).shape == (1, 1, 48, 48, 48)
+
+
+@pytest.mark.parametrize('norm', ['batch', 'instance', 'group', 'none'])
+def test_checkpointing_keeps_the_gradients(norm):
+    torch.manual_seed(0)
+    model = UNet(features=[4, 8], norm=norm)
+    scans = torch.randn(2, 1, 16, 16, 16)
+
+    model(scans).square().mean().backward()
+    expected = [parameter.grad.clone() for parameter in model.parameters()]
+    model.zero_grad()
+    model.set_checkpointing(True)
+    model(scans).square().mean().backward()
+
+    for parameter, grad in zip(model.parameters(), expected):
+        torch.testing.assert_close(parameter.grad, grad)